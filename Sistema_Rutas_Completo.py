@@ -7,12 +7,8 @@ Características:
 - Caché inteligente
 """
 
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox, scrolledtext
 import pandas as pd
 import requests
-import folium
-import polyline
 import os
 import time
 import hashlib
@@ -22,15 +18,41 @@ import threading
 import webbrowser
 import sys
 import subprocess
-from PIL import Image, ImageTk
 import math
 import re
-import urllib.parse
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, replace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import argparse
+import queue
+import pickle
+import shutil
+import random
+import sqlite3
+import uuid
 from typing import Optional, List, Dict, Any, Tuple
 from functools import lru_cache
 import logging
 
+import formato_rutas
+import url_maps
+from geometria_rutas import CACHE_POLILINEAS
+from instrumentacion import INSTRUMENTACION, MODOS_PERFIL, lineas_resumen
+from indice_destinatarios import IndiceDestinatarios, clave
+
+# tkinter y folium se importan al usarse: el pipeline sin interfaz no los necesita
+tk = ttk = filedialog = messagebox = scrolledtext = None
+
+def _importar_tk():
+    """Importa tkinter bajo demanda (solo la interfaz gráfica lo usa)"""
+    global tk, ttk, filedialog, messagebox, scrolledtext
+    if tk is None:
+        import tkinter
+        from tkinter import ttk as _ttk, filedialog as _filedialog
+        from tkinter import messagebox as _messagebox, scrolledtext as _scrolledtext
+        tk, ttk, filedialog = tkinter, _ttk, _filedialog
+        messagebox, scrolledtext = _messagebox, _scrolledtext
+
 # Configuración de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -48,8 +70,31 @@ class Config:
     ORIGEN_NOMBRE: str = "TSJCDMX - Niños Héroes 150"
     MAX_EDIFICIOS_POR_RUTA: int = 8
     MIN_EDIFICIOS_POR_RUTA: int = 6
+    PROCESOS_EXPORTACION: int = 0  # 0 = un proceso por núcleo
+    EXCEL_MODO: str = "por_ruta"  # "por_ruta" o "libro_unico"
+    LIBRO_RUTAS: str = "RUTAS_COMPLETAS.xlsx"
+    MAPA_MODO: str = "combinado"  # "combinado" o "por_ruta" (Folium)
+    MAPA_COMBINADO: str = "mapas_pro/MAPA_RUTAS.html"
+    TOLERANCIA_POLILINEA_M: float = 10.0  # Douglas–Peucker para mapas (0 = sin simplificar)
+    FORMATO_PAYLOAD: str = "json"  # "json" (minificado) o "msgpack"
+    COMPRIMIR_PAYLOAD: bool = False  # gzip sobre el formato elegido
     TIMEOUT_API: int = 15
+    PAUSA_GEOCODE: float = 0.1  # Rate limiting entre llamadas de geocoding
     CACHE_FILE: str = "geocode_cache.json"
+    CACHE_GUARDAR_CADA: int = 25  # Persistir caché de geocoding cada N consultas nuevas
+    CHECKPOINT_DIR: str = "checkpoints"
+    LOG_INTERVALO_MS: int = 100  # Cada cuánto la interfaz drena la cola de log
+    LOG_MAX_LINEAS: int = 2000  # Scrollback máximo del log en pantalla
+    MANIFIESTO_FILE: str = "manifiesto_rutas.json"
+    INDICE_DESTINATARIOS: str = "indice_destinatarios.json"  # Nombre → (ruta, edificio, persona)
+    REPORTE_EJECUCION: str = "REPORTE_EJECUCION.json"  # Junto a RESUMEN_RUTAS.xlsx
+    PERFIL_FILE: str = "perfil_ejecucion.prof"
+    OUTBOX_DB: str = "outbox_bot.db"  # Cola persistente de envíos al bot
+    OUTBOX_BACKOFF_BASE: float = 5.0  # Segundos; se duplica por intento
+    OUTBOX_BACKOFF_MAX: float = 600.0
+    AVANCES_PAGINA: int = 100  # Avances por petición al sincronizar
+    STREAM_TIMEOUT_LECTURA: float = 45.0  # > latido del bot; si se excede, reconectar
+    STREAM_ESPERA_MAX: float = 60.0  # Tope del backoff de reconexión del stream
     
     # Carpetas del sistema
     CARPETAS: List[str] = None
@@ -69,8 +114,10 @@ CONFIG = Config()
 class CacheManager:
     """Gestor de caché unificado"""
     
-    def __init__(self, cache_file: str):
+    def __init__(self, cache_file: str, guardar_cada: int = 0):
         self.cache_file = cache_file
+        self.guardar_cada = guardar_cada
+        self.pendientes = 0
         self.cache = self._cargar_cache()
     
     def _cargar_cache(self) -> Dict:
@@ -84,8 +131,11 @@ class CacheManager:
     
     def guardar_cache(self):
         try:
-            with open(self.cache_file, 'w') as f:
+            temporal = f"{self.cache_file}.tmp"
+            with open(temporal, 'w') as f:
                 json.dump(self.cache, f)
+            os.replace(temporal, self.cache_file)
+            self.pendientes = 0
         except IOError as e:
             logger.error(f"Error guardando cache: {e}")
     
@@ -94,6 +144,9 @@ class CacheManager:
     
     def guardar(self, key: str, value: Any):
         self.cache[key] = value
+        self.pendientes += 1
+        if self.guardar_cada and self.pendientes >= self.guardar_cada:
+            self.guardar_cache()
     
     def generar_key(self, texto: str) -> str:
         return hashlib.md5(texto.encode('utf-8')).hexdigest()
@@ -119,8 +172,11 @@ class FileManager:
     def limpiar_todo():
         for carpeta in CONFIG.CARPETAS:
             FileManager.limpiar_carpeta(carpeta)
-        if os.path.exists("RESUMEN_RUTAS.xlsx"):
-            os.unlink("RESUMEN_RUTAS.xlsx")
+        for archivo in ("RESUMEN_RUTAS.xlsx", CONFIG.LIBRO_RUTAS, CONFIG.MANIFIESTO_FILE,
+                        CONFIG.INDICE_DESTINATARIOS, CONFIG.REPORTE_EJECUCION, CONFIG.PERFIL_FILE):
+            if os.path.exists(archivo):
+                os.unlink(archivo)
+        PuntosControl(CONFIG.CHECKPOINT_DIR).limpiar()
     
     @staticmethod
     def abrir_carpeta(carpeta: str):
@@ -135,6 +191,193 @@ class FileManager:
                 logger.error(f"Error abriendo carpeta: {e}")
         return False
 
+class ManifiestoArtefactos:
+    """Manifiesto de artefactos generados, indexado por hash del contenido de cada ruta"""
+    
+    CARPETAS_ARTEFACTOS = ['mapas_pro', 'rutas_excel', 'rutas_telegram']
+    
+    def __init__(self, archivo: str):
+        self.archivo = archivo
+        self.entradas: Dict[str, Dict] = self._cargar()
+    
+    def _cargar(self) -> Dict:
+        if os.path.exists(self.archivo):
+            try:
+                with open(self.archivo, 'r', encoding='utf-8') as f:
+                    return json.load(f).get('rutas', {})
+            except (json.JSONDecodeError, IOError):
+                logger.warning(f"Manifiesto corrupto, se regenerará todo: {self.archivo}")
+        return {}
+    
+    def guardar(self):
+        try:
+            temporal = f"{self.archivo}.tmp"
+            with open(temporal, 'w', encoding='utf-8') as f:
+                json.dump({'version': 1, 'rutas': self.entradas}, f, ensure_ascii=False)
+            os.replace(temporal, self.archivo)
+        except IOError as e:
+            logger.error(f"Error guardando manifiesto: {e}")
+    
+    @staticmethod
+    def _archivo_en_disco(ruta_archivo: str) -> str:
+        # Los artefactos dentro del libro único se registran como "libro#hoja"
+        return ruta_archivo.split('#', 1)[0]
+    
+    def vigente(self, clave: str, hash_contenido: str) -> Optional[Dict]:
+        """Retorna la entrada si el hash coincide y todos sus archivos existen"""
+        entrada = self.entradas.get(clave)
+        if not entrada or entrada.get('hash') != hash_contenido:
+            return None
+        if not all(os.path.exists(self._archivo_en_disco(a)) for a in entrada.get('artefactos', [])):
+            return None
+        return entrada.get('resultado') or entrada
+    
+    def registrar(self, clave: str, hash_contenido: str, artefactos: List[str],
+                  resultado: Optional[Dict] = None):
+        """Registra los artefactos de una clave y elimina los que dejó de producir"""
+        anteriores = set(self.entradas.get(clave, {}).get('artefactos', []))
+        self._eliminar(anteriores - set(artefactos))
+        self.entradas[clave] = {'hash': hash_contenido, 'artefactos': list(artefactos)}
+        if resultado:
+            self.entradas[clave]['resultado'] = {
+                k: resultado[k] for k in ('ruta_id', 'excel', 'mapa', 'telegram', 'artefactos', 'error')
+            }
+    
+    def podar(self, claves_vigentes: set):
+        """Elimina artefactos de rutas que ya no existen y archivos huérfanos"""
+        for clave in list(self.entradas):
+            if clave != '__plan__' and clave not in claves_vigentes:
+                self._eliminar(self.entradas.pop(clave).get('artefactos', []))
+        
+        # Archivos Ruta_* que ningún registro reconoce (corridas previas al manifiesto)
+        conocidos = {os.path.normpath(a) for e in self.entradas.values() for a in e.get('artefactos', [])}
+        for carpeta in self.CARPETAS_ARTEFACTOS:
+            if not os.path.exists(carpeta):
+                continue
+            for archivo in os.listdir(carpeta):
+                ruta_archivo = os.path.normpath(os.path.join(carpeta, archivo))
+                if archivo.startswith('Ruta_') and ruta_archivo not in conocidos:
+                    self._eliminar([ruta_archivo])
+    
+    def hash_plan(self, hashes_rutas, opciones: Dict) -> str:
+        contenido = json.dumps([sorted(hashes_rutas), opciones], sort_keys=True)
+        return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+    
+    def _eliminar(self, archivos):
+        for archivo in archivos:
+            archivo = self._archivo_en_disco(archivo)
+            try:
+                if os.path.exists(archivo):
+                    os.unlink(archivo)
+                    logger.info(f"Artefacto obsoleto eliminado: {archivo}")
+            except OSError as e:
+                logger.error(f"Error eliminando {archivo}: {e}")
+
+class PuntosControl:
+    """Checkpoints por etapa del pipeline para reanudar corridas interrumpidas
+    
+    Cada etapa se guarda en un pickle junto con la firma de sus entradas; solo
+    se reutiliza si la firma coincide. La etapa de rutas además guarda cada
+    ruta optimizada por separado para retomar desde la última completada.
+    """
+    
+    def __init__(self, carpeta: str):
+        self.carpeta = carpeta
+        self.carpeta_rutas = os.path.join(carpeta, 'rutas')
+        self.estado_file = os.path.join(carpeta, 'estado.json')
+        self.estado = self._cargar_estado()
+    
+    def _cargar_estado(self) -> Dict:
+        if os.path.exists(self.estado_file):
+            try:
+                with open(self.estado_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError):
+                logger.warning(f"Estado de checkpoints corrupto, se ignora: {self.estado_file}")
+        return {'etapas': {}}
+    
+    def _guardar_estado(self):
+        temporal = f"{self.estado_file}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(self.estado, f, ensure_ascii=False, indent=2)
+        os.replace(temporal, self.estado_file)
+    
+    @staticmethod
+    def _escribir_pickle(archivo: str, datos: Any):
+        temporal = f"{archivo}.tmp"
+        with open(temporal, 'wb') as f:
+            pickle.dump(datos, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporal, archivo)
+    
+    @staticmethod
+    def _leer_pickle(archivo: str) -> Any:
+        try:
+            with open(archivo, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Checkpoint ilegible, se descarta: {archivo} ({e})")
+            return None
+    
+    def guardar(self, etapa: str, datos: Any, firma: str):
+        """Guarda el resultado completo de una etapa"""
+        os.makedirs(self.carpeta, exist_ok=True)
+        self._escribir_pickle(os.path.join(self.carpeta, f"{etapa}.pkl"), datos)
+        self.estado['etapas'][etapa] = {'firma': firma, 'fecha': datetime.now().isoformat()}
+        self._guardar_estado()
+        logger.info(f"Checkpoint guardado: {etapa}")
+    
+    def cargar(self, etapa: str, firma: str) -> Optional[Any]:
+        """Resultado de una etapa si se completó con las mismas entradas"""
+        info = self.estado['etapas'].get(etapa)
+        archivo = os.path.join(self.carpeta, f"{etapa}.pkl")
+        if not info or info.get('firma') != firma or not os.path.exists(archivo):
+            return None
+        return self._leer_pickle(archivo)
+    
+    def guardar_ruta(self, ruta: 'Ruta', firma: str):
+        """Checkpoint de una ruta ya optimizada (etapa de rutas en curso)"""
+        os.makedirs(self.carpeta_rutas, exist_ok=True)
+        self._escribir_pickle(os.path.join(self.carpeta_rutas, f"{ruta.id:05d}.pkl"), (firma, ruta))
+    
+    def rutas_parciales(self, firma: str) -> Dict[int, 'Ruta']:
+        """Rutas completadas en una corrida interrumpida con las mismas entradas"""
+        parciales = {}
+        if not os.path.exists(self.carpeta_rutas):
+            return parciales
+        for archivo in sorted(os.listdir(self.carpeta_rutas)):
+            if not archivo.endswith('.pkl'):
+                continue
+            datos = self._leer_pickle(os.path.join(self.carpeta_rutas, archivo))
+            if datos and datos[0] == firma:
+                parciales[datos[1].id] = datos[1]
+        return parciales
+    
+    def limpiar_rutas_parciales(self):
+        shutil.rmtree(self.carpeta_rutas, ignore_errors=True)
+    
+    def limpiar(self):
+        shutil.rmtree(self.carpeta, ignore_errors=True)
+        self.estado = {'etapas': {}}
+    
+    @staticmethod
+    def firma(*partes) -> str:
+        contenido = json.dumps(partes, sort_keys=True, default=str)
+        return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def firma_archivo(archivo: str) -> str:
+        h = hashlib.sha256()
+        with open(archivo, 'rb') as f:
+            for bloque in iter(lambda: f.read(1 << 20), b''):
+                h.update(bloque)
+        return h.hexdigest()
+    
+    @staticmethod
+    def firma_dataframe(df: pd.DataFrame) -> str:
+        h = hashlib.sha256(json.dumps(list(map(str, df.columns))).encode('utf-8'))
+        h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+        return h.hexdigest()
+
 # =============================================================================
 # MODELOS DE DATOS
 # =============================================================================
@@ -231,7 +474,7 @@ class Geocoder:
     
     def __init__(self, api_key: str):
         self.api_key = api_key
-        self.cache = CacheManager(CONFIG.CACHE_FILE)
+        self.cache = CacheManager(CONFIG.CACHE_FILE, guardar_cada=CONFIG.CACHE_GUARDAR_CADA)
         self.stats = {'exactas': 0, 'aproximadas': 0, 'fallos': 0}
     
     def geocodificar(self, direccion: str, alcaldia: str = "") -> Optional[Tuple[float, float]]:
@@ -242,7 +485,9 @@ class Geocoder:
         key = self.cache.generar_key(f"{direccion}_{alcaldia}")
         cached = self.cache.obtener(key)
         if cached:
+            INSTRUMENTACION.contar('cache_geocode.aciertos')
             return tuple(cached) if cached else None
+        INSTRUMENTACION.contar('cache_geocode.fallos')
         
         # Estrategia 1: Dirección completa
         coords = self._geocode_api(direccion)
@@ -282,12 +527,14 @@ class Geocoder:
                 'region': 'mx'
             }
             
-            response = requests.get(url, params=params, timeout=CONFIG.TIMEOUT_API)
-            data = response.json()
+            with INSTRUMENTACION.llamada('google.geocode'):
+                response = requests.get(url, params=params, timeout=CONFIG.TIMEOUT_API)
+                data = response.json()
+            INSTRUMENTACION.contar(f"google.geocode.status.{data['status']}")
             
             if data['status'] == 'OK' and data['results']:
                 loc = data['results'][0]['geometry']['location']
-                time.sleep(0.1)  # Rate limiting
+                time.sleep(CONFIG.PAUSA_GEOCODE)  # Rate limiting
                 return (loc['lat'], loc['lng'])
             
         except Exception as e:
@@ -536,29 +783,33 @@ class RouteGenerator:
         
         edificios_dict = {}
         
-        for _, fila in self.df.iterrows():
-            persona = self._extraer_persona(fila)
-            
-            if not persona.direccion or persona.direccion in ['', 'nan']:
-                continue
-            
-            # Normalizar dirección para agrupar
-            dir_norm = self.geocoder.normalizar_direccion(persona.direccion)
-            clave = f"{dir_norm}_{persona.alcaldia}"
-            
-            if clave not in edificios_dict:
-                coords = self.geocoder.geocodificar(persona.direccion, persona.alcaldia)
+        try:
+            for _, fila in self.df.iterrows():
+                persona = self._extraer_persona(fila)
                 
-                edificios_dict[clave] = Edificio(
-                    direccion_original=persona.direccion,
-                    direccion_normalizada=dir_norm,
-                    alcaldia=persona.alcaldia,
-                    dependencia_principal=persona.adscripcion,
-                    coordenadas=coords,
-                    personas=[]
-                )
-            
-            edificios_dict[clave].personas.append(persona)
+                if not persona.direccion or persona.direccion in ['', 'nan']:
+                    continue
+                
+                # Normalizar dirección para agrupar
+                dir_norm = self.geocoder.normalizar_direccion(persona.direccion)
+                clave = f"{dir_norm}_{persona.alcaldia}"
+                
+                if clave not in edificios_dict:
+                    coords = self.geocoder.geocodificar(persona.direccion, persona.alcaldia)
+                    
+                    edificios_dict[clave] = Edificio(
+                        direccion_original=persona.direccion,
+                        direccion_normalizada=dir_norm,
+                        alcaldia=persona.alcaldia,
+                        dependencia_principal=persona.adscripcion,
+                        coordenadas=coords,
+                        personas=[]
+                    )
+                
+                edificios_dict[clave].personas.append(persona)
+        finally:
+            # Lo ya geocodificado no se vuelve a pagar aunque la corrida falle
+            self.geocoder.cache.guardar_cache()
         
         # Asignar zonas
         edificios_por_zona = {}
@@ -575,8 +826,15 @@ class RouteGenerator:
         
         return edificios_por_zona
     
-    def crear_rutas(self, edificios_por_zona: Dict[str, List[Edificio]]) -> List[Ruta]:
-        """Crea rutas agrupando edificios"""
+    def crear_rutas(self, edificios_por_zona: Dict[str, List[Edificio]],
+                    completadas: Optional[Dict[int, Ruta]] = None, on_ruta=None) -> List[Ruta]:
+        """Crea rutas agrupando edificios
+        
+        completadas: rutas ya optimizadas de una corrida anterior (por id); se
+        reutilizan si contienen los mismos edificios. on_ruta(ruta) se llama al
+        terminar cada ruta nueva.
+        """
+        completadas = completadas or {}
         todas_rutas = []
         ruta_id = 1
         
@@ -600,6 +858,12 @@ class RouteGenerator:
                 grupo = edificios_ordenados[i:i + CONFIG.MAX_EDIFICIOS_POR_RUTA]
                 
                 if len(grupo) >= 2:  # Mínimo 2 edificios
+                    previa = completadas.get(ruta_id)
+                    if previa and self._mismos_edificios(previa.edificios, grupo):
+                        todas_rutas.append(previa)
+                        ruta_id += 1
+                        continue
+                    
                     ruta = Ruta(
                         id=ruta_id,
                         zona=zona,
@@ -608,8 +872,13 @@ class RouteGenerator:
                     )
                     
                     # Optimizar si hay suficientes coordenadas
+                    completa = True
                     if len([e for e in grupo if e.coordenadas]) >= 2:
-                        self._optimizar_ruta(ruta)
+                        completa = self._optimizar_ruta(ruta)
+                    
+                    # Las rutas cuya optimización falló se reintentan al reanudar
+                    if completa and on_ruta:
+                        on_ruta(ruta)
                     
                     todas_rutas.append(ruta)
                     ruta_id += 1
@@ -617,13 +886,18 @@ class RouteGenerator:
         logger.info(f"Rutas creadas: {len(todas_rutas)}")
         return todas_rutas
     
-    def _optimizar_ruta(self, ruta: Ruta):
-        """Optimiza el orden de visita usando Google Directions API"""
+    @staticmethod
+    def _mismos_edificios(a: List[Edificio], b: List[Edificio]) -> bool:
+        clave = lambda e: (e.direccion_normalizada, e.alcaldia, e.total_personas)
+        return sorted(map(clave, a)) == sorted(map(clave, b))
+    
+    def _optimizar_ruta(self, ruta: Ruta) -> bool:
+        """Optimiza el orden de visita usando Google Directions API; True si se optimizó"""
         try:
             edificios_con_coords = [e for e in ruta.edificios if e.coordenadas]
             
             if len(edificios_con_coords) < 2:
-                return
+                return True
             
             waypoints = "|".join(f"{lat},{lng}" for lat, lng in 
                                 [e.coordenadas for e in edificios_con_coords])
@@ -638,8 +912,10 @@ class RouteGenerator:
                 'units': 'metric'
             }
             
-            response = requests.get(url, params=params, timeout=CONFIG.TIMEOUT_API)
-            data = response.json()
+            with INSTRUMENTACION.llamada('google.directions'):
+                response = requests.get(url, params=params, timeout=CONFIG.TIMEOUT_API)
+                data = response.json()
+            INSTRUMENTACION.contar(f"google.directions.status.{data['status']}")
             
             if data['status'] == 'OK' and data['routes']:
                 route = data['routes'][0]
@@ -656,9 +932,14 @@ class RouteGenerator:
                 ruta.distancia_km = sum(leg['distance']['value'] for leg in route['legs']) / 1000
                 ruta.tiempo_min = sum(leg['duration']['value'] for leg in route['legs']) / 60
                 ruta.polyline = route['overview_polyline']['points']
+                return True
+            
+            logger.warning(f"Directions sin resultado para ruta {ruta.id}: {data.get('status')}")
                 
         except Exception as e:
             logger.error(f"Error optimizando ruta {ruta.id}: {e}")
+        
+        return False
     
     def _calcular_distancia(self, coord1: Tuple[float, float], coord2: Tuple[float, float]) -> float:
         """Fórmula de Haversine para distancia en km"""
@@ -689,6 +970,15 @@ class FileGenerator:
     
     def generar_excel(self, ruta: Ruta) -> str:
         """Genera archivo Excel para la ruta"""
+        df = pd.DataFrame(self._filas_excel(ruta))
+        filename = f"rutas_excel/Ruta_{ruta.id}_{ruta.zona}.xlsx"
+        df.to_excel(filename, index=False)
+        logger.info(f"Excel generado: {filename}")
+        
+        return filename
+    
+    def _filas_excel(self, ruta: Ruta) -> List[Dict]:
+        """Filas del Excel de una ruta (una por persona)"""
         excel_data = []
         
         for orden_edificio, edificio in enumerate(ruta.edificios, 1):
@@ -716,15 +1006,51 @@ class FileGenerator:
                     'Zona': ruta.zona
                 })
         
-        df = pd.DataFrame(excel_data)
-        filename = f"rutas_excel/Ruta_{ruta.id}_{ruta.zona}.xlsx"
-        df.to_excel(filename, index=False)
-        logger.info(f"Excel generado: {filename}")
+        return excel_data
+    
+    @staticmethod
+    def nombre_hoja(ruta: Ruta) -> str:
+        """Nombre de la hoja de la ruta dentro del libro único (máx. 31 caracteres)"""
+        return f"Ruta_{ruta.id}_{ruta.zona}"[:31]
+    
+    def generar_libro_unico(self, rutas: List[Ruta], archivo: str = None) -> str:
+        """Escribe todas las rutas en un solo libro: hoja RESUMEN + una hoja por ruta
         
-        return filename
+        Usa el modo constant_memory de xlsxwriter: cada fila se escribe a disco
+        en cuanto se completa, sin construir DataFrames.
+        """
+        import xlsxwriter
+        
+        archivo = archivo or CONFIG.LIBRO_RUTAS
+        libro = xlsxwriter.Workbook(archivo, {'constant_memory': True})
+        negrita = libro.add_format({'bold': True})
+        
+        try:
+            self._escribir_hoja(libro.add_worksheet("RESUMEN"), self._filas_resumen(rutas), negrita)
+            for ruta in rutas:
+                self._escribir_hoja(libro.add_worksheet(self.nombre_hoja(ruta)),
+                                    self._filas_excel(ruta), negrita)
+        finally:
+            libro.close()
+        
+        logger.info(f"Libro único generado: {archivo} ({len(rutas)} rutas)")
+        return archivo
+    
+    def _escribir_hoja(self, hoja, filas: List[Dict], formato_encabezado):
+        """Escribe encabezado y filas en orden (requisito de constant_memory)"""
+        if not filas:
+            return
+        columnas = list(filas[0].keys())
+        hoja.write_row(0, 0, columnas, formato_encabezado)
+        for idx, fila in enumerate(filas, 1):
+            # Las cadenas que inician con "=" (Foto_Acuse) se escriben como fórmula
+            hoja.write_row(idx, 0, [fila[c] for c in columnas])
     
-    def generar_mapa(self, ruta: Ruta) -> str:
+    def generar_mapa(self, ruta: Ruta, tolerancia_m: float = None) -> str:
         """Genera mapa interactivo con Folium"""
+        import folium
+        
+        tolerancia_m = CONFIG.TOLERANCIA_POLILINEA_M if tolerancia_m is None else tolerancia_m
         origen = tuple(map(float, CONFIG.ORIGEN_COORDS.split(',')))
         color = RouteGenerator.COLORES_ZONA.get(ruta.zona, 'gray')
         
@@ -740,7 +1066,7 @@ class FileGenerator:
         # Dibujar ruta optimizada
         if ruta.polyline:
             folium.PolyLine(
-                polyline.decode(ruta.polyline),
+                CACHE_POLILINEAS.coordenadas(ruta.id, ruta.polyline, tolerancia_m),
                 color=color,
                 weight=5,
                 opacity=0.7,
@@ -791,8 +1117,10 @@ class FileGenerator:
         popup += "</div>"
         return popup
     
-    def _agregar_panel_info(self, mapa: folium.Map, ruta: Ruta, color: str):
+    def _agregar_panel_info(self, mapa: "folium.Map", ruta: Ruta, color: str):
         """Agrega panel informativo al mapa"""
+        import folium
+        
         color = RouteGenerator.COLORES_ZONA.get(ruta.zona, 'gray')
         
         panel = f"""
@@ -813,10 +1141,110 @@ class FileGenerator:
         """
         mapa.get_root().html.add_child(folium.Element(panel))
     
-    def generar_json_telegram(self, ruta: Ruta, excel_file: str) -> str:
-        """Genera JSON para Telegram/Bot"""
-        google_maps_url = self._generar_url_maps(ruta)
+    def generar_mapa_combinado(self, rutas: List[Ruta], archivo: str = None) -> str:
+        """Genera una sola página con todas las rutas como capas activables
+        
+        Los datos se incrustan una vez (polilíneas codificadas + GeoJSON de
+        edificios) y los popups se arman en el navegador.
+        """
+        archivo = archivo or CONFIG.MAPA_COMBINADO
+        origen = list(map(float, CONFIG.ORIGEN_COORDS.split(',')))
+        
+        datos = {
+            'origen': {'nombre': rutas[0].origen if rutas else CONFIG.ORIGEN_NOMBRE, 'coords': origen},
+            'rutas': [
+                {
+                    'id': r.id,
+                    'zona': r.zona,
+                    'color': RouteGenerator.COLORES_ZONA.get(r.zona, 'gray'),
+                    'edificios': r.total_edificios,
+                    'personas': r.total_personas,
+                    'km': round(r.distancia_km, 1),
+                    'min': round(r.tiempo_min),
+                    'pl': CACHE_POLILINEAS.codificada(r.id, r.polyline, CONFIG.TOLERANCIA_POLILINEA_M)
+                }
+                for r in rutas
+            ],
+            'edificios': {
+                'type': 'FeatureCollection',
+                'features': [
+                    {
+                        'type': 'Feature',
+                        'geometry': {'type': 'Point',
+                                     'coordinates': [round(e.coordenadas[1], 6), round(e.coordenadas[0], 6)]},
+                        'properties': {
+                            'r': r.id,
+                            'i': i,
+                            'd': e.direccion_original[:100],
+                            'n': e.total_personas,
+                            'p': [p.nombre for p in e.personas[:4]]
+                        }
+                    }
+                    for r in rutas
+                    for i, e in enumerate(r.edificios, 1) if e.coordenadas
+                ]
+            }
+        }
         
+        # "</" escapado para que ningún texto cierre el <script>
+        datos_json = json.dumps(datos, ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/')
+        
+        with open(archivo, 'w', encoding='utf-8') as f:
+            f.write(PLANTILLA_MAPA_COMBINADO.replace('__DATOS_RUTAS__', datos_json))
+        
+        logger.info(f"Mapa combinado generado: {archivo} ({len(rutas)} rutas)")
+        return archivo
+    
+    def generar_json_telegram(self, ruta: Ruta, excel_file: str, formato: str = None,
+                              comprimir: bool = None) -> str:
+        """Genera el payload de la ruta para Telegram/Bot (JSON minificado o MessagePack)"""
+        formato = formato or CONFIG.FORMATO_PAYLOAD
+        comprimir = CONFIG.COMPRIMIR_PAYLOAD if comprimir is None else comprimir
+        
+        filename = formato_rutas.escribir_archivo(
+            f"rutas_telegram/Ruta_{ruta.id}_{ruta.zona}",
+            self.datos_telegram(ruta, excel_file), formato, comprimir
+        )
+        
+        logger.info(f"Payload Telegram: {filename}")
+        return filename
+    
+    def generar_plan_telegram(self, rutas: List[Ruta]) -> Tuple[str, List[Dict]]:
+        """Escribe todas las rutas del plan en un solo paquete versionado"""
+        payloads = [self.datos_telegram(r, r.excel_file) for r in rutas]
+        archivo = formato_rutas.escribir_archivo(
+            f"rutas_telegram/{formato_rutas.PREFIJO_PLAN}RUTAS",
+            formato_rutas.empaquetar_plan(payloads),
+            CONFIG.FORMATO_PAYLOAD, CONFIG.COMPRIMIR_PAYLOAD
+        )
+        logger.info(f"Paquete del plan: {archivo} ({len(payloads)} rutas)")
+        return archivo, payloads
+    
+    def datos_telegram(self, ruta: Ruta, excel_file: str) -> Dict:
+        """Payload de la ruta para el bot (esquema formato_rutas.VERSION_ESQUEMA)"""
+        paradas = self._paradas_telegram(ruta)
+        # Se precalcula aquí para que el bot no tenga que generarla al cargar
+        ruta.google_maps_url = url_maps.url_ruta(ruta.origen, paradas) or ""
+        
+        return {
+            'version_esquema': formato_rutas.VERSION_ESQUEMA,
+            'ruta_id': ruta.id,
+            'zona': ruta.zona,
+            'origen': ruta.origen,
+            'google_maps_url': ruta.google_maps_url,
+            'paradas': paradas,
+            'estadisticas': {
+                'total_edificios': ruta.total_edificios,
+                'total_personas': ruta.total_personas,
+                'distancia_km': round(ruta.distancia_km, 1),
+                'tiempo_min': round(ruta.tiempo_min)
+            },
+            'estado': 'pendiente',
+            'timestamp_creacion': datetime.now().isoformat(),
+            'excel_original': excel_file
+        }
+    
+    def _paradas_telegram(self, ruta: Ruta) -> List[Dict]:
         paradas = []
         for i, edificio in enumerate(ruta.edificios, 1):
             parada = {
@@ -842,57 +1270,116 @@ class FileGenerator:
                 ]
             }
             paradas.append(parada)
-        
-        data = {
-            'ruta_id': ruta.id,
-            'zona': ruta.zona,
-            'origen': ruta.origen,
-            'google_maps_url': google_maps_url,
-            'paradas': paradas,
-            'estadisticas': {
-                'total_edificios': ruta.total_edificios,
-                'total_personas': ruta.total_personas,
-                'distancia_km': round(ruta.distancia_km, 1),
-                'tiempo_min': round(ruta.tiempo_min)
-            },
-            'estado': 'pendiente',
-            'timestamp_creacion': datetime.now().isoformat(),
-            'excel_original': excel_file
+        return paradas
+    
+    def _generar_url_maps(self, ruta: Ruta) -> str:
+        """URL de Google Maps de la ruta; la misma que lleva su payload"""
+        if ruta.google_maps_url:
+            return ruta.google_maps_url
+        return url_maps.url_ruta(ruta.origen, self._paradas_telegram(ruta)) or ""
+    
+    def exportar_rutas(self, rutas: List[Ruta], procesos: Optional[int] = None,
+                       progreso=None, modo_excel: Optional[str] = None,
+                       forzar: bool = False) -> List[Dict]:
+        """Genera Excel, mapa y JSON de cada ruta en un pool de procesos
+        
+        Retorna un resultado por ruta (en el orden de entrada) con las rutas de
+        archivo generadas o el error. progreso(completadas, total, resultado)
+        se llama cada vez que termina una ruta. Con modo_excel="libro_unico"
+        las rutas y el resumen se escriben en CONFIG.LIBRO_RUTAS en lugar de
+        un archivo por ruta.
+        
+        Las rutas cuyo hash coincide con el manifiesto y cuyos archivos siguen
+        en disco se omiten (salvo forzar=True); los artefactos de rutas que
+        ya no existen se eliminan.
+        """
+        modo_excel = modo_excel or CONFIG.EXCEL_MODO
+        opciones = {
+            'excel_por_ruta': modo_excel != "libro_unico",
+            'mapa_por_ruta': CONFIG.MAPA_MODO == "por_ruta",
+            'formato_payload': CONFIG.FORMATO_PAYLOAD,
+            'comprimir_payload': CONFIG.COMPRIMIR_PAYLOAD,
+            'tolerancia_polilinea': CONFIG.TOLERANCIA_POLILINEA_M
         }
+        total = len(rutas)
+        resultados: Dict[int, Dict] = {}
         
-        filename = f"rutas_telegram/Ruta_{ruta.id}_{ruta.zona}.json"
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        manifiesto = ManifiestoArtefactos(CONFIG.MANIFIESTO_FILE)
+        hashes = {r.id: hash_ruta(r, opciones) for r in rutas}
+        manifiesto.podar({str(r.id) for r in rutas})
         
-        logger.info(f"JSON Telegram: {filename}")
-        return filename
-    
-    def _generar_url_maps(self, ruta: Ruta) -> str:
-        """Genera URL de Google Maps para la ruta"""
-        try:
-            direcciones = [e.direccion_original for e in ruta.edificios if e.direccion_original]
-            if len(direcciones) < 2:
-                return ""
-            
-            base = "https://www.google.com/maps/dir/?api=1"
-            origen = urllib.parse.quote(f"{ruta.origen}, Ciudad de México")
-            destino = urllib.parse.quote(direcciones[-1])
-            
-            if len(direcciones) > 2:
-                waypoints = "|".join(urllib.parse.quote(d) for d in direcciones[1:-1])
-                return f"{base}&origin={origen}&destination={destino}&waypoints={waypoints}&travelmode=driving"
+        pendientes = []
+        for ruta in rutas:
+            previo = None if forzar else manifiesto.vigente(str(ruta.id), hashes[ruta.id])
+            if previo:
+                resultados[ruta.id] = dict(previo, omitida=True)
+                if progreso:
+                    progreso(len(resultados), total, resultados[ruta.id])
             else:
-                return f"{base}&origin={origen}&destination={destino}&travelmode=driving"
-                
-        except Exception as e:
-            logger.error(f"Error generando URL Maps: {e}")
-            return ""
+                pendientes.append(ruta)
+        
+        # Artefactos compartidos: se regeneran solo si cambió alguna ruta
+        hash_plan = manifiesto.hash_plan(hashes.values(), opciones)
+        if forzar or not manifiesto.vigente('__plan__', hash_plan):
+            compartidos = []
+            if not opciones['excel_por_ruta']:
+                compartidos.append(self.generar_libro_unico(rutas))
+            if not opciones['mapa_por_ruta']:
+                compartidos.append(self.generar_mapa_combinado(rutas))
+            manifiesto.registrar('__plan__', hash_plan, compartidos)
+        if not opciones['excel_por_ruta']:
+            opciones['excel_libro'] = {r.id: f"{CONFIG.LIBRO_RUTAS}#{self.nombre_hoja(r)}" for r in rutas}
+        if not opciones['mapa_por_ruta']:
+            opciones['mapa_combinado'] = CONFIG.MAPA_COMBINADO
+        
+        procesos = procesos or CONFIG.PROCESOS_EXPORTACION or os.cpu_count() or 1
+        procesos = min(procesos, len(pendientes)) or 1
+        
+        def _registrar(ruta: Ruta, resultado: Dict):
+            resultados[ruta.id] = resultado
+            if not resultado['error']:
+                manifiesto.registrar(str(ruta.id), hashes[ruta.id], resultado['artefactos'], resultado)
+            if progreso:
+                progreso(len(resultados), total, resultado)
+        
+        if procesos == 1:
+            for ruta in pendientes:
+                _registrar(ruta, _exportar_ruta(ruta, opciones))
+        else:
+            contexto = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=procesos, mp_context=contexto) as pool:
+                futuros = {pool.submit(_exportar_ruta, _payload_exportacion(r), opciones): r
+                           for r in pendientes}
+                for futuro in as_completed(futuros):
+                    ruta = futuros[futuro]
+                    try:
+                        resultado = futuro.result()
+                    except Exception as e:
+                        resultado = {'ruta_id': ruta.id, 'excel': '', 'mapa': '', 'telegram': '',
+                                     'artefactos': [], 'error': f"{type(e).__name__}: {e}"}
+                    _registrar(ruta, resultado)
+        
+        manifiesto.guardar()
+        
+        for ruta in rutas:
+            r = resultados[ruta.id]
+            ruta.excel_file, ruta.mapa_file, ruta.telegram_file = r['excel'], r['mapa'], r['telegram']
+        
+        logger.info(f"Exportación: {len(pendientes)} de {total} rutas regeneradas "
+                    f"con {procesos} proceso(s)")
+        return [resultados[r.id] for r in rutas]
     
     def generar_resumen(self, rutas: List[Ruta]) -> str:
         """Genera archivo resumen de todas las rutas"""
-        resumen = []
-        for r in rutas:
-            resumen.append({
+        df = pd.DataFrame(self._filas_resumen(rutas))
+        df.to_excel("RESUMEN_RUTAS.xlsx", index=False)
+        logger.info("Resumen generado: RESUMEN_RUTAS.xlsx")
+        
+        return "RESUMEN_RUTAS.xlsx"
+    
+    def _filas_resumen(self, rutas: List[Ruta]) -> List[Dict]:
+        return [
+            {
                 'Ruta_ID': r.id,
                 'Zona': r.zona,
                 'Edificios': r.total_edificios,
@@ -900,13 +1387,439 @@ class FileGenerator:
                 'Distancia_km': round(r.distancia_km, 1),
                 'Tiempo_min': round(r.tiempo_min),
                 'Google_Maps_URL': self._generar_url_maps(r)
-            })
+            }
+            for r in rutas
+        ]
+
+PLANTILLA_MAPA_COMBINADO = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>Rutas PJCDMX</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>
+  html, body, #mapa { height: 100%; margin: 0; }
+  #panel { position: fixed; top: 10px; left: 50px; z-index: 1000; background: white; padding: 15px;
+           border-radius: 10px; box-shadow: 0 0 15px rgba(0,0,0,0.2); font-family: Arial; max-width: 400px; }
+  #panel h4 { margin: 0 0 10px; color: #2c3e50; }
+  .popup { font-family: Arial; width: 350px; }
+</style>
+</head>
+<body>
+<div id="mapa"></div>
+<div id="panel"><h4>Rutas PJCDMX</h4><small id="info"></small></div>
+<script>
+const DATOS = __DATOS_RUTAS__;
+
+function decodificar(str) {
+  let i = 0, lat = 0, lng = 0, puntos = [];
+  while (i < str.length) {
+    for (const eje of [0, 1]) {
+      let b, shift = 0, res = 0;
+      do { b = str.charCodeAt(i++) - 63; res |= (b & 0x1f) << shift; shift += 5; } while (b >= 0x20);
+      const delta = (res & 1) ? ~(res >> 1) : (res >> 1);
+      if (eje === 0) lat += delta; else lng += delta;
+    }
+    puntos.push([lat / 1e5, lng / 1e5]);
+  }
+  return puntos;
+}
+
+function esc(t) {
+  return String(t).replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c]));
+}
+
+function infoRuta(r) {
+  return `<b>Ruta ${r.id} - ${esc(r.zona)}</b><br>🏢 Edificios: ${r.edificios}<br>👥 Personas: ${r.personas}<br>` +
+         `📏 Distancia: ${r.km} km<br>⏱️ Tiempo: ${r.min} min<br>📍 Origen: ${esc(DATOS.origen.nombre)}`;
+}
+
+const mapa = L.map('mapa').setView(DATOS.origen.coords, 12);
+L.tileLayer('https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}{r}.png', {
+  attribution: '&copy; OpenStreetMap &copy; CARTO', maxZoom: 19
+}).addTo(mapa);
+L.marker(DATOS.origen.coords).bindPopup(`<b>🏛️ ${esc(DATOS.origen.nombre)}</b>`).addTo(mapa);
+
+const rutas = {}, capas = {};
+for (const r of DATOS.rutas) {
+  rutas[r.id] = r;
+  const capa = L.layerGroup();
+  if (r.pl) {
+    L.polyline(decodificar(r.pl), {color: r.color, weight: 5, opacity: 0.7})
+      .on('click', () => { document.getElementById('info').innerHTML = infoRuta(r); })
+      .addTo(capa);
+  }
+  capas[r.id] = capa;
+  capa.addTo(mapa);
+}
+
+L.geoJSON(DATOS.edificios, {
+  pointToLayer: (f, latlng) => {
+    const r = rutas[f.properties.r];
+    return L.circleMarker(latlng, {radius: 7, color: r.color, fillColor: r.color, fillOpacity: 0.9, weight: 2});
+  },
+  onEachFeature: (f, capa) => {
+    const p = f.properties, r = rutas[p.r];
+    capa.bindTooltip(`Edificio #${p.i}: ${p.n} personas`);
+    capa.bindPopup(() => {
+      let html = `<div class="popup"><h4 style="color:${r.color};margin:0 0 10px;">🏢 Edificio #${p.i} - ${esc(r.zona)}</h4>` +
+                 `<b>📍 ${esc(p.d)}</b><br><small>👥 ${p.n} personas</small><hr style="margin:8px 0;">` +
+                 `<small><b>Personas en este edificio:</b></small><br>`;
+      for (const nombre of p.p) html += `<small>• ${esc(nombre)}</small><br>`;
+      if (p.n > p.p.length) html += `<small>• ... y ${p.n - p.p.length} más</small>`;
+      return html + '</div>';
+    });
+    capa.on('click', () => { document.getElementById('info').innerHTML = infoRuta(r); });
+    capa.addTo(capas[p.r]);
+  }
+});
+
+const overlays = {};
+for (const r of DATOS.rutas) {
+  overlays[`<span style="color:${r.color}">■</span> Ruta ${r.id} - ${esc(r.zona)}`] = capas[r.id];
+}
+L.control.layers(null, overlays, {collapsed: DATOS.rutas.length > 12}).addTo(mapa);
+
+const totales = DATOS.rutas.reduce((t, r) => ({e: t.e + r.edificios, p: t.p + r.personas, km: t.km + r.km}),
+                                   {e: 0, p: 0, km: 0});
+document.getElementById('info').innerHTML =
+  `<b>🗺️ Rutas:</b> ${DATOS.rutas.length}<br><b>🏢 Edificios:</b> ${totales.e}<br>` +
+  `<b>👥 Personas:</b> ${totales.p}<br><b>📏 Distancia:</b> ${totales.km.toFixed(1)} km`;
+</script>
+</body>
+</html>
+"""
+
+def hash_ruta(ruta: Ruta, opciones: Dict) -> str:
+    """Hash del contenido que determina los artefactos de una ruta"""
+    contenido = {
+        'id': ruta.id,
+        'zona': ruta.zona,
+        'origen': ruta.origen,
+        'distancia_km': round(ruta.distancia_km, 3),
+        'tiempo_min': round(ruta.tiempo_min, 1),
+        'polyline': ruta.polyline,
+        'paradas': [
+            {
+                'direccion': e.direccion_original,
+                'dependencia': e.dependencia_principal,
+                'coords': e.coordenadas,
+                'personas': [
+                    [p.nombre_completo, p.nombre, p.adscripcion, p.direccion, p.alcaldia, p.notas]
+                    for p in e.personas
+                ]
+            }
+            for e in ruta.edificios
+        ],
+        'opciones': {k: opciones[k] for k in ('excel_por_ruta', 'mapa_por_ruta', 'formato_payload',
+                                              'comprimir_payload', 'tolerancia_polilinea')}
+    }
+    return hashlib.sha256(json.dumps(contenido, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def _payload_exportacion(ruta: Ruta) -> Ruta:
+    """Copia ligera y serializable de la ruta para enviarla a otro proceso"""
+    return replace(ruta, edificios=[
+        replace(e, personas=[replace(p, fila_original=None) for p in e.personas])
+        for e in ruta.edificios
+    ])
+
+def _exportar_ruta(ruta: Ruta, opciones: Dict) -> Dict:
+    """Genera los artefactos de una ruta (se ejecuta dentro del pool de procesos)
+    
+    Las opciones viajan con la ruta porque los procesos hijos no ven los
+    cambios hechos a CONFIG en el proceso principal.
+    """
+    inicio = time.perf_counter()
+    resultado = {'ruta_id': ruta.id, 'excel': '', 'mapa': '', 'telegram': '',
+                 'artefactos': [], 'error': ''}
+    etapa = 'excel'
+    
+    try:
+        file_gen = FileGenerator()
+        if opciones.get('excel_por_ruta', True):
+            resultado['excel'] = file_gen.generar_excel(ruta)
+            resultado['artefactos'].append(resultado['excel'])
+        else:
+            resultado['excel'] = opciones['excel_libro'][ruta.id]
+        etapa = 'mapa'
+        if opciones.get('mapa_por_ruta', True):
+            resultado['mapa'] = file_gen.generar_mapa(ruta, opciones['tolerancia_polilinea'])
+            resultado['artefactos'].append(resultado['mapa'])
+        else:
+            resultado['mapa'] = opciones['mapa_combinado']
+        etapa = 'telegram'
+        resultado['telegram'] = file_gen.generar_json_telegram(
+            ruta, resultado['excel'], opciones['formato_payload'], opciones['comprimir_payload']
+        )
+        resultado['artefactos'].append(resultado['telegram'])
+    except Exception as e:
+        resultado['error'] = f"{etapa}: {type(e).__name__}: {e}"
+        logger.error(f"Error exportando ruta {ruta.id} ({etapa}): {e}")
+    
+    resultado['segundos'] = round(time.perf_counter() - inicio, 3)
+    return resultado
+
+# =============================================================================
+# CONCILIACIÓN DE AVANCES
+# =============================================================================
+
+@dataclass
+class ResultadoConciliacion:
+    """Resultado de aplicar un avance de entrega al Excel de su ruta"""
+    avance_id: Any
+    ruta_id: Any
+    persona: str
+    estado: str  # actualizado | sin_coincidencia | ambiguo | sin_libro | invalido | error
+    archivo: str = ""
+    hoja: str = ""
+    fila: Optional[int] = None
+    detalle: str = ""
+    
+    @property
+    def actualizado(self) -> bool:
+        return self.estado == 'actualizado'
+
+class ConciliadorExcel:
+    """Aplica avances de entrega por lotes a los Excel de ruta
+    
+    Agrupa los avances por ruta_id y por libro, abre cada libro una sola
+    vez con openpyxl y guarda una sola vez. Soporta un archivo por ruta
+    (rutas_excel/) y el libro único, donde cada ruta es una hoja.
+    
+    La persona se busca en el índice de destinatarios generado junto con las
+    rutas (sin acentos ni títulos; exacto → prefijo → difuso) y se ubica la
+    fila por Orden_Edificio/Orden_Persona. Sin índice, o si la ruta no está
+    en él, se recorre la hoja por nombre como antes.
+    """
+    
+    COLUMNAS_NOMBRE = ('Nombre', 'Nombre_Completo')
+    
+    def __init__(self, carpeta: str = "rutas_excel", libro_unico: str = None,
+                 indice_file: str = None):
+        self.carpeta = carpeta
+        self.libro_unico = libro_unico or CONFIG.LIBRO_RUTAS
+        self.indice_file = indice_file or CONFIG.INDICE_DESTINATARIOS
+        self._indice: Optional[IndiceDestinatarios] = None
+        self._indice_mtime: Optional[float] = None
+    
+    @staticmethod
+    def _normalizar(texto: Any) -> str:
+        return clave(texto)
+    
+    def _indice_actual(self) -> Optional[IndiceDestinatarios]:
+        """Índice de destinatarios; se recarga si se regeneraron las rutas"""
+        try:
+            mtime = os.path.getmtime(self.indice_file)
+        except OSError:
+            self._indice = self._indice_mtime = None
+            return None
+        if mtime != self._indice_mtime:
+            try:
+                self._indice = IndiceDestinatarios.cargar(self.indice_file)
+            except Exception as e:
+                logger.warning(f"Índice de destinatarios ilegible, se busca por hoja: {e}")
+                self._indice = None
+            self._indice_mtime = mtime
+        return self._indice
+    
+    def _ubicaciones(self) -> Dict[int, Tuple[str, Optional[str]]]:
+        """ruta_id → (libro, hoja); hoja None = primera hoja de un archivo por ruta"""
+        ubicaciones = {}
+        if os.path.exists(self.libro_unico):
+            import openpyxl
+            libro = openpyxl.load_workbook(self.libro_unico, read_only=True)
+            try:
+                for hoja in libro.sheetnames:
+                    partes = hoja.split('_')
+                    if len(partes) >= 2 and partes[0] == 'Ruta' and partes[1].isdigit():
+                        ubicaciones[int(partes[1])] = (self.libro_unico, hoja)
+            finally:
+                libro.close()
+        
+        # Los archivos por ruta tienen prioridad sobre el libro único
+        if os.path.exists(self.carpeta):
+            for archivo in sorted(os.listdir(self.carpeta)):
+                partes = archivo.split('_')
+                if '.tmp' in archivo:  # Temporal de un guardado interrumpido
+                    continue
+                if archivo.endswith('.xlsx') and len(partes) >= 2 and partes[0] == 'Ruta' and partes[1].isdigit():
+                    ubicaciones[int(partes[1])] = (os.path.join(self.carpeta, archivo), None)
+        return ubicaciones
+    
+    def conciliar(self, avances: List[Dict]) -> List[ResultadoConciliacion]:
+        """Aplica todos los avances; un resultado por avance, en el mismo orden"""
+        resultados: List[Optional[ResultadoConciliacion]] = [None] * len(avances)
+        por_libro: Dict[str, Dict[Optional[str], List[int]]] = {}
+        ubicaciones = self._ubicaciones()
+        
+        for i, avance in enumerate(avances):
+            ruta_id = avance.get('ruta_id')
+            persona = str(avance.get('persona_entregada') or '').strip()
+            base = dict(avance_id=avance.get('seq', avance.get('id')), ruta_id=ruta_id, persona=persona)
+            try:
+                ruta_id = int(ruta_id)
+            except (TypeError, ValueError):
+                ruta_id = None
+            if not persona or ruta_id is None:
+                resultados[i] = ResultadoConciliacion(**base, estado='invalido', detalle="Sin persona o ruta")
+                continue
+            if ruta_id not in ubicaciones:
+                resultados[i] = ResultadoConciliacion(**base, estado='sin_libro')
+                continue
+            libro, hoja = ubicaciones[ruta_id]
+            por_libro.setdefault(libro, {}).setdefault(hoja, []).append(i)
         
-        df = pd.DataFrame(resumen)
-        df.to_excel("RESUMEN_RUTAS.xlsx", index=False)
-        logger.info("Resumen generado: RESUMEN_RUTAS.xlsx")
+        indice = self._indice_actual()
+        for libro, hojas in por_libro.items():
+            try:
+                self._conciliar_libro(libro, hojas, avances, resultados, indice)
+            except Exception as e:
+                logger.error(f"Error conciliando {libro}: {e}")
+                for indices in hojas.values():
+                    for i in indices:
+                        if resultados[i] is None:
+                            avance = avances[i]
+                            resultados[i] = ResultadoConciliacion(
+                                avance.get('seq', avance.get('id')), avance.get('ruta_id'),
+                                str(avance.get('persona_entregada') or '').strip(),
+                                estado='error', archivo=libro, detalle=str(e)
+                            )
+        
+        return resultados
+    
+    def _conciliar_libro(self, archivo: str, hojas: Dict[Optional[str], List[int]],
+                         avances: List[Dict], resultados: List,
+                         destinatarios: Optional[IndiceDestinatarios] = None):
+        import openpyxl
+        
+        libro = openpyxl.load_workbook(archivo)
+        cambios = 0
+        
+        for nombre_hoja, indices in hojas.items():
+            hoja = libro[nombre_hoja] if nombre_hoja else libro.worksheets[0]
+            columnas = {celda.value: celda.column for celda in hoja[1] if celda.value}
+            filas_orden = self._filas_por_orden(hoja, columnas) if destinatarios else {}
+            indice = None  # Índice por nombre de la hoja, solo si hace falta
+            
+            for i in indices:
+                avance = avances[i]
+                persona = str(avance.get('persona_entregada') or '').strip()
+                resultado = ResultadoConciliacion(
+                    avance.get('seq', avance.get('id')), avance.get('ruta_id'), persona,
+                    estado='sin_coincidencia', archivo=archivo, hoja=hoja.title
+                )
+                ruta_id = int(avance['ruta_id'])
+                if filas_orden and ruta_id in destinatarios.rutas():
+                    fila = self._buscar_indice(destinatarios, ruta_id, persona, filas_orden,
+                                               hoja, columnas, resultado)
+                else:
+                    if indice is None:
+                        indice = self._indexar(hoja, columnas)
+                    fila = self._buscar(indice, persona, hoja, columnas)
+                if fila:
+                    self._aplicar(hoja, columnas, fila, avance)
+                    resultado.estado, resultado.fila = 'actualizado', fila
+                    cambios += 1
+                resultados[i] = resultado
+        
+        if cambios:
+            temporal = f"{archivo}.tmp"  # Sin terminar en .xlsx: _ubicaciones no lo toma como ruta
+            libro.save(temporal)
+            os.replace(temporal, archivo)
+            logger.info(f"Conciliado {archivo}: {cambios} entregas")
+        libro.close()
+    
+    @staticmethod
+    def _filas_por_orden(hoja, columnas: Dict[str, int]) -> Dict[Tuple[int, int], int]:
+        """(Orden_Edificio, Orden_Persona) → fila"""
+        col_edificio, col_persona = columnas.get('Orden_Edificio'), columnas.get('Orden_Persona')
+        if not col_edificio or not col_persona:
+            return {}
+        filas = {}
+        for fila in range(2, hoja.max_row + 1):
+            try:
+                orden = (int(hoja.cell(row=fila, column=col_edificio).value),
+                         int(hoja.cell(row=fila, column=col_persona).value))
+            except (TypeError, ValueError):
+                continue
+            filas.setdefault(orden, fila)
+        return filas
+    
+    def _buscar_indice(self, destinatarios: IndiceDestinatarios, ruta_id: int, persona: str,
+                       filas_orden: Dict[Tuple[int, int], int], hoja, columnas: Dict[str, int],
+                       resultado: ResultadoConciliacion) -> Optional[int]:
+        """Busca en el índice de destinatarios; marca el resultado si es ambiguo"""
+        coincidencia = destinatarios.buscar(persona, ruta_id)
+        candidatos = [(d, filas_orden[d.orden_edificio, d.orden_persona])
+                      for d in coincidencia.candidatos
+                      if (d.orden_edificio, d.orden_persona) in filas_orden]
+        if not candidatos:
+            return None
+        resultado.detalle = f"Coincidencia {coincidencia.nivel}"
         
-        return "RESUMEN_RUTAS.xlsx"
+        # Varios nombres distintos: no se adivina, se reporta
+        if len({clave(d.nombre) for d, _ in candidatos}) > 1:
+            resultado.estado = 'ambiguo'
+            resultado.detalle = (f"Coincidencia {coincidencia.nivel} con varios destinatarios: "
+                                 + "; ".join(d.nombre for d, _ in candidatos))
+            return None
+        
+        # Mismo nombre repetido (homónimos): preferir filas aún pendientes
+        filas = [fila for _, fila in candidatos]
+        col_estado = columnas.get('Estado')
+        if col_estado:
+            pendientes = [f for f in filas if hoja.cell(row=f, column=col_estado).value != 'ENTREGADO']
+            if pendientes:
+                return pendientes[0]
+        return filas[0]
+    
+    def _indexar(self, hoja, columnas: Dict[str, int]) -> Dict[str, List[int]]:
+        """Nombre normalizado → filas (ambas columnas de nombre)"""
+        indice: Dict[str, List[int]] = {}
+        cols = [columnas[c] for c in self.COLUMNAS_NOMBRE if c in columnas]
+        for fila in range(2, hoja.max_row + 1):
+            for col in cols:
+                nombre = self._normalizar(hoja.cell(row=fila, column=col).value)
+                if nombre:
+                    filas = indice.setdefault(nombre, [])
+                    if fila not in filas:
+                        filas.append(fila)
+        return indice
+    
+    def _buscar(self, indice: Dict[str, List[int]], persona: str, hoja, columnas: Dict[str, int]) -> Optional[int]:
+        """Coincidencia exacta primero; si no, por contención (como el cotejo original)"""
+        buscado = self._normalizar(persona)
+        candidatos = indice.get(buscado)
+        if not candidatos:
+            candidatos = sorted({f for nombre, filas in indice.items()
+                                 if buscado in nombre or nombre in buscado for f in filas})
+        if not candidatos:
+            return None
+        
+        # Preferir filas aún pendientes (dos personas con el mismo nombre)
+        col_estado = columnas.get('Estado')
+        if col_estado:
+            pendientes = [f for f in candidatos if hoja.cell(row=f, column=col_estado).value != 'ENTREGADO']
+            if pendientes:
+                return pendientes[0]
+        return candidatos[0]
+    
+    @staticmethod
+    def _aplicar(hoja, columnas: Dict[str, int], fila: int, avance: Dict):
+        foto = avance.get('foto_local', '')
+        timestamp = avance.get('timestamp', '')
+        valores = {
+            'Acuse': f"✅ ENTREGADO - {timestamp}",
+            'Repartidor': avance.get('repartidor', ''),
+            'Foto_Acuse': f"=HIPERVINCULO(\"{foto}\", \"VER FOTO\")" if foto else "SIN FOTO",
+            'Timestamp_Entrega': timestamp,
+            'Estado': 'ENTREGADO'
+        }
+        for columna, valor in valores.items():
+            if columna in columnas:
+                hoja.cell(row=fila, column=columnas[columna], value=valor)
 
 # =============================================================================
 # CONEXIÓN CON BOT
@@ -922,12 +1835,13 @@ class BotConnector:
     def enviar_ruta(self, ruta_data: Dict) -> bool:
         """Envía ruta al bot"""
         try:
-            response = requests.post(
-                f"{self.url_base}/api/rutas",
-                json=ruta_data,
-                timeout=self.timeout,
-                headers={'Content-Type': 'application/json'}
-            )
+            with INSTRUMENTACION.llamada('bot.rutas'):
+                response = requests.post(
+                    f"{self.url_base}/api/rutas",
+                    json=ruta_data,
+                    timeout=self.timeout,
+                    headers={'Content-Type': 'application/json'}
+                )
             
             if response.status_code == 200:
                 logger.info(f"Ruta {ruta_data['ruta_id']} enviada al bot")
@@ -940,10 +1854,61 @@ class BotConnector:
             logger.error(f"Error enviando ruta: {e}")
             return False
     
+    def enviar_plan(self, rutas_data: List[Dict]) -> Optional[Dict]:
+        """Envía todas las rutas del plan en una sola petición (JSON + gzip)
+        
+        Retorna la respuesta del bot, o None si falló. Si el bot es anterior a
+        /api/rutas/batch, la respuesta trae 'no_soportado' para que el llamador
+        recurra a enviar_ruta.
+        """
+        cuerpo = formato_rutas.codificar(formato_rutas.empaquetar_plan(rutas_data), 'json', comprimir=True)
+        try:
+            with INSTRUMENTACION.llamada('bot.rutas_batch'):
+                response = requests.post(
+                    f"{self.url_base}/api/rutas/batch",
+                    data=cuerpo,
+                    timeout=self.timeout,
+                    headers={'Content-Type': 'application/gzip'}
+                )
+            
+            if response.status_code == 200:
+                resultado = response.json()
+                logger.info(f"Plan enviado al bot: {len(resultado.get('guardadas', []))} rutas "
+                           f"({len(cuerpo) / 1024:.1f} KB)")
+                return resultado
+            if response.status_code in (404, 405):
+                return {'no_soportado': True}
+            logger.error(f"Error {response.status_code}: {response.text}")
+            
+        except Exception as e:
+            logger.error(f"Error enviando plan: {e}")
+        return None
+    
+    def post_idempotente(self, endpoint: str, cuerpo: bytes, content_type: str,
+                         clave: str) -> Tuple[Optional[int], Optional[Dict]]:
+        """POST con Idempotency-Key; retorna (status, json) o (None, None) si no hubo respuesta"""
+        try:
+            with INSTRUMENTACION.llamada(f"bot.{endpoint.strip('/').replace('/', '.')}"):
+                response = requests.post(
+                    f"{self.url_base}{endpoint}",
+                    data=cuerpo,
+                    timeout=self.timeout,
+                    headers={'Content-Type': content_type, 'Idempotency-Key': clave}
+                )
+            try:
+                datos = response.json()
+            except ValueError:
+                datos = None
+            return response.status_code, datos
+        except Exception as e:
+            logger.warning(f"Bot no disponible ({endpoint}): {e}")
+            return None, None
+    
     def verificar_conexion(self) -> bool:
         """Verifica conexión con el bot"""
         try:
-            response = requests.get(f"{self.url_base}/api/health", timeout=10)
+            with INSTRUMENTACION.llamada('bot.health'):
+                response = requests.get(f"{self.url_base}/api/health", timeout=10)
             return response.status_code == 200
         except:
             return False
@@ -959,6 +1924,53 @@ class BotConnector:
             logger.error(f"Error obteniendo avances: {e}")
         return []
     
+    def obtener_avances_desde(self, cursor: int, limite: int = 100) -> Optional[Tuple[List[Dict], int, bool]]:
+        """Página de avances con seq > cursor: (avances, nuevo_cursor, hay_mas); None si falló"""
+        try:
+            with INSTRUMENTACION.llamada('bot.avances'):
+                response = requests.get(f"{self.url_base}/api/avances",
+                                        params={'since': cursor, 'limit': limite},
+                                        timeout=self.timeout)
+            if response.status_code == 200:
+                datos = response.json()
+                return datos.get('avances', []), datos.get('cursor', cursor), datos.get('hay_mas', False)
+            logger.error(f"Error {response.status_code} obteniendo avances")
+        except Exception as e:
+            logger.error(f"Error obteniendo avances: {e}")
+        return None
+    
+    def escuchar_eventos(self, cursor: int, detener: Optional[threading.Event] = None):
+        """Stream SSE de eventos con seq > cursor (/api/eventos/stream)
+        
+        Genera ('evento', dict) por cada evento y ('comentario', texto) por
+        cada lote terminado o latido. Termina cuando el bot cierra la
+        conexión; los errores de red se propagan para que el llamador reconecte.
+        """
+        with INSTRUMENTACION.llamada('bot.stream'):
+            response = requests.get(f"{self.url_base}/api/eventos/stream",
+                                    headers={'Last-Event-ID': str(cursor), 'Accept': 'text/event-stream'},
+                                    stream=True, timeout=(self.timeout, CONFIG.STREAM_TIMEOUT_LECTURA))
+        try:
+            response.raise_for_status()
+            datos: List[str] = []
+            for linea in response.iter_lines(decode_unicode=True):
+                if detener is not None and detener.is_set():
+                    break
+                if linea is None:
+                    continue
+                if not linea:
+                    # Línea en blanco: fin del evento
+                    if datos:
+                        yield 'evento', json.loads("\n".join(datos))
+                    datos = []
+                elif linea.startswith(':'):
+                    yield 'comentario', linea[1:].strip()
+                elif linea.startswith('data:'):
+                    datos.append(linea[5:].lstrip())
+                # id/event/retry: el seq ya viene en los datos del evento
+        finally:
+            response.close()
+    
     def marcar_procesado(self, avance_id: str) -> bool:
         """Marca avance como procesado"""
         try:
@@ -968,14 +1980,676 @@ class BotConnector:
         except:
             return False
 
+class OutboxBot:
+    """Cola persistente (SQLite) de envíos al bot: planes de rutas y acuses
+    
+    Encolar es local e inmediato; un hilo emisor drena la cola en segundo
+    plano con backoff exponencial. Cada envío lleva una clave de idempotencia
+    estable, así un reintento tras un timeout no duplica nada en el bot.
+    """
+    
+    # Los 4xx no se arreglan reintentando (token revocado, ruta borrada,
+    # cuerpo inválido), salvo timeout del servidor y límite de tasa
+    STATUS_REINTENTABLES = (408, 429)
+    
+    def __init__(self, db_path: str = None, conector: Optional[BotConnector] = None):
+        self.conector = conector or BotConnector()
+        self.conn = sqlite3.connect(db_path or CONFIG.OUTBOX_DB, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._hilo: Optional[threading.Thread] = None
+        self._crear_tablas()
+    
+    def _crear_tablas(self):
+        with self._lock:
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                clave TEXT UNIQUE,
+                tipo TEXT,
+                endpoint TEXT,
+                content_type TEXT,
+                cuerpo BLOB,
+                estado TEXT DEFAULT 'pendiente',
+                intentos INTEGER DEFAULT 0,
+                proximo_intento REAL DEFAULT 0,
+                ultimo_error TEXT,
+                creado DATETIME DEFAULT CURRENT_TIMESTAMP,
+                enviado DATETIME
+            )
+            ''')
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_outbox_pendientes ON outbox(estado, proximo_intento)"
+            )
+            # Posición de lectura de feeds del bot (p. ej. avances)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cursores (nombre TEXT PRIMARY KEY, valor INTEGER)"
+            )
+            self.conn.commit()
+    
+    def encolar(self, tipo: str, endpoint: str, cuerpo: bytes, content_type: str,
+                clave: Optional[str] = None) -> str:
+        """Agrega un envío; una clave ya encolada se ignora"""
+        clave = clave or f"{tipo}:{uuid.uuid4().hex}"
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO outbox (clave, tipo, endpoint, content_type, cuerpo) VALUES (?, ?, ?, ?, ?)",
+                (clave, tipo, endpoint, content_type, cuerpo)
+            )
+            self.conn.commit()
+        self._despertar.set()
+        return clave
+    
+    def encolar_plan(self, rutas_data: List[Dict]) -> str:
+        cuerpo = formato_rutas.codificar(formato_rutas.empaquetar_plan(rutas_data), 'json', comprimir=True)
+        return self.encolar('plan', '/api/rutas/batch', cuerpo, 'application/gzip')
+    
+    def encolar_ack(self, avance_id: str) -> str:
+        """Acuse de avance procesado (la clave es el id: encolar dos veces no duplica)"""
+        return self.encolar('ack', f"/api/avances/{avance_id}/procesado", b'', 'application/json',
+                            clave=f"ack:{avance_id}")
+    
+    def encolar_acks(self, seqs: List[int]) -> Optional[str]:
+        """Acuse en lote de avances procesados (/api/avances/ack)"""
+        if not seqs:
+            return None
+        seqs = sorted(set(seqs))
+        cuerpo = json.dumps({'seqs': seqs}).encode('utf-8')
+        clave = f"acks:{hashlib.sha256(cuerpo).hexdigest()[:16]}"
+        return self.encolar('acks', '/api/avances/ack', cuerpo, 'application/json', clave=clave)
+    
+    def leer_cursor(self, nombre: str) -> int:
+        with self._lock:
+            fila = self.conn.execute("SELECT valor FROM cursores WHERE nombre = ?", (nombre,)).fetchone()
+        return fila[0] if fila else 0
+    
+    def guardar_cursor(self, nombre: str, valor: int):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO cursores (nombre, valor) VALUES (?, ?)", (nombre, valor))
+            self.conn.commit()
+    
+    def estado(self, clave: str) -> Optional[str]:
+        with self._lock:
+            fila = self.conn.execute("SELECT estado FROM outbox WHERE clave = ?", (clave,)).fetchone()
+        return fila[0] if fila else None
+    
+    def pendientes(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE estado = 'pendiente'").fetchone()[0]
+    
+    def procesar_pendientes(self, solo_vencidos: bool = True) -> int:
+        """Intenta los envíos pendientes (en orden de llegada); retorna cuántos se completaron"""
+        with self._lock:
+            filas = self.conn.execute(
+                "SELECT id, clave, tipo, endpoint, content_type, cuerpo, intentos FROM outbox "
+                "WHERE estado = 'pendiente' AND proximo_intento <= ? ORDER BY id",
+                (time.time() if solo_vencidos else float('inf'),)
+            ).fetchall()
+        
+        completados = 0
+        for id_, clave, tipo, endpoint, content_type, cuerpo, intentos in filas:
+            if self._detener.is_set():
+                break
+            status, datos = self.conector.post_idempotente(endpoint, cuerpo, content_type, clave)
+            
+            if status is not None and 200 <= status < 300:
+                self._marcar(id_, 'enviado')
+                completados += 1
+                logger.info(f"📤 Envío {tipo} completado ({clave})")
+                if datos and datos.get('rechazadas'):
+                    logger.warning(f"El bot rechazó las rutas {datos['rechazadas']} ({clave})")
+            elif tipo == 'plan' and status in (404, 405):
+                # Bot anterior a /api/rutas/batch: se reencola ruta por ruta
+                self._dividir_plan(id_, clave, cuerpo)
+            elif self._es_definitivo(status):
+                self._marcar(id_, 'fallido', f"HTTP {status}: {datos}")
+                logger.error(f"Envío {tipo} rechazado por el bot ({clave}): HTTP {status}")
+            else:
+                self._reprogramar(id_, intentos + 1, f"HTTP {status}" if status else "sin conexión")
+        
+        return completados
+    
+    @classmethod
+    def _es_definitivo(cls, status: Optional[int]) -> bool:
+        return status is not None and 400 <= status < 500 and status not in cls.STATUS_REINTENTABLES
+    
+    def _marcar(self, id_: int, estado: str, error: str = None):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE outbox SET estado = ?, ultimo_error = ?, "
+                "enviado = CASE WHEN ? = 'enviado' THEN CURRENT_TIMESTAMP END WHERE id = ?",
+                (estado, error, estado, id_)
+            )
+            self.conn.commit()
+    
+    def _reprogramar(self, id_: int, intentos: int, error: str):
+        espera = min(CONFIG.OUTBOX_BACKOFF_BASE * 2 ** (intentos - 1), CONFIG.OUTBOX_BACKOFF_MAX)
+        espera *= random.uniform(0.5, 1.0)
+        with self._lock:
+            self.conn.execute(
+                "UPDATE outbox SET intentos = ?, proximo_intento = ?, ultimo_error = ? WHERE id = ?",
+                (intentos, time.time() + espera, error, id_)
+            )
+            self.conn.commit()
+    
+    def _dividir_plan(self, id_: int, clave: str, cuerpo: bytes):
+        rutas = formato_rutas.extraer_rutas(formato_rutas.decodificar(cuerpo))
+        for ruta in rutas:
+            self.encolar('ruta', '/api/rutas', json.dumps(ruta, ensure_ascii=False).encode('utf-8'),
+                         'application/json', clave=f"{clave}:ruta:{ruta.get('ruta_id')}")
+        self._marcar(id_, 'dividido')
+    
+    def _segundos_para_siguiente(self) -> float:
+        with self._lock:
+            fila = self.conn.execute(
+                "SELECT MIN(proximo_intento) FROM outbox WHERE estado = 'pendiente'"
+            ).fetchone()
+        if not fila or fila[0] is None:
+            return CONFIG.OUTBOX_BACKOFF_MAX
+        return min(max(fila[0] - time.time(), 0.5), CONFIG.OUTBOX_BACKOFF_MAX)
+    
+    def iniciar(self):
+        """Arranca el hilo emisor (idempotente)"""
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="outbox-bot", daemon=True)
+        self._hilo.start()
+    
+    def detener(self):
+        self._detener.set()
+        self._despertar.set()
+    
+    def _bucle(self):
+        while not self._detener.is_set():
+            try:
+                self.procesar_pendientes()
+            except Exception as e:
+                logger.error(f"Error en outbox: {e}")
+            self._despertar.wait(self._segundos_para_siguiente())
+            self._despertar.clear()
+
+class SuscriptorEventos:
+    """Aplica en vivo los eventos del bot (stream SSE) a los Excel de ruta
+    
+    Un hilo mantiene abierta la conexión, reconecta con backoff y reanuda
+    desde el cursor 'avances' guardado en el outbox. Las entregas se concilian
+    por lote (lo que el bot manda antes de cada comentario ": lote"), se
+    acusan por el outbox y solo entonces avanza el cursor. La sincronización
+    manual usa el mismo aplicar(), así que un evento nunca se aplica dos veces.
+    """
+    
+    CURSOR = 'avances'
+    
+    def __init__(self, conector: BotConnector, outbox: OutboxBot, conciliador: ConciliadorExcel,
+                 on_resultados=None, on_evento=None):
+        self.conector = conector
+        self.outbox = outbox
+        self.conciliador = conciliador
+        self.on_resultados = on_resultados  # (List[ResultadoConciliacion]) -> None
+        self.on_evento = on_evento  # (Dict) -> None, incidentes y ubicaciones
+        self.conectado = False
+        self.ubicaciones: Dict[Any, Dict] = {}  # user_id → última ubicación
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo: Optional[threading.Thread] = None
+    
+    def aplicar(self, eventos: List[Dict]) -> List[ResultadoConciliacion]:
+        """Aplica los eventos posteriores al cursor y lo avanza"""
+        with self._lock:
+            cursor = self.outbox.leer_cursor(self.CURSOR)
+            nuevos = [e for e in eventos if int(e.get('seq', 0)) > cursor]
+            if not nuevos:
+                return []
+            
+            entregas = [e for e in nuevos if e.get('tipo', 'entrega') == 'entrega']
+            resultados = self.conciliador.conciliar(entregas) if entregas else []
+            for evento in nuevos:
+                if evento.get('tipo') == 'ubicacion':
+                    self.ubicaciones[evento.get('user_id')] = evento
+            
+            # El cursor avanza solo después de aplicar el lote
+            self.outbox.encolar_acks([r.avance_id for r in resultados if r.actualizado])
+            self.outbox.guardar_cursor(self.CURSOR, max(int(e['seq']) for e in nuevos))
+        
+        if resultados and self.on_resultados:
+            self.on_resultados(resultados)
+        if self.on_evento:
+            for evento in nuevos:
+                if evento.get('tipo') != 'entrega':
+                    self.on_evento(evento)
+        return resultados
+    
+    def iniciar(self):
+        """Arranca el hilo del stream (idempotente)"""
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="stream-bot", daemon=True)
+        self._hilo.start()
+    
+    def detener(self):
+        self._detener.set()
+    
+    def _bucle(self):
+        espera, avisado = 1.0, False
+        while not self._detener.is_set():
+            lote: List[Dict] = []
+            try:
+                for tipo, dato in self.conector.escuchar_eventos(self.outbox.leer_cursor(self.CURSOR),
+                                                                 self._detener):
+                    if not self.conectado:
+                        self.conectado, espera, avisado = True, 1.0, False
+                        logger.info("📡 Stream de eventos del bot conectado")
+                    if tipo == 'evento':
+                        lote.append(dato)
+                        if len(lote) < CONFIG.AVANCES_PAGINA:
+                            continue
+                    if lote:
+                        self.aplicar(lote)
+                        lote = []
+                if lote:
+                    self.aplicar(lote)
+            except Exception as e:
+                # Lo no aplicado se vuelve a pedir desde el cursor guardado
+                if self.conectado or not avisado:
+                    logger.warning(f"Stream de eventos desconectado: {e}")
+                    avisado = True
+            self.conectado = False
+            
+            if self._detener.wait(espera + random.uniform(0, espera / 2)):
+                break
+            espera = min(espera * 2, CONFIG.STREAM_ESPERA_MAX)
+
+# =============================================================================
+# PIPELINE SIN INTERFAZ
+# =============================================================================
+
+@dataclass
+class OpcionesPipeline:
+    """Parámetros de una corrida de generación"""
+    archivo: str = "Alcaldías.xlsx"
+    api_key: str = CONFIG.API_KEY
+    origen_coords: str = CONFIG.ORIGEN_COORDS
+    origen_nombre: str = CONFIG.ORIGEN_NOMBRE
+    max_edificios: int = CONFIG.MAX_EDIFICIOS_POR_RUTA
+    procesos: int = CONFIG.PROCESOS_EXPORTACION
+    excel_modo: str = CONFIG.EXCEL_MODO
+    mapa_modo: str = CONFIG.MAPA_MODO
+    formato_payload: str = CONFIG.FORMATO_PAYLOAD
+    comprimir_payload: bool = CONFIG.COMPRIMIR_PAYLOAD
+    forzar: bool = False
+    subir: bool = True
+    reanudar: bool = False  # Retomar desde los checkpoints de una corrida interrumpida
+    perfil: str = ""  # "", "cpu" (cProfile), "memoria" (tracemalloc) o "completo"
+
+@dataclass
+class EventoPipeline:
+    """Evento de progreso: etapa (ingesta, agrupacion, rutas, exportacion, subida, fin)"""
+    etapa: str
+    tipo: str  # inicio | progreso | fin | info | error
+    mensaje: str = ""
+    actual: int = 0
+    total: int = 0
+    
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+class PipelineRutas:
+    """Ingesta → agrupación → rutas → exportación → subida, sin tkinter
+    
+    Se usa como biblioteca (ejecutar() con callback o eventos() como
+    generador) o desde la línea de comandos con --headless. Cada etapa deja
+    un checkpoint en CONFIG.CHECKPOINT_DIR; con reanudar=True se retoma
+    desde la última etapa (y ruta) completada.
+    """
+    
+    ETAPAS = ['ingesta', 'agrupacion', 'rutas', 'exportacion', 'subida']
+    
+    def __init__(self, opciones: OpcionesPipeline, df: Optional[pd.DataFrame] = None,
+                 outbox: Optional[OutboxBot] = None):
+        self.opciones = opciones
+        self.df = df
+        self.outbox = outbox
+        self.rutas: List[Ruta] = []
+        self.exportados: List[Dict] = []
+        self.payloads: List[Dict] = []
+        self.enviadas = 0
+        self.generator: Optional[RouteGenerator] = None
+        self._on_evento = None
+        self.checkpoints = PuntosControl(CONFIG.CHECKPOINT_DIR)
+    
+    def _emitir(self, etapa: str, tipo: str, mensaje: str = "", actual: int = 0, total: int = 0):
+        if self._on_evento:
+            self._on_evento(EventoPipeline(etapa, tipo, mensaje, actual, total))
+    
+    def _aplicar_config(self):
+        op = self.opciones
+        CONFIG.MAX_EDIFICIOS_POR_RUTA = op.max_edificios
+        CONFIG.PROCESOS_EXPORTACION = op.procesos
+        CONFIG.EXCEL_MODO = op.excel_modo
+        CONFIG.MAPA_MODO = op.mapa_modo
+        CONFIG.FORMATO_PAYLOAD = op.formato_payload
+        CONFIG.COMPRIMIR_PAYLOAD = op.comprimir_payload
+    
+    def _cargar_checkpoint(self, etapa: str, firma: str) -> Optional[Any]:
+        if not self.opciones.reanudar:
+            return None
+        datos = self.checkpoints.cargar(etapa, firma)
+        if datos is not None:
+            INSTRUMENTACION.contar('checkpoints.reutilizados')
+            self._emitir(etapa, 'info', f"⏭️ Reanudando: etapa {etapa} tomada del checkpoint")
+        return datos
+    
+    def ejecutar(self, on_evento=None) -> Dict:
+        """Ejecuta todas las etapas; on_evento(EventoPipeline) recibe el progreso
+        
+        Al terminar (aun con error) escribe CONFIG.REPORTE_EJECUCION con los
+        tiempos por etapa, las llamadas externas y, si se pidió, el perfil.
+        """
+        self._on_evento = on_evento
+        INSTRUMENTACION.reiniciar()
+        archivo_perfil = CONFIG.PERFIL_FILE if self.opciones.perfil in ('cpu', 'completo') else None
+        try:
+            with INSTRUMENTACION.capturar(self.opciones.perfil, archivo_perfil):
+                return self._ejecutar_etapas()
+        finally:
+            self._guardar_reporte()
+    
+    def _ejecutar_etapas(self) -> Dict:
+        self._aplicar_config()
+        op = self.opciones
+        if not op.reanudar:
+            self.checkpoints.limpiar()
+        
+        # Ingesta
+        with INSTRUMENTACION.etapa('ingesta'):
+            if self.df is None:
+                firma = PuntosControl.firma('ingesta', PuntosControl.firma_archivo(op.archivo))
+                self.df = self._cargar_checkpoint('ingesta', firma)
+                if self.df is None:
+                    self._emitir('ingesta', 'inicio', f"Procesando {op.archivo}")
+                    self.df = ExcelProcessor(op.archivo).procesar()
+                    self.checkpoints.guardar('ingesta', self.df, firma)
+        self._emitir('ingesta', 'fin', f"Registros: {len(self.df)}", len(self.df), len(self.df))
+        
+        # Agrupación (geocodificación; el caché se persiste durante la etapa)
+        self.generator = generator = RouteGenerator(
+            df=self.df,
+            api_key=op.api_key,
+            origen_coords=op.origen_coords,
+            origen_nombre=op.origen_nombre
+        )
+        with INSTRUMENTACION.etapa('agrupacion'):
+            firma_agrupacion = PuntosControl.firma('agrupacion', PuntosControl.firma_dataframe(self.df))
+            edificios_por_zona = self._cargar_checkpoint('agrupacion', firma_agrupacion)
+            if edificios_por_zona is None:
+                self._emitir('agrupacion', 'inicio', "Agrupando personas por edificio")
+                edificios_por_zona = generator.agrupar_edificios()
+                self.checkpoints.guardar('agrupacion', edificios_por_zona, firma_agrupacion)
+        total_edificios = sum(len(e) for e in edificios_por_zona.values())
+        self._emitir('agrupacion', 'fin', f"Edificios: {total_edificios}", total_edificios, total_edificios)
+        
+        # Rutas
+        with INSTRUMENTACION.etapa('rutas'):
+            firma_rutas = PuntosControl.firma('rutas', firma_agrupacion, op.origen_coords,
+                                              op.origen_nombre, op.max_edificios)
+            self.rutas = self._cargar_checkpoint('rutas', firma_rutas)
+            if self.rutas is None:
+                self._crear_rutas(generator, edificios_por_zona, firma_rutas)
+        if not self.rutas:
+            self._emitir('rutas', 'error', "No se pudieron crear rutas")
+            return self.resumen()
+        self._emitir('rutas', 'fin', f"Rutas creadas: {len(self.rutas)}", len(self.rutas), len(self.rutas))
+        
+        # Exportación
+        # La polilínea distingue rutas optimizadas de las que quedaron pendientes
+        firma_exportacion = PuntosControl.firma('exportacion', firma_rutas,
+                                                [(r.id, r.polyline) for r in self.rutas],
+                                                op.excel_modo, op.mapa_modo,
+                                                op.formato_payload, op.comprimir_payload)
+        with INSTRUMENTACION.etapa('exportacion'):
+            self._etapa_exportacion(firma_exportacion)
+        
+        # Subida al bot
+        if op.subir:
+            with INSTRUMENTACION.etapa('subida'):
+                self._subir()
+        
+        resumen = self.resumen()
+        self._emitir('fin', 'fin', f"{resumen['rutas']} rutas generadas", resumen['rutas'], resumen['rutas'])
+        return resumen
+    
+    def _guardar_reporte(self):
+        """Escribe el reporte de la corrida y emite su resumen"""
+        extra = {
+            'opciones': {k: v for k, v in asdict(self.opciones).items() if k != 'api_key'},
+            'resumen': self.resumen(),
+            'geocoding': dict(self.generator.geocoder.stats) if self.generator else {},
+            'exportacion_segundos_trabajo': round(
+                sum(e.get('segundos') or 0 for e in self.exportados), 3
+            )
+        }
+        try:
+            reporte = INSTRUMENTACION.guardar(CONFIG.REPORTE_EJECUCION, extra)
+        except OSError as e:
+            logger.error(f"Error guardando reporte de ejecución: {e}")
+            return
+        self._emitir('fin', 'info', f"📄 Reporte de ejecución: {CONFIG.REPORTE_EJECUCION}")
+        for linea in lineas_resumen(reporte):
+            self._emitir('fin', 'info', linea)
+    
+    def _crear_rutas(self, generator: RouteGenerator, edificios_por_zona: Dict[str, List[Edificio]],
+                     firma: str):
+        parciales = self.checkpoints.rutas_parciales(firma) if self.opciones.reanudar else {}
+        if parciales:
+            self._emitir('rutas', 'info', f"⏭️ Reanudando: {len(parciales)} rutas ya optimizadas")
+        self._emitir('rutas', 'inicio', "Creando y optimizando rutas")
+        
+        completas = set()
+        
+        def _on_ruta(ruta: Ruta):
+            self.checkpoints.guardar_ruta(ruta, firma)
+            completas.add(ruta.id)
+            self._emitir('rutas', 'progreso', f"Ruta {ruta.id} optimizada", ruta.id)
+        
+        self.rutas = generator.crear_rutas(edificios_por_zona, completadas=parciales, on_ruta=_on_ruta)
+        completas.update(r.id for r in self.rutas if parciales.get(r.id) is r)
+        
+        # Con rutas sin optimizar la etapa queda abierta para reintentarlas al reanudar
+        pendientes = [r.id for r in self.rutas if r.id not in completas]
+        if pendientes:
+            self._emitir('rutas', 'error', f"{len(pendientes)} rutas sin optimizar; "
+                                           f"use reanudar para reintentarlas")
+            return
+        self.checkpoints.guardar('rutas', self.rutas, firma)
+        self.checkpoints.limpiar_rutas_parciales()
+    
+    def _etapa_exportacion(self, firma: str):
+        exportacion = None if self.opciones.forzar else self._cargar_checkpoint('exportacion', firma)
+        if exportacion is not None:
+            self.exportados, self.payloads = exportacion
+            return
+        
+        self._exportar()
+        # Con rutas fallidas la etapa queda abierta: al reanudar se vuelve a
+        # exportar y el manifiesto omite las que ya se generaron
+        fallidas = [e['ruta_id'] for e in self.exportados if e['error']]
+        if fallidas:
+            self._emitir('exportacion', 'error', f"{len(fallidas)} rutas sin exportar; "
+                                                 f"use reanudar para reintentarlas")
+            return
+        self.checkpoints.guardar('exportacion', (self.exportados, self.payloads), firma)
+    
+    def _exportar(self):
+        total = len(self.rutas)
+        self._emitir('exportacion', 'inicio', "Generando archivos", 0, total)
+        file_gen = FileGenerator()
+        
+        def _progreso(completadas, total, resultado):
+            if resultado.get('omitida'):
+                mensaje, tipo = f"Ruta {resultado['ruta_id']} sin cambios", 'progreso'
+                INSTRUMENTACION.contar('exportacion.omitidas')
+            elif resultado['error']:
+                mensaje, tipo = f"Ruta {resultado['ruta_id']}: {resultado['error']}", 'error'
+                INSTRUMENTACION.contar('exportacion.errores')
+            else:
+                mensaje, tipo = f"Archivos ruta {resultado['ruta_id']}", 'progreso'
+                INSTRUMENTACION.contar('exportacion.generadas')
+            self._emitir('exportacion', tipo, mensaje, completadas, total)
+        
+        self.exportados = file_gen.exportar_rutas(self.rutas, progreso=_progreso,
+                                                  forzar=self.opciones.forzar)
+        IndiceDestinatarios.desde_rutas(self.rutas).guardar(CONFIG.INDICE_DESTINATARIOS)
+        _, self.payloads = file_gen.generar_plan_telegram(self.rutas)
+        
+        # Resumen (en modo libro único ya va como hoja RESUMEN)
+        if CONFIG.EXCEL_MODO != "libro_unico":
+            file_gen.generar_resumen(self.rutas)
+        self._emitir('exportacion', 'fin', "Archivos generados", total, total)
+    
+    def _subir(self):
+        """Encola el plan en el outbox; el envío no bloquea la generación"""
+        pendientes = [p for e, p in zip(self.exportados, self.payloads) if not e['error']]
+        self._emitir('subida', 'inicio', "Encolando plan para el bot", 0, len(pendientes))
+        
+        propio = self.outbox is None
+        if propio:
+            self.outbox = OutboxBot()
+        clave = self.outbox.encolar_plan(pendientes)
+        
+        if propio:
+            # Sin emisor en segundo plano (CLI): un intento; si falla queda en cola
+            self.outbox.procesar_pendientes()
+        
+        if self.outbox.estado(clave) == 'enviado':
+            self.enviadas = len(pendientes)
+            self._emitir('subida', 'fin', f"Rutas enviadas: {self.enviadas}", self.enviadas, len(pendientes))
+        elif propio:
+            self._emitir('subida', 'error', f"Bot no disponible; plan en cola "
+                                            f"({self.outbox.pendientes()} envíos pendientes)")
+        else:
+            self._emitir('subida', 'fin', f"Plan en cola: {len(pendientes)} rutas; "
+                                          f"el envío continúa en segundo plano", len(pendientes), len(pendientes))
+    
+    def resumen(self) -> Dict:
+        generadas = [r for r, e in zip(self.rutas, self.exportados) if not e['error']]
+        return {
+            'rutas': len(generadas),
+            'errores': len(self.rutas) - len(generadas),
+            'edificios': sum(r.total_edificios for r in generadas),
+            'personas': sum(r.total_personas for r in generadas),
+            'distancia_km': round(sum(r.distancia_km for r in generadas), 1),
+            'enviadas': self.enviadas
+        }
+    
+    def eventos(self):
+        """Generador de eventos; ejecuta el pipeline en un hilo aparte"""
+        cola: "queue.Queue" = queue.Queue()
+        fin = object()
+        error: List[BaseException] = []
+        
+        def _correr():
+            try:
+                self.ejecutar(on_evento=cola.put)
+            except BaseException as e:
+                error.append(e)
+            finally:
+                cola.put(fin)
+        
+        threading.Thread(target=_correr, daemon=True).start()
+        while True:
+            evento = cola.get()
+            if evento is fin:
+                break
+            yield evento
+        if error:
+            raise error[0]
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    """Punto de entrada sin interfaz: python Sistema_Rutas_Completo.py --headless archivo.xlsx"""
+    parser = argparse.ArgumentParser(description="Generación de rutas sin interfaz gráfica")
+    parser.add_argument('--headless', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('archivo', nargs='?', default="Alcaldías.xlsx")
+    parser.add_argument('--api-key', default=os.environ.get('GOOGLE_API_KEY', CONFIG.API_KEY))
+    parser.add_argument('--origen', default=CONFIG.ORIGEN_COORDS)
+    parser.add_argument('--origen-nombre', default=CONFIG.ORIGEN_NOMBRE)
+    parser.add_argument('--max-edificios', type=int, default=CONFIG.MAX_EDIFICIOS_POR_RUTA)
+    parser.add_argument('--procesos', type=int, default=CONFIG.PROCESOS_EXPORTACION)
+    parser.add_argument('--excel-modo', choices=['por_ruta', 'libro_unico'], default=CONFIG.EXCEL_MODO)
+    parser.add_argument('--mapa-modo', choices=['combinado', 'por_ruta'], default=CONFIG.MAPA_MODO)
+    parser.add_argument('--formato', choices=['json', 'msgpack'], default=CONFIG.FORMATO_PAYLOAD)
+    parser.add_argument('--gzip', action='store_true', default=CONFIG.COMPRIMIR_PAYLOAD)
+    parser.add_argument('--forzar', action='store_true', help="Regenera rutas sin cambios")
+    parser.add_argument('--sin-subir', action='store_true', help="No envía las rutas al bot")
+    parser.add_argument('--reanudar', action='store_true',
+                        help="Retoma desde los checkpoints de la última corrida")
+    parser.add_argument('--perfil', choices=[m for m in MODOS_PERFIL if m], default="",
+                        help="Incluye cProfile (cpu), tracemalloc (memoria) o ambos en el reporte")
+    parser.add_argument('--json-eventos', action='store_true', help="Un evento JSON por línea en stdout")
+    args = parser.parse_args(argv)
+    
+    FileManager.crear_carpetas()
+    pipeline = PipelineRutas(OpcionesPipeline(
+        archivo=args.archivo,
+        api_key=args.api_key,
+        origen_coords=args.origen,
+        origen_nombre=args.origen_nombre,
+        max_edificios=args.max_edificios,
+        procesos=args.procesos,
+        excel_modo=args.excel_modo,
+        mapa_modo=args.mapa_modo,
+        formato_payload=args.formato,
+        comprimir_payload=args.gzip,
+        forzar=args.forzar,
+        subir=not args.sin_subir,
+        reanudar=args.reanudar,
+        perfil=args.perfil
+    ))
+    
+    errores = 0
+    for evento in pipeline.eventos():
+        errores += evento.tipo == 'error'
+        if args.json_eventos:
+            print(json.dumps(evento.to_dict(), ensure_ascii=False), flush=True)
+        else:
+            avance = f" ({evento.actual}/{evento.total})" if evento.total else ""
+            print(f"[{evento.etapa}] {evento.mensaje}{avance}", flush=True)
+    
+    return 1 if errores else 0
+
 # =============================================================================
 # INTERFAZ GRÁFICA
 # =============================================================================
 
+class ManejadorLogCola(logging.Handler):
+    """Reenvía registros de logging a la cola de la interfaz (desde cualquier hilo)"""
+    
+    ICONOS = {logging.WARNING: '⚠️', logging.ERROR: '❌', logging.CRITICAL: '❌'}
+    
+    def __init__(self, cola: "queue.Queue", nivel: int = logging.WARNING):
+        super().__init__(nivel)
+        self.cola = cola
+    
+    def emit(self, record: logging.LogRecord):
+        try:
+            timestamp = datetime.fromtimestamp(record.created).strftime("%H:%M:%S")
+            icono = self.ICONOS.get(record.levelno, '•')
+            self.cola.put(('log', f"[{timestamp}] {icono} {record.getMessage()}"))
+        except Exception:
+            self.handleError(record)
+
 class SistemaRutasGUI:
-    """Interfaz gráfica principal"""
+    """Interfaz gráfica principal
+    
+    Tk solo se toca desde el hilo principal: los hilos de trabajo encolan
+    mensajes, progreso y llamadas en self.cola_ui, que _drenar_cola procesa
+    por lotes con root.after.
+    """
     
     def __init__(self, root):
+        _importar_tk()
         self.root = root
         self.root.title("Sistema Rutas PRO - Optimizado")
         self.root.geometry("1100x800")
@@ -985,13 +2659,25 @@ class SistemaRutasGUI:
         self.df = None
         self.procesando = False
         self.sincronizando = False
+        self.cola_ui: "queue.Queue" = queue.Queue()
         
         self.bot = BotConnector()
         self.file_manager = FileManager()
         self.file_manager.crear_carpetas()
+        self.outbox = OutboxBot(conector=self.bot)
+        self.outbox.iniciar()
+        self.conciliador = ConciliadorExcel()
+        self.suscriptor = SuscriptorEventos(self.bot, self.outbox, self.conciliador,
+                                            on_resultados=self._log_conciliacion,
+                                            on_evento=self._log_evento_bot)
+        self.suscriptor.iniciar()
+        
+        self.manejador_log = ManejadorLogCola(self.cola_ui)
+        logger.addHandler(self.manejador_log)
         
         self._setup_ui()
         self._carga_inicial()
+        self.root.after(CONFIG.LOG_INTERVALO_MS, self._drenar_cola)
     
     def _setup_ui(self):
         """Configura la interfaz de usuario"""
@@ -1042,6 +2728,9 @@ class SistemaRutasGUI:
         self.nombre_entry.insert(0, CONFIG.ORIGEN_NOMBRE)
         self.nombre_entry.pack(side=tk.LEFT, padx=(5, 0))
         
+        self.reanudar_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(params_frame, text="Reanudar", variable=self.reanudar_var).pack(side=tk.LEFT, padx=(10, 0))
+        
         # Botones principales
         btn_frame = ttk.LabelFrame(main_frame, text="Control", padding="15")
         btn_frame.pack(fill=tk.X, pady=(0, 10))
@@ -1079,7 +2768,7 @@ class SistemaRutasGUI:
         # Progress
         self.progress_frame = ttk.Frame(main_frame)
         self.progress_frame.pack(fill=tk.X, pady=(10, 0))
-        self.progress_bar = ttk.Progressbar(self.progress_frame, mode='indeterminate')
+        self.progress_bar = ttk.Progressbar(self.progress_frame, mode='determinate', maximum=100)
         self.progress_bar.pack(fill=tk.X)
         self.progress_label = ttk.Label(self.progress_frame, text="Listo")
         self.progress_label.pack()
@@ -1155,79 +2844,45 @@ class SistemaRutasGUI:
             messagebox.showwarning("API Key", "Configura la API Key")
             return
         
+        opciones = OpcionesPipeline(
+            archivo=getattr(self, 'archivo_excel', None) or "",
+            api_key=self.api_key,
+            origen_coords=self.origen_entry.get().strip(),
+            origen_nombre=self.nombre_entry.get().strip(),
+            max_edificios=int(self.max_spinbox.get()),
+            reanudar=self.reanudar_var.get()
+        )
+        
         self.procesando = True
         self.btn_generar.config(state='disabled')
-        self.progress_bar.start(10)
+        self.progress_bar['value'] = 0
         self.progress_label.config(text="Generando rutas...")
         
-        thread = threading.Thread(target=self._procesar_rutas)
+        thread = threading.Thread(target=self._procesar_rutas, args=(opciones,))
         thread.daemon = True
         thread.start()
     
-    def _procesar_rutas(self):
+    def _procesar_rutas(self, opciones: OpcionesPipeline):
         """Procesa las rutas en segundo plano"""
+        iconos = {'inicio': '🚀', 'progreso': '📦', 'fin': '✅', 'info': '', 'error': '❌'}
+        
+        def _on_evento(evento: EventoPipeline):
+            avance = f" ({evento.actual}/{evento.total})" if evento.tipo == 'progreso' and evento.total else ""
+            self.log(f"{iconos.get(evento.tipo, '•')} {evento.mensaje}{avance}".lstrip())
+            self.progreso(evento)
+        
         try:
             self.log("🚀 INICIANDO GENERACIÓN...")
             
-            # Limpiar carpetas
-            self.file_manager.limpiar_todo()
-            
-            # Configurar
-            origen_coords = self.origen_entry.get().strip()
-            origen_nombre = self.nombre_entry.get().strip()
-            max_stops = int(self.max_spinbox.get())
-            
-            # Generador
-            generator = RouteGenerator(
-                df=self.df,
-                api_key=self.api_key,
-                origen_coords=origen_coords,
-                origen_nombre=origen_nombre
-            )
-            
-            # Agrupar y crear rutas
-            edificios_por_zona = generator.agrupar_edificios()
-            rutas = generator.crear_rutas(edificios_por_zona)
-            
-            if not rutas:
-                self.log("❌ No se pudieron crear rutas")
+            resumen = PipelineRutas(opciones, df=self.df, outbox=self.outbox).ejecutar(on_evento=_on_evento)
+            if not resumen['rutas']:
                 return
             
-            # Generar archivos
-            file_gen = FileGenerator()
-            resultados = []
-            
-            for ruta in rutas:
-                excel = file_gen.generar_excel(ruta)
-                mapa = file_gen.generar_mapa(ruta)
-                telegram = file_gen.generar_json_telegram(ruta, excel)
-                
-                # Enviar a bot
-                if self.bot.verificar_conexion():
-                    with open(telegram, 'r', encoding='utf-8') as f:
-                        ruta_data = json.load(f)
-                    if self.bot.enviar_ruta(ruta_data):
-                        self.log(f"📱 Ruta {ruta.id} enviada al bot")
-                
-                resultados.append({
-                    'id': ruta.id,
-                    'zona': ruta.zona,
-                    'edificios': ruta.total_edificios,
-                    'personas': ruta.total_personas,
-                    'distancia': ruta.distancia_km,
-                    'tiempo': ruta.tiempo_min
-                })
-                
-                self.log(f"✅ Ruta {ruta.id}: {ruta.total_edificios} edificios, {ruta.total_personas} personas")
-            
-            # Resumen
-            resumen = file_gen.generar_resumen(rutas)
-            
-            self.log(f"🎉 {len(resultados)} RUTAS GENERADAS")
-            self.log(f"📊 Total edificios: {sum(r['edificios'] for r in resultados)}")
-            self.log(f"👥 Total personas: {sum(r['personas'] for r in resultados)}")
+            self.log(f"🎉 {resumen['rutas']} RUTAS GENERADAS")
+            self.log(f"📊 Total edificios: {resumen['edificios']}")
+            self.log(f"👥 Total personas: {resumen['personas']}")
             
-            messagebox.showinfo("Éxito", f"{len(resultados)} rutas generadas")
+            self.en_ui(messagebox.showinfo, "Éxito", f"{resumen['rutas']} rutas generadas")
             
         except Exception as e:
             self.log(f"❌ ERROR: {e}")
@@ -1235,13 +2890,13 @@ class SistemaRutasGUI:
             self.log(traceback.format_exc())
         
         finally:
-            self.root.after(0, self._finalizar_procesamiento)
+            self.en_ui(self._finalizar_procesamiento)
     
     def _finalizar_procesamiento(self):
         """Finaliza el procesamiento"""
         self.procesando = False
         self.btn_generar.config(state='normal')
-        self.progress_bar.stop()
+        self.progress_bar['value'] = 100
         self.progress_label.config(text="Completado")
     
     def abrir_carpeta(self, carpeta):
@@ -1252,68 +2907,55 @@ class SistemaRutasGUI:
             self.log(f"📁 Carpeta no encontrada: {carpeta}")
     
     def actualizar_fotos(self):
-        """Actualiza fotos en Excel"""
+        """Fuerza la sincronización de avances (normalmente llegan solos por el stream)"""
+        if self.sincronizando:
+            return
+        self.sincronizando = True
+        threading.Thread(target=self._sincronizar_avances, daemon=True).start()
+    
+    def _sincronizar_avances(self):
+        """Lee el feed de avances por páginas desde el último cursor guardado"""
         try:
             self.log("🔄 Actualizando fotos...")
             
-            avances = self.bot.obtener_avances()
-            self.log(f"📊 Avances pendientes: {len(avances)}")
-            
-            actualizados = 0
-            for avance in avances:
-                if self._procesar_avance(avance):
-                    actualizados += 1
-                    if avance.get('id'):
-                        self.bot.marcar_procesado(avance['id'])
+            cursor = self.outbox.leer_cursor(SuscriptorEventos.CURSOR)
+            recibidos = actualizados = 0
+            while True:
+                pagina = self.bot.obtener_avances_desde(cursor, CONFIG.AVANCES_PAGINA)
+                if pagina is None:
+                    self.log("❌ Bot no disponible; se reintentará en la próxima sincronización")
+                    break
+                avances, nuevo_cursor, hay_mas = pagina
+                recibidos += len(avances)
+                
+                # Mismo camino que el stream: lo ya aplicado se descarta por cursor
+                resultados = self.suscriptor.aplicar(avances)
+                actualizados += sum(r.actualizado for r in resultados)
+                cursor = max(nuevo_cursor, self.outbox.leer_cursor(SuscriptorEventos.CURSOR))
+                if not hay_mas:
+                    break
             
+            self.log(f"📊 Avances nuevos: {recibidos}")
             self.log(f"✅ Excel actualizados: {actualizados}")
             
         except Exception as e:
             self.log(f"❌ Error: {e}")
-    
-    def _procesar_avance(self, avance: Dict) -> bool:
-        """Procesa un avance individual"""
-        try:
-            ruta_id = avance.get('ruta_id')
-            persona = avance.get('persona_entregada', '').strip()
-            foto = avance.get('foto_local', '')
-            repartidor = avance.get('repartidor', '')
-            timestamp = avance.get('timestamp', '')
-            
-            if not persona or not ruta_id:
-                return False
-            
-            # Buscar Excel
-            excel_files = [f for f in os.listdir("rutas_excel") 
-                          if f.startswith(f"Ruta_{ruta_id}_") and f.endswith('.xlsx')]
-            
-            if not excel_files:
-                return False
-            
-            excel = f"rutas_excel/{excel_files[0]}"
-            df = pd.read_excel(excel)
-            
-            # Buscar persona
-            persona_lower = persona.lower()
-            for idx, row in df.iterrows():
-                nombre = str(row.get('Nombre', '')).lower()
-                if persona_lower in nombre or nombre in persona_lower:
-                    link = f"=HIPERVINCULO(\"{foto}\", \"VER FOTO\")" if foto else "SIN FOTO"
-                    df.at[idx, 'Acuse'] = f"✅ ENTREGADO - {timestamp}"
-                    df.at[idx, 'Repartidor'] = repartidor
-                    df.at[idx, 'Foto_Acuse'] = link
-                    df.at[idx, 'Timestamp_Entrega'] = timestamp
-                    df.at[idx, 'Estado'] = 'ENTREGADO'
-                    
-                    df.to_excel(excel, index=False)
-                    self.log(f"✅ Actualizado: {persona}")
-                    return True
-            
-            return False
-            
-        except Exception as e:
-            self.log(f"❌ Error procesando: {e}")
-            return False
+        finally:
+            self.sincronizando = False
+    
+    def _log_conciliacion(self, resultados: List[ResultadoConciliacion]):
+        """Una línea por entrega aplicada o no encontrada"""
+        iconos = {'actualizado': '✅', 'sin_coincidencia': '🔍', 'ambiguo': '❓', 'sin_libro': '📁',
+                  'invalido': '⚠️', 'error': '❌'}
+        for r in resultados:
+            destino = f"{os.path.basename(r.archivo)}:{r.hoja} fila {r.fila}" if r.fila else r.detalle or r.estado
+            self.log(f"{iconos.get(r.estado, '•')} Ruta {r.ruta_id} - {r.persona or '?'}: {destino}")
+    
+    def _log_evento_bot(self, evento: Dict):
+        """Incidentes en el log; las ubicaciones solo se guardan (ver estado)"""
+        if evento.get('tipo') == 'incidente':
+            self.log(f"🚨 Incidente en ruta {evento.get('ruta_id') or '?'} - {evento.get('repartidor', '')}: "
+                     f"{evento.get('foto_local') or 'sin foto'}")
     
     def ver_estado(self):
         """Muestra estado de las rutas"""
@@ -1323,14 +2965,17 @@ class SistemaRutasGUI:
         
         self.log("📋 ESTADO DE RUTAS:")
         
-        for archivo in os.listdir("rutas_telegram"):
-            if not archivo.endswith('.json'):
-                continue
-            
+        pendientes = self.outbox.pendientes()
+        if pendientes:
+            self.log(f"   📤 Envíos al bot pendientes: {pendientes}")
+        self.log(f"   📡 Stream del bot: {'conectado' if self.suscriptor.conectado else 'reconectando'}")
+        for ubicacion in self.suscriptor.ubicaciones.values():
+            datos = ubicacion.get('datos', {})
+            self.log(f"     📍 {ubicacion.get('repartidor', '')} (ruta {ubicacion.get('ruta_id') or '-'}): "
+                     f"{datos.get('latitud')}, {datos.get('longitud')} a las {ubicacion.get('timestamp', '')[11:19]}")
+        
+        for archivo, data in formato_rutas.iterar_rutas("rutas_telegram"):
             try:
-                with open(f"rutas_telegram/{archivo}", 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
                 estado = data.get('estado', 'desconocido')
                 repartidor = data.get('repartidor_asignado', 'Sin asignar')
                 paradas = len(data.get('paradas', []))
@@ -1346,18 +2991,13 @@ class SistemaRutasGUI:
         """Interfaz para asignar rutas"""
         rutas = []
         
-        if os.path.exists("rutas_telegram"):
-            for archivo in os.listdir("rutas_telegram"):
-                if archivo.endswith('.json'):
-                    with open(f"rutas_telegram/{archivo}", 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                    
-                    if data.get('estado') == 'pendiente':
-                        rutas.append({
-                            'id': data['ruta_id'],
-                            'zona': data['zona'],
-                            'archivo': archivo
-                        })
+        for archivo, data in formato_rutas.iterar_rutas("rutas_telegram"):
+            if data.get('estado') == 'pendiente':
+                rutas.append({
+                    'id': data['ruta_id'],
+                    'zona': data['zona'],
+                    'archivo': archivo
+                })
         
         if not rutas:
             messagebox.showinfo("Info", "No hay rutas pendientes")
@@ -1397,15 +3037,13 @@ class SistemaRutasGUI:
             return
         
         try:
-            with open(f"rutas_telegram/{archivo}", 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = formato_rutas.leer_archivo(f"rutas_telegram/{archivo}")
             
             data['estado'] = 'asignada'
             data['repartidor_asignado'] = repartidor
             data['fecha_asignacion'] = datetime.now().isoformat()
             
-            with open(f"rutas_telegram/{archivo}", 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            formato_rutas.guardar_archivo(f"rutas_telegram/{archivo}", data)
             
             self.log(f"✅ Ruta {data['ruta_id']} asignada a {repartidor}")
             messagebox.showinfo("Éxito", "Ruta asignada")
@@ -1419,13 +3057,12 @@ class SistemaRutasGUI:
             messagebox.showinfo("Info", "Primero genera rutas")
             return
         
-        archivos = [f for f in os.listdir("rutas_telegram") if f.endswith('.json')]
+        archivos = [f for f in sorted(os.listdir("rutas_telegram")) if formato_rutas.es_archivo_ruta(f)]
         if not archivos:
             return
         
         try:
-            with open(f"rutas_telegram/{archivos[0]}", 'r', encoding='utf-8') as f:
-                ruta = json.load(f)
+            ruta = formato_rutas.leer_archivo(f"rutas_telegram/{archivos[0]}")
             
             # Tomar primera persona
             primera_parada = ruta.get('paradas', [{}])[0]
@@ -1441,7 +3078,9 @@ class SistemaRutasGUI:
                 'tipo': 'simulacion'
             }
             
-            if self._procesar_avance(avance):
+            resultados = self.conciliador.conciliar([avance])
+            self._log_conciliacion(resultados)
+            if resultados[0].actualizado:
                 self.log("🧪 Entrega simulada completada")
             else:
                 self.log("❌ Error en simulación")
@@ -1461,18 +3100,89 @@ class SistemaRutasGUI:
             self.btn_generar.config(state='disabled')
     
     def log(self, mensaje: str):
-        """Agrega mensaje al log"""
+        """Agrega mensaje al log (seguro desde cualquier hilo; no bloquea)"""
         timestamp = datetime.now().strftime("%H:%M:%S")
-        self.log_text.insert(tk.END, f"[{timestamp}] {mensaje}\n")
-        self.log_text.see(tk.END)
-        self.root.update()
+        self.cola_ui.put(('log', f"[{timestamp}] {mensaje}"))
+    
+    def progreso(self, evento: EventoPipeline):
+        """Encola el avance de una etapa para la barra de progreso"""
+        self.cola_ui.put(('progreso', evento))
+    
+    def en_ui(self, funcion, *args):
+        """Ejecuta funcion(*args) en el hilo de Tk (p. ej. diálogos desde un hilo de trabajo)"""
+        self.cola_ui.put(('llamada', (funcion, args)))
+    
+    def _drenar_cola(self):
+        """Procesa la cola de la interfaz en un solo lote por intervalo
+        
+        Un mensaje que falla se registra y no detiene al resto del lote; el
+        siguiente drenado se programa siempre, aun si algo falla aquí.
+        """
+        try:
+            self._procesar_cola()
+        finally:
+            self.root.after(CONFIG.LOG_INTERVALO_MS, self._drenar_cola)
+    
+    def _procesar_cola(self):
+        lineas, ultimo_progreso, llamadas = [], None, []
+        try:
+            while True:
+                tipo, dato = self.cola_ui.get_nowait()
+                if tipo == 'log':
+                    lineas.append(dato)
+                elif tipo == 'progreso':
+                    ultimo_progreso = dato
+                else:
+                    llamadas.append(dato)
+        except queue.Empty:
+            pass
+        
+        if lineas:
+            try:
+                self.log_text.insert(tk.END, "\n".join(lineas) + "\n")
+                total_lineas = int(self.log_text.index('end-1c').split('.')[0])
+                if total_lineas > CONFIG.LOG_MAX_LINEAS:
+                    self.log_text.delete('1.0', f"{total_lineas - CONFIG.LOG_MAX_LINEAS + 1}.0")
+                self.log_text.see(tk.END)
+            except Exception as e:
+                logger.error(f"Error escribiendo el log en pantalla: {e}")
+        
+        if ultimo_progreso:
+            try:
+                self._mostrar_progreso(ultimo_progreso)
+            except Exception as e:
+                logger.error(f"Error mostrando progreso ({ultimo_progreso.etapa}): {e}")
+        
+        for funcion, args in llamadas:
+            try:
+                funcion(*args)
+            except Exception as e:
+                logger.error(f"Error en llamada de interfaz {getattr(funcion, '__name__', funcion)}: {e}")
+    
+    def _mostrar_progreso(self, evento: EventoPipeline):
+        """Porcentaje global: etapas completas más la fracción de la etapa actual"""
+        etapas = PipelineRutas.ETAPAS
+        if evento.etapa not in etapas:
+            return
+        fraccion = 1.0 if evento.tipo == 'fin' else 0.0
+        if evento.tipo == 'progreso' and evento.total:
+            fraccion = min(evento.actual / evento.total, 1.0)
+        porcentaje = (etapas.index(evento.etapa) + fraccion) / len(etapas) * 100
+        self.progress_bar['value'] = max(self.progress_bar['value'], porcentaje)
+        
+        avance = f" {evento.actual}/{evento.total}" if evento.total else ""
+        self.progress_label.config(text=f"{evento.etapa.capitalize()}{avance} ({porcentaje:.0f}%)")
 
 # =============================================================================
 # EJECUCIÓN PRINCIPAL
 # =============================================================================
 
 if __name__ == "__main__":
+    if '--headless' in sys.argv[1:]:
+        sys.exit(main_cli())
+    
     FileManager.crear_carpetas()
+    _importar_tk()
     
     root = tk.Tk()
     app = SistemaRutasGUI(root)
@@ -0,0 +1,499 @@
+"""
+BENCHMARK DE GENERACIÓN DE RUTAS
+Mide cada etapa del pipeline con datos sintéticos reproducibles:
+- Libros sintéticos con el formato de Alcaldías.xlsx (1k, 10k, 100k destinatarios)
+- Backend de Google (Geocoding + Directions) simulado, sin red ni cuota
+- Tiempos por etapa: procesar, agrupar_edificios, crear_rutas, FileGenerator
+- Métricas de calidad: km totales y desbalance entre rutas
+- Resultados en JSON para comparar entre commits
+
+Uso:
+    python benchmarks/bench_rutas.py                       # 1k y 10k
+    python benchmarks/bench_rutas.py --tamanos 1000 10000 100000
+    python benchmarks/bench_rutas.py --comparar base.json --salida actual.json
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from unittest import mock
+
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ_REPO)
+
+import pandas as pd
+import polyline
+
+import Sistema_Rutas_Completo as sistema
+
+logger = logging.getLogger("bench_rutas")
+
+ESQUEMA_RESULTADOS = 1
+TAMANOS_DEFAULT = [1000, 10000]
+# Fracción mínima de destinatarios que ExcelProcessor debe leer bien del libro
+# sintético (número y dirección en su columna); menos indica que el diseño del
+# libro no es el que espera el parser y la corrida no mide rutas reales
+MIN_FRACCION_LEIDOS = 0.9
+
+# =============================================================================
+# DATOS SINTÉTICOS
+# =============================================================================
+
+ALCALDIAS = [
+    'Cuauhtémoc', 'Miguel Hidalgo', 'Benito Juárez', 'Álvaro Obregón',
+    'Coyoacán', 'Tlalpan', 'Iztapalapa', 'Gustavo A. Madero',
+    'Venustiano Carranza', 'Azcapotzalco', 'Iztacalco', 'Xochimilco',
+    'Tláhuac', 'Magdalena Contreras', 'Cuajimalpa', 'Milpa Alta'
+]
+
+CALLES = [
+    'Av. Insurgentes Sur', 'Av. Reforma', 'Calle Dr. Velasco', 'Av. Patriotismo',
+    'Calle Amores', 'Av. Constituyentes', 'Calle Nuevo León', 'Av. de la Paz',
+    'Calle Abraham González', 'Av. Álvaro Obregón', 'Calle Fray Servando',
+    'Av. Universidad', 'Calzada de Tlalpan', 'Av. Revolución', 'Calle Río Lerma',
+    'Av. Chapultepec', 'Calle Donceles', 'Av. Cuauhtémoc', 'Calle Durango'
+]
+
+COLONIAS = [
+    'Centro', 'Doctores', 'Juárez', 'Roma Norte', 'Del Valle', 'Narvarte',
+    'San Juan', 'Condesa', 'Chimalistac', 'Escandón', 'Nápoles', 'Obrera'
+]
+
+NOMBRES = ['Alejandra', 'Juan', 'María', 'Carlos', 'Ana', 'Luis', 'Rosa',
+           'Héctor', 'Myriam', 'Pablo', 'Araceli', 'Salvador', 'Nelly', 'Omar']
+APELLIDOS = ['Pérez', 'García', 'López', 'Martínez', 'Hernández', 'Ramírez',
+             'Juárez', 'Maldonado', 'Yáñez', 'Frausto', 'Guerrero', 'Nieto']
+TITULOS = ['', '', 'Lic. ', 'Mtra. ', 'Mtro. ', 'Dr. ', 'Dra. ', 'Ing. ']
+SECCIONES = ['FGR', 'Gobierno Federal', 'Alcaldías', 'Suprema Corte',
+             'Congreso de la Ciudad', 'Sindicatos', 'Organismos Autónomos']
+
+ENCABEZADO = ['#', 'NOMBRE', 'ADSCRIPCIÓN', 'DIRECCIÓN', 'ALCALDÍA',
+              'INVITACIÓN', 'CONFIRMA ASISTENCIA', 'NOTAS']
+
+
+def generar_libro_sintetico(destinatarios: int, archivo: str, semilla: int = 42,
+                            por_seccion: int = 60, por_edificio: int = 4,
+                            columna_inicial: int = 1) -> str:
+    """Genera un libro con el formato de Alcaldías.xlsx (secciones + encabezados)
+
+    columna_inicial desplaza la tabla a la derecha; con 1 (el valor por defecto,
+    como en el libro real) las columnas coinciden con los índices que lee
+    ExcelProcessor._extraer_seccion (nombre en iloc[2]).
+    """
+    rnd = random.Random(semilla)
+    filas: List[List] = [['PODER JUDICIAL DE LA CIUDAD DE MÉXICO'] + [None] * 7]
+
+    direccion_actual = None
+    for i in range(destinatarios):
+        if i % por_seccion == 0:
+            filas.append([rnd.choice(SECCIONES)] + [None] * 7)
+            filas.append(list(ENCABEZADO))
+
+        # Varias personas comparten edificio, como en el libro real
+        if direccion_actual is None or rnd.random() < 1 / por_edificio:
+            alcaldia = rnd.choice(ALCALDIAS)
+            direccion_actual = (
+                f"{rnd.choice(CALLES)} {rnd.randint(1, 1999)}, "
+                f"Colonia {rnd.choice(COLONIAS)},\nAlcaldía {alcaldia}, "
+                f"C.P. {rnd.randint(1000, 16999):05d}, Ciudad de México.",
+                alcaldia
+            )
+
+        nombre = (f"{rnd.choice(TITULOS)}{rnd.choice(NOMBRES)} "
+                  f"{rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}")
+        filas.append([
+            str(i % por_seccion + 1),
+            nombre,
+            f"Titular de la Unidad {rnd.randint(1, 500)}",
+            direccion_actual[0],
+            direccion_actual[1],
+            'True',
+            rnd.choice(['True', 'False']),
+            rnd.choice(['', '', 'CONFIRMÓ VÍA WEB', 'NO ASISTE'])
+        ])
+
+    if columna_inicial:
+        filas = [[None] * columna_inicial + fila for fila in filas]
+
+    pd.DataFrame(filas).to_excel(archivo, header=False, index=False)
+    return archivo
+
+
+def obtener_libro(destinatarios: int, carpeta_datos: str, semilla: int,
+                  columna_inicial: int = 1) -> str:
+    """Reutiliza libros ya generados para la misma semilla y tamaño"""
+    os.makedirs(carpeta_datos, exist_ok=True)
+    archivo = os.path.join(
+        carpeta_datos, f"sintetico_{destinatarios}_s{semilla}_c{columna_inicial}.xlsx"
+    )
+    if not os.path.exists(archivo):
+        logger.info(f"Generando libro sintético: {archivo}")
+        generar_libro_sintetico(destinatarios, archivo, semilla, columna_inicial=columna_inicial)
+    return archivo
+
+# =============================================================================
+# BACKEND DE GOOGLE SIMULADO
+# =============================================================================
+
+class _RespuestaSimulada:
+    def __init__(self, data: Dict):
+        self._data = data
+        self.status_code = 200
+
+    def json(self) -> Dict:
+        return self._data
+
+
+class BackendGoogleSimulado:
+    """Sustituye requests.get para Geocoding y Directions con respuestas deterministas"""
+
+    # Caja aproximada de la CDMX
+    LAT_MIN, LAT_MAX = 19.20, 19.58
+    LNG_MIN, LNG_MAX = -99.30, -98.96
+
+    def __init__(self, tasa_fallo: float = 0.03, latencia_ms: float = 0.0,
+                 puntos_por_tramo: int = 25):
+        self.tasa_fallo = tasa_fallo
+        self.latencia = latencia_ms / 1000
+        self.puntos_por_tramo = puntos_por_tramo
+        self.llamadas = {'geocode': 0, 'directions': 0}
+
+    def get(self, url: str, params: Optional[Dict] = None, timeout: float = None, **kwargs):
+        params = params or {}
+        if self.latencia:
+            time.sleep(self.latencia)
+        if 'geocode' in url:
+            self.llamadas['geocode'] += 1
+            return _RespuestaSimulada(self._geocode(params.get('address', '')))
+        if 'directions' in url:
+            self.llamadas['directions'] += 1
+            return _RespuestaSimulada(self._directions(params))
+        return _RespuestaSimulada({'status': 'REQUEST_DENIED', 'results': [], 'routes': []})
+
+    def _hash_unitario(self, texto: str) -> Tuple[float, float, float]:
+        digest = hashlib.md5(texto.encode('utf-8')).digest()
+        return tuple(int.from_bytes(digest[i:i + 4], 'big') / 2**32 for i in (0, 4, 8))
+
+    def _geocode(self, direccion: str) -> Dict:
+        u_lat, u_lng, u_fallo = self._hash_unitario(direccion)
+        if u_fallo < self.tasa_fallo:
+            return {'status': 'ZERO_RESULTS', 'results': []}
+        lat = self.LAT_MIN + u_lat * (self.LAT_MAX - self.LAT_MIN)
+        lng = self.LNG_MIN + u_lng * (self.LNG_MAX - self.LNG_MIN)
+        return {'status': 'OK', 'results': [{'geometry': {'location': {'lat': lat, 'lng': lng}}}]}
+
+    def _directions(self, params: Dict) -> Dict:
+        origen = tuple(map(float, params['origin'].split(',')))
+        waypoints = params.get('waypoints', '').split('|')
+        puntos = [tuple(map(float, w.split(','))) for w in waypoints if ',' in w]
+
+        # Orden por vecino más cercano, como aproximación del optimize:true
+        pendientes = list(range(len(puntos)))
+        orden, actual = [], origen
+        while pendientes:
+            siguiente = min(pendientes, key=lambda i: _haversine(actual, puntos[i]))
+            orden.append(siguiente)
+            pendientes.remove(siguiente)
+            actual = puntos[siguiente]
+
+        recorrido = [origen] + [puntos[i] for i in orden] + [origen]
+        legs, geometria = [], [origen]
+        for a, b in zip(recorrido, recorrido[1:]):
+            km = _haversine(a, b) * 1.3  # Factor de tortuosidad urbano
+            legs.append({
+                'distance': {'value': int(km * 1000)},
+                'duration': {'value': int(km / 25 * 3600)}  # 25 km/h promedio
+            })
+            for k in range(1, self.puntos_por_tramo + 1):
+                t = k / self.puntos_por_tramo
+                geometria.append((a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t))
+
+        return {
+            'status': 'OK',
+            'routes': [{
+                'waypoint_order': orden,
+                'legs': legs,
+                'overview_polyline': {'points': polyline.encode(geometria)}
+            }]
+        }
+
+
+def _haversine(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    lat1, lon1 = map(math.radians, a)
+    lat2, lon2 = map(math.radians, b)
+    h = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 6371 * 2 * math.asin(math.sqrt(h))
+
+# =============================================================================
+# EJECUCIÓN
+# =============================================================================
+
+@contextmanager
+def _directorio_trabajo(ruta: str):
+    anterior = os.getcwd()
+    os.chdir(ruta)
+    try:
+        yield ruta
+    finally:
+        os.chdir(anterior)
+
+
+def _cronometrar(tiempos: Dict[str, float], etapa: str, funcion, *args, **kwargs):
+    inicio = time.perf_counter()
+    resultado = funcion(*args, **kwargs)
+    tiempos[etapa] = time.perf_counter() - inicio
+    return resultado
+
+
+def metricas_rutas(rutas: List) -> Dict:
+    """Km totales y desbalance de carga entre rutas"""
+    if not rutas:
+        return {'rutas': 0}
+
+    personas = [r.total_personas for r in rutas]
+    distancias = [r.distancia_km for r in rutas]
+    media_personas = statistics.mean(personas)
+    media_km = statistics.mean(distancias)
+
+    return {
+        'rutas': len(rutas),
+        'edificios': sum(r.total_edificios for r in rutas),
+        'personas': sum(personas),
+        'km_totales': round(sum(distancias), 2),
+        'minutos_totales': round(sum(r.tiempo_min for r in rutas), 1),
+        'rutas_sin_optimizar': sum(1 for r in rutas if not r.polyline),
+        # Desbalance: máximo sobre promedio y coeficiente de variación
+        'desbalance_personas': round(max(personas) / media_personas, 3) if media_personas else 0,
+        'cv_personas': round(statistics.pstdev(personas) / media_personas, 3) if media_personas else 0,
+        'desbalance_km': round(max(distancias) / media_km, 3) if media_km else 0,
+        'cv_km': round(statistics.pstdev(distancias) / media_km, 3) if media_km else 0,
+    }
+
+
+def registros_validos(df: pd.DataFrame) -> int:
+    """Destinatarios leídos con número y dirección en las columnas esperadas"""
+    numero = df['numero'].astype(str).str.strip().str.isdigit()
+    direccion = df['direccion'].astype(str).str.contains('Ciudad de México', regex=False)
+    return int((numero & direccion).sum())
+
+
+def ejecutar_corrida(archivo: str, backend: BackendGoogleSimulado,
+                     procesos: Optional[int] = None) -> Dict:
+    """Ejecuta el pipeline completo en un directorio temporal limpio"""
+    tiempos: Dict[str, float] = {}
+    trabajo = tempfile.mkdtemp(prefix="bench_rutas_")
+
+    try:
+        with _directorio_trabajo(trabajo), mock.patch.object(sistema, 'requests', backend):
+            def _procesar():
+                return sistema.ExcelProcessor(archivo).procesar()
+
+            df = _cronometrar(tiempos, 'procesar', _procesar)
+
+            generator = sistema.RouteGenerator(
+                df=df,
+                api_key="BENCHMARK",
+                origen_coords=sistema.CONFIG.ORIGEN_COORDS,
+                origen_nombre=sistema.CONFIG.ORIGEN_NOMBRE
+            )
+            edificios_por_zona = _cronometrar(tiempos, 'agrupar_edificios', generator.agrupar_edificios)
+            rutas = _cronometrar(tiempos, 'crear_rutas', generator.crear_rutas, edificios_por_zona)
+
+            def _exportar():
+                file_gen = sistema.FileGenerator()
+                file_gen.exportar_rutas(rutas, procesos=procesos)
+                if sistema.CONFIG.EXCEL_MODO != "libro_unico":
+                    file_gen.generar_resumen(rutas)
+
+            _cronometrar(tiempos, 'file_generator', _exportar)
+
+            bytes_salida = sum(
+                os.path.getsize(os.path.join(d, f))
+                for d, _, archivos in os.walk('.') for f in archivos
+            )
+    finally:
+        shutil.rmtree(trabajo, ignore_errors=True)
+
+    tiempos['total'] = sum(tiempos.values())
+    return {
+        'tiempos': tiempos,
+        'metricas': metricas_rutas(rutas),
+        'registros': len(df),
+        'registros_validos': registros_validos(df),
+        'bytes_salida': bytes_salida,
+        'geocoder': dict(generator.geocoder.stats)
+    }
+
+
+def ejecutar_benchmark(tamanos: List[int], repeticiones: int, semilla: int,
+                       carpeta_datos: str, latencia_ms: float, tasa_fallo: float,
+                       columna_inicial: int = 1, procesos: Optional[int] = None) -> Dict:
+    resultados = {}
+
+    for tamano in tamanos:
+        archivo = obtener_libro(tamano, carpeta_datos, semilla, columna_inicial)
+        corridas = []
+        for n in range(repeticiones):
+            backend = BackendGoogleSimulado(tasa_fallo=tasa_fallo, latencia_ms=latencia_ms)
+            corrida = ejecutar_corrida(archivo, backend, procesos)
+            if corrida['registros_validos'] < tamano * MIN_FRACCION_LEIDOS:
+                raise RuntimeError(
+                    f"ExcelProcessor leyó bien {corrida['registros_validos']} de {tamano} "
+                    f"destinatarios de {archivo}; revise --columna-inicial (el parser espera 1)"
+                )
+            corrida['llamadas_api'] = dict(backend.llamadas)
+            corridas.append(corrida)
+            logger.info(f"[{tamano}] corrida {n + 1}/{repeticiones}: "
+                        f"{corrida['tiempos']['total']:.2f}s")
+
+        etapas = corridas[0]['tiempos'].keys()
+        resultados[str(tamano)] = {
+            'etapas': {
+                etapa: {
+                    'mediana_s': round(statistics.median(c['tiempos'][etapa] for c in corridas), 4),
+                    'min_s': round(min(c['tiempos'][etapa] for c in corridas), 4),
+                    'muestras_s': [round(c['tiempos'][etapa], 4) for c in corridas]
+                }
+                for etapa in etapas
+            },
+            'metricas': corridas[-1]['metricas'],
+            'registros': corridas[-1]['registros'],
+            'bytes_salida': corridas[-1]['bytes_salida'],
+            'geocoder': corridas[-1]['geocoder'],
+            'llamadas_api': corridas[-1]['llamadas_api']
+        }
+
+    return resultados
+
+
+def _commit_actual() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ_REPO, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "desconocido"
+
+
+def comparar(base: Dict, actual: Dict) -> List[str]:
+    """Compara medianas por etapa entre dos archivos de resultados"""
+    lineas = [f"Base {base.get('commit')} → Actual {actual.get('commit')}"]
+    for tamano, datos in actual['resultados'].items():
+        previo = base['resultados'].get(tamano)
+        if not previo:
+            continue
+        lineas.append(f"  {tamano} destinatarios:")
+        for etapa, valores in datos['etapas'].items():
+            antes = previo['etapas'].get(etapa, {}).get('mediana_s')
+            ahora = valores['mediana_s']
+            if antes:
+                cambio = (ahora - antes) / antes * 100
+                lineas.append(f"    {etapa:<18} {antes:>9.3f}s → {ahora:>9.3f}s ({cambio:+.1f}%)")
+        for metrica in ('km_totales', 'desbalance_personas', 'cv_km'):
+            antes = previo['metricas'].get(metrica)
+            ahora = datos['metricas'].get(metrica)
+            if antes is not None and ahora is not None and antes != ahora:
+                lineas.append(f"    {metrica:<18} {antes} → {ahora}")
+    return lineas
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark del generador de rutas")
+    parser.add_argument('--tamanos', type=int, nargs='+', default=TAMANOS_DEFAULT,
+                        help="Número de destinatarios por libro (ej. 1000 10000 100000)")
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--datos', default=os.path.join(RAIZ_REPO, 'benchmarks', 'datos'),
+                        help="Carpeta donde se guardan los libros sintéticos")
+    parser.add_argument('--latencia-ms', type=float, default=0.0,
+                        help="Latencia simulada por llamada a Google")
+    parser.add_argument('--tasa-fallo', type=float, default=0.03,
+                        help="Fracción de direcciones que el geocoder no resuelve")
+    parser.add_argument('--columna-inicial', type=int, default=1,
+                        help="Desplaza la tabla sintética N columnas a la derecha "
+                             "(1 = diseño de Alcaldías.xlsx que espera ExcelProcessor)")
+    parser.add_argument('--procesos', type=int, default=None,
+                        help="Procesos para la exportación (por defecto, uno por núcleo)")
+    parser.add_argument('--excel-modo', choices=['por_ruta', 'libro_unico'],
+                        default=sistema.CONFIG.EXCEL_MODO)
+    parser.add_argument('--mapa-modo', choices=['combinado', 'por_ruta'],
+                        default=sistema.CONFIG.MAPA_MODO)
+    parser.add_argument('--tolerancia-m', type=float, default=sistema.CONFIG.TOLERANCIA_POLILINEA_M,
+                        help="Tolerancia Douglas–Peucker de los mapas (0 = sin simplificar)")
+    parser.add_argument('--con-pausa', action='store_true',
+                        help="Conserva la pausa de rate limiting del geocoder")
+    parser.add_argument('--salida', default='bench_resultados.json')
+    parser.add_argument('--comparar', help="Archivo de resultados base para comparar")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sistema.logger.setLevel(logging.WARNING)
+    sistema.CONFIG.EXCEL_MODO = args.excel_modo
+    sistema.CONFIG.MAPA_MODO = args.mapa_modo
+    sistema.CONFIG.TOLERANCIA_POLILINEA_M = args.tolerancia_m
+    if not args.con_pausa:
+        sistema.CONFIG.PAUSA_GEOCODE = 0
+
+    resultados = ejecutar_benchmark(
+        args.tamanos, args.repeticiones, args.semilla,
+        args.datos, args.latencia_ms, args.tasa_fallo, args.columna_inicial, args.procesos
+    )
+
+    reporte = {
+        'esquema': ESQUEMA_RESULTADOS,
+        'commit': _commit_actual(),
+        'fecha': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'parametros': {
+            'repeticiones': args.repeticiones,
+            'semilla': args.semilla,
+            'latencia_ms': args.latencia_ms,
+            'tasa_fallo': args.tasa_fallo,
+            'columna_inicial': args.columna_inicial,
+            'procesos': args.procesos or os.cpu_count(),
+            'excel_modo': args.excel_modo,
+            'mapa_modo': args.mapa_modo,
+            'tolerancia_polilinea_m': args.tolerancia_m,
+            'pausa_geocode': sistema.CONFIG.PAUSA_GEOCODE,
+            'max_edificios_por_ruta': sistema.CONFIG.MAX_EDIFICIOS_POR_RUTA
+        },
+        'resultados': resultados
+    }
+
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(reporte, f, indent=2, ensure_ascii=False)
+    logger.info(f"Resultados guardados: {args.salida}")
+
+    for tamano, datos in resultados.items():
+        etapas = ", ".join(f"{e}={v['mediana_s']:.3f}s" for e, v in datos['etapas'].items())
+        logger.info(f"[{tamano}] {etapas}")
+        logger.info(f"[{tamano}] km={datos['metricas'].get('km_totales')} "
+                    f"desbalance={datos['metricas'].get('desbalance_personas')}")
+
+    if args.comparar:
+        with open(args.comparar, 'r', encoding='utf-8') as f:
+            base = json.load(f)
+        for linea in comparar(base, reporte):
+            print(linea)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,15 +13,26 @@ import telebot
 import sqlite3
 import json
 import requests
-import urllib.parse
 from telebot import types
 from datetime import datetime
-from flask import Flask, request, jsonify
-import re
+from flask import Flask, Response, request, jsonify
 import logging
-from typing import Dict, List, Optional, Any
-from dataclasses import dataclass
+import threading
+import time
+from typing import Dict, List, Optional, Any, Tuple
+from dataclasses import dataclass, field
 from functools import lru_cache
+from contextlib import contextmanager
+
+import formato_rutas
+import url_maps
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # Sin watchdog las rutas se cargan solo al iniciar o por la API
+    Observer = None
+    FileSystemEventHandler = object
 
 # =============================================================================
 # CONFIGURACIÓN
@@ -45,7 +56,22 @@ class Config:
     ORIGEN_FIJO = "TSJCDMX - Niños Héroes 150, Doctores, Ciudad de México"
     CARPETA_RUTAS = "rutas_telegram"
     CARPETA_FOTOS = "carpeta_fotos_central"
+    AVANCES_LIMITE = 100  # Página por defecto de /api/avances
+    AVANCES_LIMITE_MAX = 500
+    TIPOS_AVANCE = ('entrega', 'incidente')  # Lo que consume /api/avances
+    TIPOS_STREAM = ('entrega', 'incidente', 'ubicacion')  # Lo que emite /api/eventos/stream
+    STREAM_LATIDO_S = 15  # Comentario de keep-alive si no hay eventos
+    STREAM_SONDEO_S = 1.0  # Revisión de la base (eventos registrados por otro worker)
+    STREAM_DURACION_MAX_S = 300  # Luego se cierra; el cliente reconecta con Last-Event-ID
+    STREAM_RETRY_MS = 3000
     DB_PATH = '/tmp/incidentes.db'
+    STORE_TIMEOUT_S = 5.0  # Espera máxima por el candado de escritura entre workers
+    DB_CACHE_KIB = 8192  # Caché de páginas por conexión (PRAGMA cache_size)
+    DB_SENTENCIAS = 128  # Sentencias preparadas que reutiliza cada conexión
+    VIGILANTE_DEBOUNCE_S = 0.5  # Silencio en rutas_telegram antes de aplicar cambios
+    ASIGNACION_LEASE_S = 10 * 3600  # Sin actividad del repartidor, la ruta vuelve a quedar libre
+    # Zonas que se reparten primero (ZONAS_PRIORITARIAS=CENTRO,NORTE); el resto después
+    ZONAS_PRIORITARIAS = tuple(z.strip() for z in os.environ.get('ZONAS_PRIORITARIAS', '').split(',') if z.strip())
     TIMEOUT_API = 10
     MAX_DIRECCIONES_URL = 8  # Google Maps tiene límite de waypoints
 
@@ -55,15 +81,45 @@ CONFIG = Config()
 # BASE DE DATOS
 # =============================================================================
 
+def conectar_sqlite(db_path: str) -> sqlite3.Connection:
+    """Conexión en autocommit con los pragmas del bot
+    
+    - WAL: las lecturas no bloquean a la escritura ni al revés
+    - synchronous=NORMAL: en WAL solo sincroniza en los checkpoints; un
+      corte de luz puede perder la última transacción, nunca corromper
+    - cache_size y sentencias preparadas reutilizadas por conexión
+    """
+    conn = sqlite3.connect(db_path, timeout=CONFIG.STORE_TIMEOUT_S, isolation_level=None,
+                           cached_statements=CONFIG.DB_SENTENCIAS)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{int(CONFIG.DB_CACHE_KIB)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
 class Database:
-    """Manejador de base de datos SQLite"""
+    """Manejador de base de datos SQLite (una conexión por hilo, modo WAL)
     
-    def __init__(self):
-        self.conn = sqlite3.connect(CONFIG.DB_PATH, check_same_thread=False)
+    Cada escritura es una sola sentencia en autocommit; con WAL y los
+    índices por usuario el costo de insertar no crece con el historial.
+    """
+    
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or CONFIG.DB_PATH
+        self._local = threading.local()  # Una conexión por hilo
+        self._aviso = threading.Condition()  # Despierta a los streams de este proceso
         self._crear_tablas()
     
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = conectar_sqlite(self.db_path)
+        return conn
+    
     def _crear_tablas(self):
         cursor = self.conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS fotos (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -77,14 +133,6 @@ class Database:
         )
         ''')
         
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS rutas_asignadas (
-            user_id INTEGER PRIMARY KEY,
-            ruta_id INTEGER,
-            fecha_asignacion DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS ubicaciones (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -95,7 +143,39 @@ class Database:
         )
         ''')
         
-        self.conn.commit()
+        # Avances de entrega; seq es el cursor monotónico que consume el escritorio
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS eventos (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT,
+            ruta_id INTEGER,
+            user_id INTEGER,
+            repartidor TEXT,
+            persona_entregada TEXT,
+            foto_local TEXT,
+            file_id TEXT,
+            datos TEXT,
+            procesado INTEGER DEFAULT 0,
+            procesado_en DATETIME,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # Respuestas ya dadas por clave de idempotencia (reintentos del outbox)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotencia (
+            clave TEXT PRIMARY KEY,
+            endpoint TEXT,
+            respuesta TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # Consultas por repartidor sin recorrer todo el historial
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ubicaciones_usuario ON ubicaciones(user_id, timestamp)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fotos_usuario ON fotos(user_id, tipo)")
+        
+        cursor.execute("COMMIT")
     
     def guardar_foto(self, file_id: str, user_id: int, user_name: str, 
                      caption: str, tipo: str, ruta_local: str) -> bool:
@@ -105,7 +185,6 @@ class Database:
                 "INSERT OR IGNORE INTO fotos (file_id, user_id, user_name, caption, tipo, ruta_local) VALUES (?, ?, ?, ?, ?, ?)",
                 (file_id, user_id, user_name, caption, tipo, ruta_local)
             )
-            self.conn.commit()
             return True
         except Exception as e:
             logger.error(f"Error guardando foto: {e}")
@@ -118,12 +197,111 @@ class Database:
                 "INSERT INTO ubicaciones (user_id, latitud, longitud) VALUES (?, ?, ?)",
                 (user_id, latitud, longitud)
             )
-            self.conn.commit()
             return True
         except Exception as e:
             logger.error(f"Error guardando ubicación: {e}")
             return False
     
+    def registrar_evento(self, tipo: str, ruta_id: Optional[int], user_id: int, repartidor: str,
+                         persona_entregada: str = "", foto_local: str = "", file_id: str = "",
+                         datos: Optional[Dict] = None) -> Optional[int]:
+        """Registra un avance de entrega; retorna su seq"""
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "INSERT INTO eventos (tipo, ruta_id, user_id, repartidor, persona_entregada, "
+                "foto_local, file_id, datos, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (tipo, ruta_id, user_id, repartidor, persona_entregada, foto_local, file_id,
+                 json.dumps(datos or {}, ensure_ascii=False), datetime.now().isoformat())
+            )
+            with self._aviso:
+                self._aviso.notify_all()
+            return cursor.lastrowid
+        except Exception as e:
+            logger.error(f"Error registrando evento: {e}")
+            return None
+    
+    @staticmethod
+    def _evento_a_dict(fila) -> Dict:
+        seq, tipo, ruta_id, user_id, repartidor, persona, foto, file_id, datos, procesado, timestamp = fila
+        return {
+            'seq': seq,
+            'id': seq,
+            'tipo': tipo,
+            'ruta_id': ruta_id,
+            'user_id': user_id,
+            'repartidor': repartidor,
+            'persona_entregada': persona,
+            'foto_local': foto,
+            'file_id': file_id,
+            'datos': json.loads(datos) if datos else {},
+            'procesado': bool(procesado),
+            'timestamp': timestamp
+        }
+    
+    def eventos_desde(self, since: int = 0, limit: int = 100, solo_pendientes: bool = False,
+                      tipos: Optional[List[str]] = None) -> List[Dict]:
+        """Eventos con seq > since, en orden; opcionalmente solo de ciertos tipos"""
+        filtro_tipos = f"AND tipo IN ({', '.join('?' * len(tipos))}) " if tipos else ""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT seq, tipo, ruta_id, user_id, repartidor, persona_entregada, foto_local, file_id, "
+            "datos, procesado, timestamp FROM eventos WHERE seq > ? "
+            + ("AND procesado = 0 " if solo_pendientes else "")
+            + filtro_tipos
+            + "ORDER BY seq LIMIT ?",
+            (since, *(tipos or ()), limit)
+        )
+        return [self._evento_a_dict(f) for f in cursor.fetchall()]
+    
+    def ultimo_seq(self) -> int:
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM eventos")
+        return cursor.fetchone()[0]
+    
+    def esperar_evento(self, despues_de: int, timeout: float) -> bool:
+        """Espera hasta timeout a que exista un evento con seq > despues_de
+        
+        El aviso despierta al instante si el evento se registró en este
+        proceso; los de otros workers se ven al vencer el timeout.
+        """
+        with self._aviso:
+            self._aviso.wait(timeout)
+        return self.ultimo_seq() > despues_de
+    
+    def marcar_eventos_procesados(self, seqs: List[int]) -> int:
+        if not seqs:
+            return 0
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN")  # Un solo commit para todo el lote
+        try:
+            cursor.executemany(
+                "UPDATE eventos SET procesado = 1, procesado_en = CURRENT_TIMESTAMP WHERE seq = ? AND procesado = 0",
+                [(int(s),) for s in seqs]
+            )
+            marcados = cursor.rowcount
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        return marcados
+    
+    def respuesta_idempotente(self, clave: str) -> Optional[Dict]:
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT respuesta FROM idempotencia WHERE clave = ?", (clave,))
+        fila = cursor.fetchone()
+        return json.loads(fila[0]) if fila else None
+    
+    def guardar_respuesta_idempotente(self, clave: str, endpoint: str, respuesta: Dict):
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO idempotencia (clave, endpoint, respuesta) VALUES (?, ?, ?)",
+                (clave, endpoint, json.dumps(respuesta, ensure_ascii=False))
+            )
+        except Exception as e:
+            logger.error(f"Error guardando clave de idempotencia: {e}")
+    
     def obtener_estadisticas(self) -> Dict:
         cursor = self.conn.cursor()
         cursor.execute("SELECT COUNT(*) FROM fotos")
@@ -148,6 +326,7 @@ class Ruta:
     origen: str
     paradas: List[Dict]
     google_maps_url: Optional[str] = None
+    version: int = field(default=0, compare=False)  # Versión del almacén en que se guardó
     
     @property
     def total_paradas(self) -> int:
@@ -157,61 +336,461 @@ class Ruta:
     def total_personas(self) -> int:
         return sum(p.get('total_personas', 1) for p in self.paradas)
 
+class IndiceRutas:
+    """Copia de lectura indexada del almacén
+    
+    - por_id: ruta_id → Ruta
+    - por_zona: zona → ruta_ids
+    - asignadas / ocupantes: user_id → ruta_id y ruta_id → usuarios
+    - libres: rutas sin repartidor
+    
+    Buscar, asignar y liberar cuestan O(1) sin importar el tamaño del plan.
+    La elección de qué ruta libre asignar la hace RouteStore.reclamar.
+    Un índice publicado no se modifica: los cambios se hacen sobre una
+    copia (con_rutas / con_asignaciones) que luego se intercambia.
+    """
+    
+    def __init__(self, version: int, rutas: List[Ruta], asignadas: Dict[int, int]):
+        self.version = version
+        self.lista: List[Ruta] = list(rutas)
+        self.por_id: Dict[int, Ruta] = {r.id: r for r in self.lista}
+        self.por_zona: Dict[str, List[int]] = {}
+        for ruta in self.lista:
+            self.por_zona.setdefault(ruta.zona, []).append(ruta.id)
+        
+        self.asignadas: Dict[int, int] = {}
+        self.ocupantes: Dict[int, int] = {}
+        self._libres = set(self.por_id)
+        for user_id, ruta_id in asignadas.items():
+            self.asignadas[user_id] = ruta_id
+            self.ocupantes[ruta_id] = self.ocupantes.get(ruta_id, 0) + 1
+            self._libres.discard(ruta_id)
+    
+    def asignar(self, user_id: int, ruta_id: int):
+        previa = self.asignadas.get(user_id)
+        if previa is not None:
+            self._desocupar(previa)
+        self.asignadas[user_id] = ruta_id
+        self.ocupantes[ruta_id] = self.ocupantes.get(ruta_id, 0) + 1
+        self._libres.discard(ruta_id)
+    
+    def liberar(self, user_id: int):
+        ruta_id = self.asignadas.pop(user_id, None)
+        if ruta_id is not None:
+            self._desocupar(ruta_id)
+    
+    def _desocupar(self, ruta_id: int):
+        restantes = self.ocupantes.get(ruta_id, 0) - 1
+        if restantes > 0:
+            self.ocupantes[ruta_id] = restantes
+            return
+        self.ocupantes.pop(ruta_id, None)
+        if ruta_id in self.por_id:
+            self._libres.add(ruta_id)
+    
+    @property
+    def total_libres(self) -> int:
+        return len(self._libres)
+    
+    def con_asignaciones(self, version: int, asignar: Optional[Dict[int, int]] = None,
+                         liberar: List[int] = ()) -> 'IndiceRutas':
+        """Copia con usuarios liberados y asignados (el original no cambia)
+        
+        Las rutas se comparten con el original; solo se copian las
+        estructuras de asignación, que son las que cambian.
+        """
+        copia = object.__new__(IndiceRutas)
+        copia.version = version
+        copia.lista, copia.por_id, copia.por_zona = self.lista, self.por_id, self.por_zona
+        copia.asignadas = dict(self.asignadas)
+        copia.ocupantes = dict(self.ocupantes)
+        copia._libres = set(self._libres)
+        for user_id in liberar:
+            copia.liberar(user_id)
+        for user_id, ruta_id in (asignar or {}).items():
+            copia.asignar(user_id, ruta_id)
+        return copia
+    
+    def con_rutas(self, version: int, rutas: List[Ruta] = (), quitar: List[int] = ()) -> 'IndiceRutas':
+        """Copia con rutas agregadas/reemplazadas y quitadas (el original no cambia)"""
+        por_id = dict(self.por_id)
+        for ruta in rutas:
+            por_id[ruta.id] = ruta
+        for ruta_id in quitar:
+            por_id.pop(ruta_id, None)
+        asignadas = {u: r for u, r in self.asignadas.items() if r in por_id}
+        return IndiceRutas(version, sorted(por_id.values(), key=lambda r: r.id), asignadas)
+
+class RouteStore:
+    """Rutas y asignaciones en SQLite (modo WAL), compartidas por todos los workers
+    
+    Cada escritura que cambia rutas o asignaciones incrementa meta.version
+    dentro de la misma transacción (renovar un lease no cuenta). Cada
+    proceso guarda una copia de lectura indexada (IndiceRutas) y solo la
+    reconstruye cuando la versión cambió por otro proceso; sus propias
+    escrituras las aplica a una copia del índice que intercambia.
+    
+    Las asignaciones son leases: reclamar() toma una ruta libre en una sola
+    transacción (atómica entre hilos y workers) y la actividad del
+    repartidor renueva el lease; al vencer, la ruta vuelve a estar libre.
+    """
+    
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or CONFIG.DB_PATH
+        self._local = threading.local()  # Una conexión por hilo
+        self._lock = threading.Lock()
+        self._indice = IndiceRutas(-1, [], {})
+        self._crear_tablas()
+    
+    def _conexion(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit: las transacciones se abren explícitamente
+            conn = self._local.conn = conectar_sqlite(self.db_path)
+        return conn
+    
+    @contextmanager
+    def _escritura(self):
+        """Transacción de escritura (BEGIN IMMEDIATE) que incrementa la versión
+        
+        BEGIN IMMEDIATE toma el candado de escritura al inicio: dos reclamos
+        simultáneos se ordenan en vez de leer el mismo estado. Las
+        transacciones son de milisegundos; las lecturas no esperan (WAL).
+        Si el bloque llama a _sin_cambio_de_indice() la versión no cambia y
+        los demás workers conservan su índice.
+        """
+        conn = self._conexion()
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.versionar = True
+        try:
+            yield conn
+            if self._local.versionar:
+                conn.execute("UPDATE meta SET valor = valor + 1 WHERE clave = 'version'")
+            self._local.version = conn.execute("SELECT valor FROM meta WHERE clave = 'version'").fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def _sin_cambio_de_indice(self):
+        """Dentro de _escritura: lo escrito no afecta rutas ni asignaciones"""
+        self._local.versionar = False
+    
+    def _crear_tablas(self):
+        conn = self._conexion()
+        conn.executescript('''
+        BEGIN IMMEDIATE;
+        CREATE TABLE IF NOT EXISTS rutas (
+            id INTEGER PRIMARY KEY,
+            zona TEXT,
+            origen TEXT,
+            paradas TEXT,
+            google_maps_url TEXT,
+            total_personas INTEGER DEFAULT 0,
+            version INTEGER DEFAULT 0,
+            actualizado DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_rutas_zona ON rutas(zona);
+        CREATE TABLE IF NOT EXISTS rutas_asignadas (
+            user_id INTEGER PRIMARY KEY,
+            ruta_id INTEGER,
+            fecha_asignacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+            lease_hasta REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_asignadas_ruta ON rutas_asignadas(ruta_id);
+        CREATE TABLE IF NOT EXISTS repartidores (
+            user_id INTEGER PRIMARY KEY,
+            ultima_zona TEXT
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            clave TEXT PRIMARY KEY,
+            valor INTEGER
+        );
+        INSERT OR IGNORE INTO meta (clave, valor) VALUES ('version', 0);
+        COMMIT;
+        ''')
+        
+        # Bases creadas antes de estas columnas; con el candado tomado, dos
+        # workers que arrancan juntos no intentan el mismo ALTER
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for tabla, columna, tipo in (('rutas', 'total_personas', 'INTEGER DEFAULT 0'),
+                                         ('rutas', 'version', 'INTEGER DEFAULT 0'),
+                                         ('rutas_asignadas', 'lease_hasta', 'REAL')):
+                if columna not in {fila[1] for fila in conn.execute(f"PRAGMA table_info({tabla})")}:
+                    conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_rutas_prioridad ON rutas(zona, total_personas)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_asignadas_lease ON rutas_asignadas(lease_hasta)")
+            conn.execute("UPDATE rutas_asignadas SET lease_hasta = ? WHERE lease_hasta IS NULL",
+                         (time.time() + CONFIG.ASIGNACION_LEASE_S,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def version(self) -> int:
+        return self._conexion().execute("SELECT valor FROM meta WHERE clave = 'version'").fetchone()[0]
+    
+    def indice(self) -> IndiceRutas:
+        """Índice vigente; se reconstruye si otro proceso cambió el almacén"""
+        if self.version() == self._indice.version:
+            return self._indice
+        with self._lock:
+            conn = self._conexion()
+            # Lectura en una sola transacción: versión y datos del mismo instante
+            conn.execute("BEGIN")
+            try:
+                version = conn.execute("SELECT valor FROM meta WHERE clave = 'version'").fetchone()[0]
+                if version == self._indice.version:
+                    return self._indice
+                filas = conn.execute(
+                    "SELECT id, zona, origen, paradas, google_maps_url, version FROM rutas ORDER BY id"
+                ).fetchall()
+                asignadas = conn.execute("SELECT user_id, ruta_id FROM rutas_asignadas").fetchall()
+            finally:
+                conn.execute("COMMIT")
+            
+            rutas = [Ruta(id=i, zona=z, origen=o, paradas=json.loads(p), google_maps_url=u, version=v)
+                     for i, z, o, p, u, v in filas]
+            self._indice = IndiceRutas(version, rutas, dict(asignadas))
+            return self._indice
+    
+    def _aplicar_local(self, asignar: Optional[Dict[int, int]] = None, liberar: List[int] = ()):
+        """Aplica la escritura recién hecha si nadie más escribió entre medio
+        
+        Como en guardar_rutas, se arma una copia y se intercambia la
+        referencia: quien esté leyendo el índice anterior no lo ve a medias.
+        """
+        with self._lock:
+            if self._indice.version == self._local.version - 1:
+                self._indice = self._indice.con_asignaciones(self._local.version, asignar, liberar)
+    
+    def rutas(self) -> List[Ruta]:
+        """Rutas vigentes (copia de lectura compartida; no modificar)"""
+        return self.indice().lista
+    
+    def asignaciones(self) -> Dict[int, int]:
+        """user_id → ruta_id (copia de lectura compartida; no modificar)"""
+        return self.indice().asignadas
+    
+    @staticmethod
+    def _filas(conn: sqlite3.Connection, rutas: List[Ruta]) -> List[tuple]:
+        """Filas para INSERT; cada ruta queda con la versión que tendrá el almacén al confirmar"""
+        version = conn.execute("SELECT valor FROM meta WHERE clave = 'version'").fetchone()[0] + 1
+        filas = []
+        for ruta in rutas:
+            ruta.version = version
+            filas.append((ruta.id, ruta.zona, ruta.origen, json.dumps(ruta.paradas, ensure_ascii=False),
+                          ruta.google_maps_url, ruta.total_personas, version))
+        return filas
+    
+    def guardar_rutas(self, rutas: List[Ruta]):
+        """Inserta o reemplaza rutas
+        
+        El índice local no se modifica en sitio: se arma una copia con las
+        rutas nuevas y se intercambia la referencia, así los handlers que
+        están leyendo nunca ven un índice a medio construir.
+        """
+        with self._escritura() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO rutas (id, zona, origen, paradas, google_maps_url, total_personas, version) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._filas(conn, rutas)
+            )
+        version = self._local.version
+        with self._lock:
+            if self._indice.version == version - 1:
+                self._indice = self._indice.con_rutas(version, rutas)
+    
+    def reemplazar_rutas(self, rutas: List[Ruta]):
+        """Deja exactamente estas rutas; las asignaciones a rutas que ya no existen se borran"""
+        with self._escritura() as conn:
+            conn.execute("DELETE FROM rutas")
+            conn.executemany(
+                "INSERT INTO rutas (id, zona, origen, paradas, google_maps_url, total_personas, version) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._filas(conn, rutas)
+            )
+            conn.execute("DELETE FROM rutas_asignadas WHERE ruta_id NOT IN (SELECT id FROM rutas)")
+    
+    def eliminar_rutas(self, ruta_ids: List[int]):
+        """Quita rutas y sus asignaciones (copia e intercambio del índice, como guardar_rutas)"""
+        with self._escritura() as conn:
+            conn.executemany("DELETE FROM rutas WHERE id = ?", [(i,) for i in ruta_ids])
+            conn.executemany("DELETE FROM rutas_asignadas WHERE ruta_id = ?", [(i,) for i in ruta_ids])
+        version = self._local.version
+        with self._lock:
+            if self._indice.version == version - 1:
+                self._indice = self._indice.con_rutas(version, quitar=ruta_ids)
+    
+    def reclamar(self, user_id: int) -> Optional[int]:
+        """Asigna al usuario la mejor ruta libre; retorna su id o None si no hay
+        
+        Todo ocurre en una transacción: se liberan los leases vencidos, se
+        renueva la ruta que el usuario ya tenga y, si no tiene, se toma una
+        ruta sin lease vigente. Orden: la zona de su ruta anterior, luego
+        CONFIG.ZONAS_PRIORITARIAS, luego las rutas con más personas.
+        """
+        ahora = time.time()
+        lease = ahora + CONFIG.ASIGNACION_LEASE_S
+        zonas = CONFIG.ZONAS_PRIORITARIAS
+        rango_zona = ("CASE r.zona " + " ".join("WHEN ? THEN ?" for _ in zonas)
+                      + f" ELSE {len(zonas)} END, ") if zonas else ""
+        
+        ruta_id, asignada = None, False
+        with self._escritura() as conn:
+            vencidas = [u for (u,) in conn.execute(
+                "SELECT user_id FROM rutas_asignadas WHERE lease_hasta < ?", (ahora,))]
+            if vencidas:
+                conn.executemany("DELETE FROM rutas_asignadas WHERE user_id = ?", [(u,) for u in vencidas])
+            fila = conn.execute("SELECT ruta_id FROM rutas_asignadas WHERE user_id = ?", (user_id,)).fetchone()
+            if fila:
+                # Renovar el lease no cambia el índice
+                conn.execute("UPDATE rutas_asignadas SET lease_hasta = ? WHERE user_id = ?", (lease, user_id))
+                ruta_id = fila[0]
+            else:
+                fila = conn.execute(
+                    f"""SELECT r.id, r.zona FROM rutas r
+                        WHERE NOT EXISTS (SELECT 1 FROM rutas_asignadas a WHERE a.ruta_id = r.id)
+                        ORDER BY (r.zona = (SELECT ultima_zona FROM repartidores WHERE user_id = ?)) DESC,
+                                 {rango_zona}r.total_personas DESC, r.id
+                        LIMIT 1""",
+                    (user_id, *[v for i, z in enumerate(zonas) for v in (z, i)])
+                ).fetchone()
+                if fila:
+                    ruta_id, zona = fila
+                    asignada = True
+                    conn.execute("INSERT INTO rutas_asignadas (user_id, ruta_id, lease_hasta) VALUES (?, ?, ?)",
+                                 (user_id, ruta_id, lease))
+                    conn.execute("INSERT OR REPLACE INTO repartidores (user_id, ultima_zona) VALUES (?, ?)",
+                                 (user_id, zona))
+            if not vencidas and not asignada:
+                self._sin_cambio_de_indice()
+        
+        if vencidas or asignada:
+            self._aplicar_local({user_id: ruta_id} if asignada else None, vencidas)
+        return ruta_id
+    
+    def renovar(self, user_id: int):
+        """Extiende el lease del repartidor activo
+        
+        Sin transacción ni cambio de versión (el lease no está en el índice);
+        solo escribe si ya pasó la mitad del lease.
+        """
+        ahora = time.time()
+        self._conexion().execute(
+            "UPDATE rutas_asignadas SET lease_hasta = ? WHERE user_id = ? AND lease_hasta < ?",
+            (ahora + CONFIG.ASIGNACION_LEASE_S, user_id, ahora + CONFIG.ASIGNACION_LEASE_S / 2)
+        )
+    
+    def liberar(self, user_id: int) -> bool:
+        with self._escritura() as conn:
+            liberada = conn.execute("DELETE FROM rutas_asignadas WHERE user_id = ?", (user_id,)).rowcount > 0
+            if not liberada:
+                self._sin_cambio_de_indice()
+        if liberada:
+            self._aplicar_local(liberar=[user_id])
+        return liberada
+
 class RouteManager:
-    """Gestor de rutas - Carga y procesamiento"""
+    """Gestor de rutas - Carga y procesamiento
+    
+    Las rutas y asignaciones viven en RouteStore, así que todos los workers
+    de gunicorn ven lo mismo; los archivos de rutas_telegram son la fuente
+    que se sincroniza al almacén.
+    """
     
     def __init__(self):
-        self.rutas_disponibles: List[Ruta] = []
-        self.rutas_asignadas: Dict[int, int] = {}  # user_id -> ruta_id
         self.db = Database()
+        self.store = RouteStore()
+        # Qué archivo de rutas_telegram aporta cada ruta (para cambios incrementales)
+        self._origen: Dict[int, str] = {}
+        self._ids_por_archivo: Dict[str, set] = {}
+        self._lock_archivos = threading.Lock()
         self._cargar_rutas()
     
+    @property
+    def rutas_disponibles(self) -> List[Ruta]:
+        return self.store.rutas()
+    
+    @property
+    def rutas_asignadas(self) -> Dict[int, int]:
+        """user_id -> ruta_id"""
+        return self.store.asignaciones()
+    
+    def ruta(self, ruta_id: int) -> Optional[Ruta]:
+        return self.store.indice().por_id.get(ruta_id)
+    
+    def ruta_de_usuario(self, user_id: int) -> Optional[Ruta]:
+        indice = self.store.indice()
+        ruta_id = indice.asignadas.get(user_id)
+        return indice.por_id.get(ruta_id) if ruta_id is not None else None
+    
+    def rutas_de_zona(self, zona: str) -> List[Ruta]:
+        indice = self.store.indice()
+        return [indice.por_id[i] for i in indice.por_zona.get(zona, [])]
+    
     def _cargar_rutas(self):
-        """Carga rutas desde archivos JSON"""
-        self.rutas_disponibles = []
-        
+        """Carga rutas desde archivos de payload (JSON, MessagePack, gzip o plan)"""
         if not os.path.exists(CONFIG.CARPETA_RUTAS):
             os.makedirs(CONFIG.CARPETA_RUTAS)
             self._crear_ruta_ejemplo()
             return
         
-        for archivo in os.listdir(CONFIG.CARPETA_RUTAS):
-            if not archivo.endswith('.json'):
-                continue
-            
+        # Paquetes de plan primero; los archivos individuales los sobrescriben
+        archivos = sorted(
+            (a for a in os.listdir(CONFIG.CARPETA_RUTAS) if formato_rutas.es_archivo_payload(a)),
+            key=lambda a: (formato_rutas.es_archivo_ruta(a), a)
+        )
+        por_id: Dict[int, Ruta] = {}
+        origen: Dict[int, str] = {}
+        
+        for archivo in archivos:
             try:
-                with open(f"{CONFIG.CARPETA_RUTAS}/{archivo}", 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                # Validar datos mínimos
-                if not data.get('paradas'):
-                    logger.warning(f"Ruta sin paradas: {archivo}")
-                    continue
-                
-                ruta = Ruta(
-                    id=data.get('ruta_id', 0),
-                    zona=data.get('zona', 'SIN ZONA'),
-                    origen=data.get('origen', CONFIG.ORIGEN_FIJO),
-                    paradas=data.get('paradas', []),
-                    google_maps_url=data.get('google_maps_url')
-                )
-                
-                # Generar URL si no existe
-                if not ruta.google_maps_url:
-                    ruta.google_maps_url = self._generar_url_maps(ruta)
-                    if ruta.google_maps_url:
-                        self._guardar_url_en_archivo(archivo, ruta.google_maps_url)
-                
-                self.rutas_disponibles.append(ruta)
-                logger.info(f"✅ Ruta {ruta.id} cargada: {ruta.total_paradas} paradas")
-                
+                contenido = formato_rutas.leer_archivo(f"{CONFIG.CARPETA_RUTAS}/{archivo}")
             except Exception as e:
                 logger.error(f"Error cargando {archivo}: {e}")
+                continue
+            
+            for data in formato_rutas.extraer_rutas(contenido):
+                ruta = self._ruta_desde_payload(data, archivo)
+                if ruta:
+                    por_id[ruta.id] = ruta
+                    origen[ruta.id] = archivo
         
-        if not self.rutas_disponibles:
+        with self._lock_archivos:
+            self._origen, self._ids_por_archivo = {}, {}
+            for ruta_id, archivo in origen.items():
+                self._registrar_origen(ruta_id, archivo)
+        self.store.reemplazar_rutas(list(por_id.values()))
+        
+        if not por_id:
             logger.warning("No hay rutas disponibles, creando ejemplo")
             self._crear_ruta_ejemplo()
     
+    def _ruta_desde_payload(self, data: Dict, archivo: str) -> Optional[Ruta]:
+        """Valida y construye una ruta a partir de su payload (la URL viene precalculada)"""
+        try:
+            # Validar datos mínimos
+            if not data.get('paradas'):
+                logger.warning(f"Ruta sin paradas: {archivo}")
+                return None
+            
+            ruta = Ruta(
+                id=data.get('ruta_id', 0),
+                zona=data.get('zona', 'SIN ZONA'),
+                origen=data.get('origen', CONFIG.ORIGEN_FIJO),
+                paradas=data.get('paradas', []),
+                google_maps_url=data.get('google_maps_url')
+            )
+            
+            logger.info(f"✅ Ruta {ruta.id} cargada: {ruta.total_paradas} paradas")
+            return ruta
+            
+        except Exception as e:
+            logger.error(f"Error cargando ruta de {archivo}: {e}")
+            return None
+    
     def _crear_ruta_ejemplo(self):
         """Crea una ruta de ejemplo para pruebas"""
         ruta_ejemplo = {
@@ -245,153 +824,257 @@ class RouteManager:
             ]
         }
         
-        url = self._generar_url_maps(Ruta(**ruta_ejemplo))
-        if url:
-            ruta_ejemplo['google_maps_url'] = url
+        ruta = Ruta(id=ruta_ejemplo['ruta_id'], zona=ruta_ejemplo['zona'],
+                    origen=ruta_ejemplo['origen'], paradas=ruta_ejemplo['paradas'])
+        ruta.google_maps_url = ruta_ejemplo['google_maps_url'] = self._url_maps(ruta)
         
-        archivo = f"{CONFIG.CARPETA_RUTAS}/Ruta_1_CENTRO.json"
-        with open(archivo, 'w', encoding='utf-8') as f:
-            json.dump(ruta_ejemplo, f, indent=2, ensure_ascii=False)
+        formato_rutas.escribir_archivo(f"{CONFIG.CARPETA_RUTAS}/Ruta_1_CENTRO", ruta_ejemplo)
         
-        self.rutas_disponibles.append(Ruta(**ruta_ejemplo))
+        self.store.guardar_rutas([ruta])
         logger.info("✅ Ruta de ejemplo creada")
     
-    def _guardar_url_en_archivo(self, archivo: str, url: str):
-        """Guarda URL en archivo JSON"""
-        try:
-            with open(f"{CONFIG.CARPETA_RUTAS}/{archivo}", 'r+', encoding='utf-8') as f:
-                data = json.load(f)
-                data['google_maps_url'] = url
-                f.seek(0)
-                json.dump(data, f, indent=2, ensure_ascii=False)
-                f.truncate()
-        except Exception as e:
-            logger.error(f"Error guardando URL: {e}")
-    
-    def _limpiar_direccion(self, direccion: str) -> str:
-        """Limpia y normaliza una dirección"""
-        if not direccion:
-            return CONFIG.ORIGEN_FIJO
-        
-        d = str(direccion)
-        # Limpiar HTML y saltos de línea
-        d = re.sub(r'<br\s*/?>', ' ', d)
-        d = re.sub(r'[\n\r]', ' ', d)
-        d = re.sub(r'\s+', ' ', d)
-        d = d.strip()
-        
-        # Agregar Ciudad de México si es necesario
-        if not any(term in d.lower() for term in ['ciudad de méxico', 'cdmx', 'mexico']):
-            d += ", Ciudad de México"
-        
-        return d
-    
-    def _extraer_direccion_parada(self, parada: Dict) -> str:
-        """Extrae la mejor dirección disponible de una parada"""
-        # Intentar con dirección directa
-        direccion = parada.get('direccion', '')
-        if direccion and direccion not in ['', 'Sin dirección', 'N/A']:
-            return direccion
-        
-        # Intentar con coordenadas
-        coords = parada.get('coords', '')
-        if coords and ',' in coords:
-            return coords
-        
-        # Intentar con primera persona
-        personas = parada.get('personas', [])
-        if personas:
-            dir_persona = personas[0].get('direccion', '')
-            if dir_persona and dir_persona not in ['', 'Sin dirección']:
-                return dir_persona
-        
-        # Usar nombre del edificio como último recurso
-        nombre = parada.get('nombre', f"Edificio {parada.get('orden', '')}")
-        return f"{nombre}, Ciudad de México"
-    
-    def _generar_url_maps(self, ruta: Ruta) -> Optional[str]:
-        """Genera URL de Google Maps para la ruta"""
-        try:
-            logger.info(f"Generando URL Maps para ruta {ruta.id}...")
-            
-            if not ruta.paradas:
-                return None
-            
-            # Extraer direcciones válidas
-            direcciones = []
-            for parada in ruta.paradas[:CONFIG.MAX_DIRECCIONES_URL]:  # Límite de Google
-                dir_raw = self._extraer_direccion_parada(parada)
-                dir_limpia = self._limpiar_direccion(dir_raw)
-                direcciones.append(dir_limpia)
-            
-            if len(direcciones) < 1:
-                return None
-            
-            # Codificar para URL
-            direcciones_codificadas = [urllib.parse.quote(d) for d in direcciones]
-            
-            # Construir URL
-            base = "https://www.google.com/maps/dir/"
-            origen = urllib.parse.quote(CONFIG.ORIGEN_FIJO)
-            
-            if len(direcciones) == 1:
-                url = f"{base}{origen}/{direcciones_codificadas[0]}/data=!4m2!4m1!3e0"
-            else:
-                waypoints = "/".join(direcciones_codificadas[:-1])
-                destino = direcciones_codificadas[-1]
-                url = f"{base}{origen}/{waypoints}/{destino}/data=!4m2!4m1!3e0"
-            
-            logger.info(f"✅ URL Maps generada: {url[:100]}...")
-            return url
-            
-        except Exception as e:
-            logger.error(f"Error generando URL Maps: {e}")
-            return None
+    def upsert_rutas(self, payloads: List[Dict]) -> Tuple[List[Ruta], List[Any], List[str]]:
+        """Valida, escribe e indexa solo las rutas recibidas: (guardadas, rechazadas, archivos)
+        
+        Los archivos se escriben en temporales y se renombran juntos; la URL
+        de Maps que falte se calcula aquí y se escribe con el payload, así
+        la carga nunca tiene que recalcularla ni reescribir archivos.
+        """
+        validas, rechazadas = [], []
+        for data in payloads:
+            if not isinstance(data, dict) or 'ruta_id' not in data:
+                rechazadas.append(data.get('ruta_id') if isinstance(data, dict) else None)
+                continue
+            ruta = self._ruta_desde_payload(data, f"ruta {data['ruta_id']}")
+            if not ruta:
+                rechazadas.append(data['ruta_id'])
+                continue
+            if not ruta.google_maps_url:
+                ruta.google_maps_url = self._url_maps(ruta)
+                data = {**data, 'google_maps_url': ruta.google_maps_url}
+            validas.append((ruta, data))
+        
+        if not validas:
+            return [], rechazadas, []
+        
+        os.makedirs(CONFIG.CARPETA_RUTAS, exist_ok=True)
+        previas = {ruta.id: self.ruta(ruta.id) for ruta, _ in validas}
+        bases = [f"{CONFIG.CARPETA_RUTAS}/Ruta_{ruta.id}_{data.get('zona', 'GENERAL')}" for ruta, data in validas]
+        archivos = formato_rutas.escribir_lote(list(zip(bases, (data for _, data in validas))))
+        
+        for (ruta, _), archivo in zip(validas, archivos):
+            self._quitar_archivos_previos(previas[ruta.id], archivo)
+        
+        rutas = [ruta for ruta, _ in validas]
+        with self._lock_archivos:
+            for ruta, archivo in zip(rutas, archivos):
+                self._registrar_origen(ruta.id, os.path.basename(archivo))
+        self.store.guardar_rutas(rutas)
+        return rutas, rechazadas, archivos
+    
+    def _registrar_origen(self, ruta_id: int, archivo: Optional[str]):
+        """Actualiza ruta_id → archivo y su inverso (llamar con _lock_archivos)"""
+        previo = self._origen.pop(ruta_id, None)
+        if previo is not None:
+            self._ids_por_archivo.get(previo, set()).discard(ruta_id)
+        if archivo is not None:
+            self._origen[ruta_id] = archivo
+            self._ids_por_archivo.setdefault(archivo, set()).add(ruta_id)
+    
+    def sincronizar_archivos(self, nombres: List[str]):
+        """Carga, actualiza o quita solo las rutas de los archivos indicados
+        
+        Un archivo que ya no existe quita sus rutas; uno nuevo o modificado se
+        vuelve a leer. Las rutas idénticas a las del índice no se reescriben
+        (p. ej. el archivo que acaba de guardar upsert_rutas).
+        """
+        nuevas: Dict[int, Ruta] = {}
+        quitar = set()
+        encontradas = set()  # En cualquiera de los archivos del lote
+        
+        with self._lock_archivos:
+            for nombre in nombres:
+                ruta_archivo = os.path.join(CONFIG.CARPETA_RUTAS, nombre)
+                previas = set(self._ids_por_archivo.get(nombre, set()))
+                contenidas = set()
+                
+                if os.path.exists(ruta_archivo):
+                    try:
+                        contenido = formato_rutas.leer_archivo(ruta_archivo)
+                    except Exception as e:
+                        logger.error(f"Error cargando {nombre}: {e}")
+                        continue
+                    
+                    for data in formato_rutas.extraer_rutas(contenido):
+                        ruta = self._ruta_desde_payload(data, nombre)
+                        if not ruta:
+                            continue
+                        # Un plan no pisa a una ruta que tiene su propio archivo
+                        origen = self._origen.get(ruta.id)
+                        if (not formato_rutas.es_archivo_ruta(nombre) and origen and origen != nombre
+                                and formato_rutas.es_archivo_ruta(origen)):
+                            continue
+                        contenidas.add(ruta.id)
+                        self._registrar_origen(ruta.id, nombre)
+                        if self.ruta(ruta.id) != ruta:
+                            nuevas[ruta.id] = ruta
+                
+                for ruta_id in previas - contenidas:
+                    self._registrar_origen(ruta_id, None)
+                    quitar.add(ruta_id)
+                encontradas |= contenidas
+                if not contenidas:
+                    self._ids_por_archivo.pop(nombre, None)
+        
+        # Una ruta que solo cambió de archivo (zona o formato) no se quita,
+        # aunque su contenido sea idéntico y no esté en nuevas
+        quitar -= encontradas
+        if nuevas:
+            self.store.guardar_rutas(list(nuevas.values()))
+        if quitar:
+            self.store.eliminar_rutas(sorted(quitar))
+        if nuevas or quitar:
+            logger.info(f"🔄 rutas_telegram: {len(nuevas)} rutas actualizadas, {len(quitar)} quitadas")
+    
+    @staticmethod
+    def _quitar_archivos_previos(previa: Optional[Ruta], archivo_nuevo: str):
+        """Borra el archivo anterior de la ruta si cambió de zona o de formato"""
+        if previa is None:
+            return
+        base = f"{CONFIG.CARPETA_RUTAS}/Ruta_{previa.id}_{previa.zona}"
+        for ext in formato_rutas.EXTENSIONES.values():
+            if base + ext != archivo_nuevo and os.path.exists(base + ext):
+                os.unlink(base + ext)
+    
+    @staticmethod
+    def _url_maps(ruta: Ruta) -> Optional[str]:
+        """URL de Google Maps para rutas recibidas sin ella (memoizada en url_maps)"""
+        return url_maps.url_ruta(ruta.origen, ruta.paradas, CONFIG.MAX_DIRECCIONES_URL)
     
     def obtener_ruta_para_usuario(self, user_id: int, user_name: str) -> Optional[Ruta]:
-        """Obtiene o asigna una ruta para un usuario"""
-        # Si ya tiene ruta asignada
-        if user_id in self.rutas_asignadas:
-            ruta_id = self.rutas_asignadas[user_id]
-            for ruta in self.rutas_disponibles:
-                if ruta.id == ruta_id:
-                    return ruta
-            # Si la ruta ya no existe, eliminar asignación
-            del self.rutas_asignadas[user_id]
-        
-        # Asignar nueva ruta (round-robin simple)
-        if not self.rutas_disponibles:
-            return None
+        """Obtiene o asigna una ruta para un usuario; None si no queda ninguna libre"""
+        indice = self.store.indice()
         
-        # Buscar ruta no asignada o tomar la primera
-        rutas_asignadas_ids = set(self.rutas_asignadas.values())
-        for ruta in self.rutas_disponibles:
-            if ruta.id not in rutas_asignadas_ids:
-                self.rutas_asignadas[user_id] = ruta.id
-                logger.info(f"Ruta {ruta.id} asignada a {user_name}")
-                return ruta
+        # Si ya tiene ruta asignada, solo se renueva el lease
+        ruta = indice.por_id.get(indice.asignadas.get(user_id))
+        if ruta:
+            self.store.renovar(user_id)
+            return ruta
+        
+        ruta_id = self.store.reclamar(user_id)
+        if ruta_id is None:
+            logger.info(f"Sin rutas libres para {user_name}")
+            return None
         
-        # Todas están asignadas, tomar la primera
-        ruta = self.rutas_disponibles[0]
-        self.rutas_asignadas[user_id] = ruta.id
-        logger.info(f"Ruta {ruta.id} (reutilizada) asignada a {user_name}")
-        return ruta
+        logger.info(f"Ruta {ruta_id} asignada a {user_name}")
+        return self.ruta(ruta_id)
+    
+    def registrar_actividad(self, user_id: int):
+        """El repartidor sigue trabajando: renueva el lease de su ruta"""
+        if user_id in self.rutas_asignadas:
+            self.store.renovar(user_id)
     
     def liberar_ruta(self, user_id: int):
         """Libera la ruta asignada a un usuario"""
-        if user_id in self.rutas_asignadas:
-            del self.rutas_asignadas[user_id]
+        if self.store.liberar(user_id):
             logger.info(f"Ruta liberada para usuario {user_id}")
 
+class VigilanteRutas(FileSystemEventHandler):
+    """Recarga en caliente de rutas_telegram con watchdog
+    
+    Junta los eventos del sistema de archivos y, tras VIGILANTE_DEBOUNCE_S
+    sin cambios, aplica solo los archivos afectados con
+    RouteManager.sincronizar_archivos (sin recorrer la carpeta completa).
+    """
+    
+    def __init__(self, route_manager: RouteManager, carpeta: str = None):
+        self.route_manager = route_manager
+        self.carpeta = carpeta or CONFIG.CARPETA_RUTAS
+        self._pendientes = set()
+        self._lock = threading.Lock()
+        self._temporizador: Optional[threading.Timer] = None
+        self._observer = None
+    
+    def iniciar(self) -> bool:
+        if Observer is None:
+            logger.warning("watchdog no instalado; rutas_telegram no se vigila")
+            return False
+        os.makedirs(self.carpeta, exist_ok=True)
+        self._observer = Observer()
+        self._observer.schedule(self, self.carpeta, recursive=False)
+        self._observer.daemon = True
+        self._observer.start()
+        logger.info(f"👀 Vigilando {self.carpeta}")
+        return True
+    
+    def detener(self):
+        if self._observer:
+            self._observer.stop()
+        with self._lock:
+            if self._temporizador:
+                self._temporizador.cancel()
+    
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        # Los renombrados (temporal → final) cuentan para ambos nombres
+        nombres = {os.path.basename(event.src_path), os.path.basename(getattr(event, 'dest_path', '') or '')}
+        nombres = {n for n in nombres if formato_rutas.es_archivo_payload(n)}
+        if not nombres:
+            return
+        with self._lock:
+            self._pendientes |= nombres
+            if self._temporizador:
+                self._temporizador.cancel()
+            self._temporizador = threading.Timer(CONFIG.VIGILANTE_DEBOUNCE_S, self._aplicar)
+            self._temporizador.daemon = True
+            self._temporizador.start()
+    
+    def _aplicar(self):
+        with self._lock:
+            nombres, self._pendientes = sorted(self._pendientes), set()
+        try:
+            self.route_manager.sincronizar_archivos(nombres)
+        except Exception as e:
+            logger.error(f"Error aplicando cambios de rutas_telegram: {e}")
+
 # =============================================================================
 # INTERFAZ DE TELEGRAM - MENÚS Y HANDLERS
 # =============================================================================
 
+class CacheVistas:
+    """Mensajes de ruta ya armados: (vista, ruta_id) → (versión, texto, teclado JSON)
+    
+    La entrada vale mientras la ruta conserve su versión; un upsert guarda la
+    ruta con una versión nueva y la siguiente consulta vuelve a armar la vista.
+    """
+    
+    def __init__(self):
+        self._vistas: Dict[Tuple[str, int], Tuple[int, str, str]] = {}
+    
+    def obtener(self, vista: str, ruta: Ruta, armar) -> Tuple[str, str]:
+        """(texto, teclado JSON); armar(ruta) -> (texto, InlineKeyboardMarkup) si no está vigente"""
+        entrada = self._vistas.get((vista, ruta.id))
+        if entrada is None or entrada[0] != ruta.version:
+            texto, markup = armar(ruta)
+            entrada = (ruta.version, texto, markup.to_json())
+            self._vistas[(vista, ruta.id)] = entrada
+        return entrada[1], entrada[2]
+    
+    def invalidar(self, ruta_ids: Optional[List[int]] = None):
+        if ruta_ids is None:
+            self._vistas.clear()
+            return
+        ids = set(ruta_ids)
+        for clave in [c for c in self._vistas if c[1] in ids]:
+            self._vistas.pop(clave, None)
+
 class TelegramBot:
     """Manejador principal del bot de Telegram"""
     
     def __init__(self):
         self.route_manager = RouteManager()
+        self.vistas = CacheVistas()
         self._registrar_handlers()
     
     def _registrar_handlers(self):
@@ -424,6 +1107,10 @@ class TelegramBot:
         @bot.message_handler(content_types=['location'])
         def handle_location(message):
             self._procesar_ubicacion(message)
+        
+        @bot.message_handler(content_types=['photo'])
+        def handle_photo(message):
+            self._procesar_foto(message)
     
     def _menu_principal(self, message):
         """Muestra el menú principal"""
@@ -466,17 +1153,26 @@ class TelegramBot:
         ruta = self.route_manager.obtener_ruta_para_usuario(user_id, user_name)
         
         if not ruta:
-            bot.reply_to(
-                message,
-                "❌ **NO HAY RUTAS DISPONIBLES**\n\n"
-                "El sistema está generando nuevas rutas. Intenta más tarde."
-            )
+            if self.route_manager.rutas_disponibles:
+                texto = ("❌ **TODAS LAS RUTAS ESTÁN ASIGNADAS**\n\n"
+                         "Contacta a tu supervisor o intenta más tarde.")
+            else:
+                texto = ("❌ **NO HAY RUTAS DISPONIBLES**\n\n"
+                         "El sistema está generando nuevas rutas. Intenta más tarde.")
+            bot.reply_to(message, texto)
             return
         
-        # Crear mensaje de respuesta
+        # Solo el nombre del repartidor cambia entre usuarios
+        detalle, markup = self.vistas.obtener('asignada', ruta, self._armar_ruta_asignada)
         texto = (
             f"✅ **RUTA ASIGNADA EXITOSAMENTE**\n\n"
             f"👤 **Repartidor:** {user_name}\n"
+            + detalle
+        )
+        bot.reply_to(message, texto, parse_mode='Markdown', reply_markup=markup)
+    
+    def _armar_ruta_asignada(self, ruta: Ruta) -> Tuple[str, Any]:
+        texto = (
             f"📊 **Ruta ID:** {ruta.id} - {ruta.zona}\n"
             f"🏢 **Edificios:** {ruta.total_paradas}\n"
             f"👥 **Personas:** {ruta.total_personas}\n\n"
@@ -505,7 +1201,7 @@ class TelegramBot:
                 personas = parada.get('total_personas', 1)
                 texto += f"\n{i}. **{nombre}** - 👥 {personas} personas"
         
-        bot.reply_to(message, texto, parse_mode='Markdown', reply_markup=markup)
+        return texto, markup
     
     def _ver_ruta_actual(self, message):
         """Muestra la ruta actual del usuario"""
@@ -523,14 +1219,17 @@ class TelegramBot:
             )
             return
         
-        ruta_id = self.route_manager.rutas_asignadas[user_id]
-        ruta = next((r for r in self.route_manager.rutas_disponibles if r.id == ruta_id), None)
+        ruta = self.route_manager.ruta_de_usuario(user_id)
         
         if not ruta:
             self.route_manager.liberar_ruta(user_id)
             bot.reply_to(message, "❌ Tu ruta ya no está disponible. Solicita una nueva con /ruta")
             return
         
+        texto, markup = self.vistas.obtener('actual', ruta, self._armar_ruta_actual)
+        bot.reply_to(message, texto, parse_mode='Markdown', reply_markup=markup)
+    
+    def _armar_ruta_actual(self, ruta: Ruta) -> Tuple[str, Any]:
         texto = (
             f"🗺️ **TU RUTA ACTUAL**\n\n"
             f"**ID:** {ruta.id} - {ruta.zona}\n"
@@ -558,7 +1257,7 @@ class TelegramBot:
             markup.add(types.InlineKeyboardButton("📍 VER EN GOOGLE MAPS", url=ruta.google_maps_url))
         markup.add(types.InlineKeyboardButton("⬅️ VOLVER", callback_data="menu"))
         
-        bot.reply_to(message, texto, parse_mode='Markdown', reply_markup=markup)
+        return texto, markup
     
     def _liberar_ruta(self, message):
         """Libera la ruta actual del usuario"""
@@ -593,8 +1292,13 @@ class TelegramBot:
             lon = message.location.longitude
             user_id = message.from_user.id
             
-            # Guardar en DB
-            self.route_manager.db.guardar_ubicacion(user_id, lat, lon)
+            # Guardar en DB y publicar para el seguimiento en vivo
+            db = self.route_manager.db
+            db.guardar_ubicacion(user_id, lat, lon)
+            self.route_manager.registrar_actividad(user_id)
+            db.registrar_evento('ubicacion', self.route_manager.rutas_asignadas.get(user_id), user_id,
+                                message.from_user.first_name or str(user_id),
+                                datos={'latitud': lat, 'longitud': lon})
             
             maps_url = f"https://www.google.com/maps?q={lat},{lon}"
             
@@ -619,6 +1323,51 @@ class TelegramBot:
             logger.error(f"Error procesando ubicación: {e}")
             bot.reply_to(message, "❌ Error procesando tu ubicación")
     
+    def _procesar_foto(self, message):
+        """Registra la foto de acuse como avance de entrega
+        
+        El pie de foto es el nombre de la persona que recibió; si empieza con
+        "incidente" se registra como incidente.
+        """
+        try:
+            user_id = message.from_user.id
+            repartidor = message.from_user.first_name or str(user_id)
+            caption = (message.caption or "").strip()
+            tipo = 'incidente' if caption.lower().startswith('incidente') else 'entrega'
+            persona = caption if tipo == 'entrega' else ""
+            ruta_id = self.route_manager.rutas_asignadas.get(user_id)
+            
+            # La foto de mayor resolución es la última
+            foto = message.photo[-1]
+            carpeta = f"{CONFIG.CARPETA_FOTOS}/{'entregas' if tipo == 'entrega' else 'incidentes'}"
+            os.makedirs(carpeta, exist_ok=True)
+            ruta_local = f"{carpeta}/{ruta_id or 'sin_ruta'}_{user_id}_{foto.file_unique_id}.jpg"
+            
+            try:
+                archivo = bot.get_file(foto.file_id)
+                with open(ruta_local, 'wb') as f:
+                    f.write(bot.download_file(archivo.file_path))
+            except Exception as e:
+                logger.error(f"Error descargando foto: {e}")
+                ruta_local = ""
+            
+            self.route_manager.registrar_actividad(user_id)
+            db = self.route_manager.db
+            db.guardar_foto(foto.file_id, user_id, repartidor, caption, tipo, ruta_local)
+            seq = db.registrar_evento(tipo, ruta_id, user_id, repartidor, persona, ruta_local, foto.file_id)
+            
+            if tipo == 'entrega' and not persona:
+                texto = "📸 Foto guardada. Escribe el nombre de quien recibió como pie de foto."
+            elif not ruta_id:
+                texto = "📸 Foto guardada, pero no tienes ruta asignada. Usa /ruta."
+            else:
+                texto = f"✅ {'Entrega' if tipo == 'entrega' else 'Incidente'} registrado (#{seq})"
+            bot.reply_to(message, texto)
+            
+        except Exception as e:
+            logger.error(f"Error procesando foto: {e}")
+            bot.reply_to(message, "❌ Error procesando tu foto")
+    
     def _manejar_callback(self, call):
         """Maneja todos los callbacks de botones inline"""
         try:
@@ -723,12 +1472,16 @@ class TelegramBot:
     
     def _mostrar_lista_edificios(self, message, ruta_id: int):
         """Muestra lista completa de edificios de una ruta"""
-        ruta = next((r for r in self.route_manager.rutas_disponibles if r.id == ruta_id), None)
+        ruta = self.route_manager.ruta(ruta_id)
         
         if not ruta:
             bot.send_message(message.chat.id, "❌ Ruta no encontrada")
             return
         
+        texto, markup = self.vistas.obtener('lista', ruta, self._armar_lista_edificios)
+        bot.send_message(message.chat.id, texto, parse_mode='Markdown', reply_markup=markup)
+    
+    def _armar_lista_edificios(self, ruta: Ruta) -> Tuple[str, Any]:
         texto = f"📋 **RUTA {ruta.id} - {ruta.zona}**\n\n"
         
         for i, parada in enumerate(ruta.paradas, 1):
@@ -749,7 +1502,7 @@ class TelegramBot:
             markup.add(types.InlineKeyboardButton("📍 VER RUTA EN MAPAS", url=ruta.google_maps_url))
         markup.add(types.InlineKeyboardButton("⬅️ VOLVER", callback_data="menu"))
         
-        bot.send_message(message.chat.id, texto, parse_mode='Markdown', reply_markup=markup)
+        return texto, markup
     
     def run(self):
         """Inicia el bot"""
@@ -762,6 +1515,8 @@ class TelegramBot:
 
 # Inicializar bot (pero no iniciar polling aquí)
 telegram_bot = TelegramBot()
+vigilante_rutas = VigilanteRutas(telegram_bot.route_manager)
+vigilante_rutas.iniciar()
 
 @app.route('/')
 def home():
@@ -798,7 +1553,8 @@ def api_status():
         "status": "ok",
         "rutas": {
             "disponibles": len(telegram_bot.route_manager.rutas_disponibles),
-            "asignadas": len(telegram_bot.route_manager.rutas_asignadas)
+            "asignadas": len(telegram_bot.route_manager.rutas_asignadas),
+            "libres": telegram_bot.route_manager.store.indice().total_libres
         },
         "usuarios_activos": len(telegram_bot.route_manager.rutas_asignadas),
         "fotos": stats['fotos'],
@@ -816,38 +1572,205 @@ def api_health():
         "timestamp": datetime.now().isoformat()
     })
 
+def _tipos_solicitados(por_defecto) -> List[str]:
+    """?tipos=entrega,ubicacion; sin parámetro, los tipos por defecto del endpoint"""
+    tipos = [t.strip() for t in request.args.get('tipos', '').split(',') if t.strip()]
+    return tipos or list(por_defecto)
+
+@app.route('/api/avances')
+def api_avances():
+    """Avances con seq > since, paginados: ?since=<cursor>&limit=N"""
+    try:
+        since = max(int(request.args.get('since', 0)), 0)
+        limit = min(max(int(request.args.get('limit', CONFIG.AVANCES_LIMITE)), 1), CONFIG.AVANCES_LIMITE_MAX)
+    except ValueError:
+        return jsonify({"error": "since y limit deben ser enteros"}), 400
+    
+    # Se pide uno de más para saber si hay otra página
+    eventos = telegram_bot.route_manager.db.eventos_desde(
+        since, limit + 1, tipos=_tipos_solicitados(CONFIG.TIPOS_AVANCE)
+    )
+    hay_mas = len(eventos) > limit
+    eventos = eventos[:limit]
+    
+    return jsonify({
+        "avances": eventos,
+        "cursor": eventos[-1]['seq'] if eventos else since,
+        "hay_mas": hay_mas
+    })
+
+@app.route('/api/avances/ack', methods=['POST'])
+def api_avances_ack():
+    """Marca como procesados varios avances: {"seqs": [..]}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        seqs = [int(s) for s in data.get('seqs', [])]
+    except (TypeError, ValueError):
+        return jsonify({"error": "seqs debe ser una lista de enteros"}), 400
+    
+    procesados = telegram_bot.route_manager.db.marcar_eventos_procesados(seqs)
+    return jsonify({"status": "success", "recibidos": len(seqs), "procesados": procesados})
+
+@app.route('/api/avances_pendientes')
+def api_avances_pendientes():
+    """Compatibilidad: avances aún no procesados (sin cursor)"""
+    eventos = telegram_bot.route_manager.db.eventos_desde(0, CONFIG.AVANCES_LIMITE_MAX, solo_pendientes=True,
+                                                          tipos=list(CONFIG.TIPOS_AVANCE))
+    return jsonify({"avances": eventos, "total": len(eventos)})
+
+@app.route('/api/eventos/stream')
+def api_eventos_stream():
+    """Server-Sent Events de entregas, incidentes y ubicaciones
+    
+    Reanuda desde el header Last-Event-ID (o ?since=<cursor>). Cada evento
+    lleva su seq como id; tras cada lote se envía un comentario ": lote" y,
+    sin actividad, un ": latido" periódico. La conexión se cierra después de
+    STREAM_DURACION_MAX_S y el cliente reconecta desde su último id.
+    """
+    try:
+        since = max(int(request.headers.get('Last-Event-ID') or request.args.get('since', 0)), 0)
+    except ValueError:
+        return jsonify({"error": "Last-Event-ID/since debe ser entero"}), 400
+    tipos = _tipos_solicitados(CONFIG.TIPOS_STREAM)
+    db = telegram_bot.route_manager.db
+    
+    def generar():
+        cursor = since
+        fin = time.monotonic() + CONFIG.STREAM_DURACION_MAX_S
+        ultimo_envio = time.monotonic()
+        yield f"retry: {CONFIG.STREAM_RETRY_MS}\n\n"
+        yield f": conectado {cursor}\n\n"
+        
+        while time.monotonic() < fin:
+            # ultimo_seq antes de consultar: lo que llegue después despierta la espera
+            visto = db.ultimo_seq()
+            eventos = db.eventos_desde(cursor, CONFIG.AVANCES_LIMITE, tipos=tipos)
+            if eventos:
+                for evento in eventos:
+                    datos = json.dumps(evento, ensure_ascii=False)
+                    yield f"id: {evento['seq']}\nevent: {evento['tipo']}\ndata: {datos}\n\n"
+                cursor = eventos[-1]['seq']
+                yield f": lote {cursor}\n\n"
+                ultimo_envio = time.monotonic()
+                continue
+            
+            # Nada de los tipos pedidos hasta visto: no volver a recorrer esos seq
+            cursor = max(cursor, visto)
+            if time.monotonic() - ultimo_envio >= CONFIG.STREAM_LATIDO_S:
+                yield ": latido\n\n"
+                ultimo_envio = time.monotonic()
+            db.esperar_evento(visto, CONFIG.STREAM_SONDEO_S)
+    
+    return Response(generar(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/avances/<int:seq>/procesado', methods=['POST'])
+def api_avance_procesado(seq: int):
+    """Compatibilidad: marca un solo avance como procesado"""
+    procesados = telegram_bot.route_manager.db.marcar_eventos_procesados([seq])
+    return jsonify({"status": "success", "procesados": procesados})
+
+def _respuesta_previa():
+    """Si la petición repite una Idempotency-Key ya atendida, su respuesta original"""
+    clave = request.headers.get('Idempotency-Key')
+    if not clave:
+        return None
+    previa = telegram_bot.route_manager.db.respuesta_idempotente(clave)
+    if previa is None:
+        return None
+    logger.info(f"↩️ Petición repetida ({clave}), se devuelve la respuesta original")
+    respuesta = jsonify(previa)
+    respuesta.headers['Idempotent-Replay'] = 'true'
+    return respuesta
+
+def _registrar_respuesta(respuesta: Dict) -> Dict:
+    clave = request.headers.get('Idempotency-Key')
+    if clave:
+        telegram_bot.route_manager.db.guardar_respuesta_idempotente(clave, request.path, respuesta)
+    return respuesta
+
 @app.route('/api/rutas', methods=['POST'])
 def api_recibir_ruta():
-    """Endpoint para recibir rutas del sistema generador"""
+    """Endpoint para recibir rutas del sistema generador
+    
+    Acepta JSON (application/json) o cualquier payload de formato_rutas:
+    JSON minificado, MessagePack y gzip.
+    """
     try:
-        data = request.json
-        if not data:
+        previa = _respuesta_previa()
+        if previa:
+            return previa
+        
+        if request.is_json:
+            data = request.get_json(silent=True)
+        else:
+            data = formato_rutas.decodificar(request.get_data()) if request.content_length else None
+        if not data or not isinstance(data, dict):
             return jsonify({"error": "Datos vacíos"}), 400
         
-        ruta_id = data.get('ruta_id', 1)
+        ruta_id = data.setdefault('ruta_id', 1)
         zona = data.get('zona', 'GENERAL')
         
         logger.info(f"📥 Recibiendo ruta {ruta_id} - {zona}")
         
-        # Guardar archivo
-        archivo = f"{CONFIG.CARPETA_RUTAS}/Ruta_{ruta_id}_{zona}.json"
-        with open(archivo, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        # Solo esta ruta: validar, escribir e indexar
+        guardadas, _, archivos = telegram_bot.route_manager.upsert_rutas([data])
+        if not guardadas:
+            return jsonify({"error": "Ruta inválida (sin paradas)", "ruta_id": ruta_id}), 400
+        telegram_bot.vistas.invalidar([r.id for r in guardadas])
         
-        # Recargar rutas
-        telegram_bot.route_manager._cargar_rutas()
-        
-        return jsonify({
+        return jsonify(_registrar_respuesta({
             "status": "success",
             "ruta_id": ruta_id,
-            "archivo": archivo,
+            "archivo": archivos[0],
             "rutas_disponibles": len(telegram_bot.route_manager.rutas_disponibles)
-        })
+        }))
         
     except Exception as e:
         logger.error(f"Error en API /rutas: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/rutas/batch', methods=['POST'])
+def api_recibir_rutas_batch():
+    """Recibe un plan completo en una sola petición
+    
+    El cuerpo puede ser un paquete de plan o un arreglo de rutas, en JSON o
+    MessagePack y opcionalmente comprimido con gzip. Todas las rutas válidas
+    se escriben juntas y se indexan en una sola transacción.
+    """
+    try:
+        previa = _respuesta_previa()
+        if previa:
+            return previa
+        
+        if request.is_json:
+            data = request.get_json(silent=True)
+        else:
+            data = formato_rutas.decodificar(request.get_data()) if request.content_length else None
+        if not data:
+            return jsonify({"error": "Datos vacíos"}), 400
+        
+        rutas = formato_rutas.extraer_rutas(data)
+        logger.info(f"📥 Recibiendo lote de {len(rutas)} rutas")
+        
+        guardadas, rechazadas, archivos = telegram_bot.route_manager.upsert_rutas(rutas)
+        if not guardadas:
+            return jsonify({"error": "Ninguna ruta válida", "rechazadas": rechazadas}), 400
+        telegram_bot.vistas.invalidar([r.id for r in guardadas])
+        
+        return jsonify(_registrar_respuesta({
+            "status": "success",
+            "recibidas": len(rutas),
+            "guardadas": [ruta.id for ruta in guardadas],
+            "rechazadas": rechazadas,
+            "archivos": archivos,
+            "rutas_disponibles": len(telegram_bot.route_manager.rutas_disponibles)
+        }))
+        
+    except Exception as e:
+        logger.error(f"Error en API /rutas/batch: {e}")
+        return jsonify({"error": str(e)}), 500
+
 # =============================================================================
 # MAIN
 # =============================================================================
@@ -0,0 +1,186 @@
+"""
+FORMATO DE RUTAS - PAYLOAD COMPARTIDO
+Codificación de rutas entre el generador (Sistema_Rutas_Completo.py) y el bot:
+- JSON minificado (siempre disponible) o MessagePack
+- Compresión gzip opcional
+- Paquete de plan: todas las rutas en un solo archivo
+- Esquema versionado; los archivos sin versión se leen como versión 1
+"""
+
+import gzip
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # JSON sigue disponible como respaldo
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+VERSION_ESQUEMA = 1
+ESQUEMA_PLAN = "pjcdmx.plan_rutas"
+PREFIJO_PLAN = "PLAN_"
+
+EXTENSIONES = {
+    ('json', False): '.json',
+    ('json', True): '.json.gz',
+    ('msgpack', False): '.msgpack',
+    ('msgpack', True): '.msgpack.gz',
+}
+
+_MAGIC_GZIP = b'\x1f\x8b'
+
+
+def formato_disponible(formato: str) -> str:
+    """Retorna el formato solicitado o 'json' si MessagePack no está instalado"""
+    if formato == 'msgpack' and msgpack is None:
+        return 'json'
+    return formato
+
+
+def codificar(data: Any, formato: str = 'json', comprimir: bool = False) -> bytes:
+    """Serializa un payload en el formato indicado"""
+    formato = formato_disponible(formato)
+    if formato == 'msgpack':
+        contenido = msgpack.packb(data, use_bin_type=True)
+    else:
+        contenido = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    if comprimir:
+        contenido = gzip.compress(contenido, compresslevel=6)
+    return contenido
+
+
+def decodificar(contenido: bytes) -> Any:
+    """Deserializa un payload detectando gzip, JSON o MessagePack por su contenido"""
+    if contenido[:2] == _MAGIC_GZIP:
+        contenido = gzip.decompress(contenido)
+
+    inicio = contenido.lstrip()[:1]
+    if inicio in (b'{', b'['):
+        data = json.loads(contenido.decode('utf-8'))
+    elif msgpack is not None:
+        data = msgpack.unpackb(contenido, raw=False)
+    else:
+        raise ValueError("Payload MessagePack recibido pero msgpack no está instalado")
+
+    _validar_version(data)
+    return data
+
+
+def _validar_version(data: Any):
+    if isinstance(data, dict):
+        version = data.get('version_esquema', 1)
+        if version > VERSION_ESQUEMA:
+            raise ValueError(f"Versión de esquema no soportada: {version} (máx. {VERSION_ESQUEMA})")
+
+
+def empaquetar_plan(rutas: List[Dict], generado: Optional[str] = None) -> Dict:
+    """Envuelve las rutas de un plan en un solo documento versionado"""
+    return {
+        'esquema': ESQUEMA_PLAN,
+        'version_esquema': VERSION_ESQUEMA,
+        'generado': generado or datetime.now().isoformat(),
+        'total_rutas': len(rutas),
+        'rutas': rutas
+    }
+
+
+def es_plan(data: Any) -> bool:
+    return isinstance(data, dict) and data.get('esquema') == ESQUEMA_PLAN
+
+
+def extraer_rutas(data: Any) -> List[Dict]:
+    """Lista de rutas de un payload: ruta individual, plan o arreglo de rutas"""
+    if es_plan(data):
+        return list(data.get('rutas', []))
+    if isinstance(data, list):
+        return data
+    return [data]
+
+
+def extension(formato: str = 'json', comprimir: bool = False) -> str:
+    return EXTENSIONES[(formato_disponible(formato), comprimir)]
+
+
+def es_archivo_payload(nombre: str) -> bool:
+    return any(nombre.endswith(ext) for ext in EXTENSIONES.values())
+
+
+def es_archivo_ruta(nombre: str) -> bool:
+    """Archivo de una ruta individual (excluye paquetes de plan)"""
+    return es_archivo_payload(nombre) and not nombre.startswith(PREFIJO_PLAN)
+
+
+def _formato_de_archivo(archivo: str) -> Tuple[str, bool]:
+    for (formato, comprimir), ext in EXTENSIONES.items():
+        if archivo.endswith(ext):
+            return formato, comprimir
+    return 'json', False
+
+
+def escribir_archivo(base: str, data: Any, formato: str = 'json', comprimir: bool = False) -> str:
+    """Escribe el payload en base + extensión del formato; retorna la ruta final"""
+    archivo = base + extension(formato, comprimir)
+    temporal = f"{archivo}.tmp"
+    with open(temporal, 'wb') as f:
+        f.write(codificar(data, formato, comprimir))
+    os.replace(temporal, archivo)
+    return archivo
+
+
+def escribir_lote(elementos: List[Tuple[str, Any]], formato: str = 'json',
+                  comprimir: bool = False) -> List[str]:
+    """Escribe varios payloads (base, datos) como una sola operación
+
+    Primero se codifican todos en temporales; solo si ninguno falla se
+    renombran a su nombre final, así un lote inválido no deja archivos a medias.
+    """
+    pendientes = []
+    try:
+        for base, data in elementos:
+            archivo = base + extension(formato, comprimir)
+            temporal = f"{archivo}.tmp"
+            with open(temporal, 'wb') as f:
+                f.write(codificar(data, formato, comprimir))
+            pendientes.append((temporal, archivo))
+    except Exception:
+        for temporal, _ in pendientes:
+            if os.path.exists(temporal):
+                os.unlink(temporal)
+        raise
+
+    for temporal, archivo in pendientes:
+        os.replace(temporal, archivo)
+    return [archivo for _, archivo in pendientes]
+
+
+def guardar_archivo(archivo: str, data: Any) -> str:
+    """Reescribe un archivo existente conservando su formato"""
+    formato, comprimir = _formato_de_archivo(archivo)
+    base = archivo[:-len(EXTENSIONES[(formato, comprimir)])]
+    return escribir_archivo(base, data, formato, comprimir)
+
+
+def leer_archivo(archivo: str) -> Any:
+    with open(archivo, 'rb') as f:
+        return decodificar(f.read())
+
+
+def iterar_rutas(carpeta: str) -> Iterator[Tuple[str, Dict]]:
+    """Recorre los archivos de rutas individuales de una carpeta: (nombre, datos)"""
+    if not os.path.exists(carpeta):
+        return
+    for archivo in sorted(os.listdir(carpeta)):
+        if not es_archivo_ruta(archivo):
+            continue
+        try:
+            data = leer_archivo(os.path.join(carpeta, archivo))
+        except Exception as e:
+            logger.error(f"Error leyendo {archivo}: {e}")
+            continue
+        yield archivo, data
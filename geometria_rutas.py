@@ -0,0 +1,114 @@
+"""
+GEOMETRÍA DE RUTAS
+Procesamiento de polilíneas para mapas:
+- Decodificación cacheada por ruta (se invalida si cambia la polilínea)
+- Simplificación Douglas–Peucker con NumPy y tolerancia en metros
+- Re-codificación para incrustar la geometría simplificada
+"""
+
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+import polyline
+
+# Metros por grado de latitud (aprox. constante a la latitud de la CDMX)
+METROS_POR_GRADO_LAT = 110_540.0
+METROS_POR_GRADO_LNG_ECUADOR = 111_320.0
+
+
+def simplificar(puntos: np.ndarray, tolerancia_m: float) -> np.ndarray:
+    """Douglas–Peucker sobre un arreglo (N, 2) de [lat, lng]
+
+    Las distancias se calculan en una proyección equirectangular local, así
+    que la tolerancia se expresa en metros. Es iterativo (pila de segmentos)
+    y cada segmento evalúa todas sus distancias en una sola operación.
+    """
+    n = len(puntos)
+    if n < 3 or tolerancia_m <= 0:
+        return puntos
+
+    lat0 = np.radians(puntos[:, 0].mean())
+    xy = np.column_stack((
+        puntos[:, 1] * METROS_POR_GRADO_LNG_ECUADOR * np.cos(lat0),
+        puntos[:, 0] * METROS_POR_GRADO_LAT
+    ))
+
+    conservar = np.zeros(n, dtype=bool)
+    conservar[0] = conservar[-1] = True
+    pila = [(0, n - 1)]
+
+    while pila:
+        inicio, fin = pila.pop()
+        if fin - inicio < 2:
+            continue
+
+        a, b = xy[inicio], xy[fin]
+        intermedios = xy[inicio + 1:fin]
+        ab = b - a
+        largo = np.hypot(ab[0], ab[1])
+
+        if largo == 0:
+            distancias = np.hypot(intermedios[:, 0] - a[0], intermedios[:, 1] - a[1])
+        else:
+            # Distancia perpendicular = |producto cruz| / |ab|
+            distancias = np.abs(ab[0] * (intermedios[:, 1] - a[1]) -
+                                ab[1] * (intermedios[:, 0] - a[0])) / largo
+
+        idx = int(np.argmax(distancias))
+        if distancias[idx] > tolerancia_m:
+            medio = inicio + 1 + idx
+            conservar[medio] = True
+            pila.append((inicio, medio))
+            pila.append((medio, fin))
+
+    return puntos[conservar]
+
+
+class CachePolilineas:
+    """Caché de polilíneas decodificadas y simplificadas por ruta"""
+
+    def __init__(self):
+        self._rutas: Dict[int, Dict] = {}
+        self._lock = threading.Lock()
+
+    def _entrada(self, ruta_id: int, polilinea: str) -> Dict:
+        with self._lock:
+            entrada = self._rutas.get(ruta_id)
+            if entrada is None or entrada['polilinea'] != polilinea:
+                entrada = {
+                    'polilinea': polilinea,
+                    'puntos': np.array(polyline.decode(polilinea), dtype=float).reshape(-1, 2),
+                    'simplificadas': {}
+                }
+                self._rutas[ruta_id] = entrada
+            return entrada
+
+    def puntos(self, ruta_id: int, polilinea: str, tolerancia_m: float = 0) -> np.ndarray:
+        """Puntos [lat, lng] de la ruta, simplificados si tolerancia_m > 0"""
+        if not polilinea:
+            return np.empty((0, 2))
+        entrada = self._entrada(ruta_id, polilinea)
+        if tolerancia_m <= 0:
+            return entrada['puntos']
+        simplificadas = entrada['simplificadas']
+        if tolerancia_m not in simplificadas:
+            simplificadas[tolerancia_m] = simplificar(entrada['puntos'], tolerancia_m)
+        return simplificadas[tolerancia_m]
+
+    def coordenadas(self, ruta_id: int, polilinea: str, tolerancia_m: float = 0) -> List[Tuple[float, float]]:
+        """Lista de tuplas (lat, lng), como la retorna polyline.decode"""
+        return [tuple(p) for p in self.puntos(ruta_id, polilinea, tolerancia_m).tolist()]
+
+    def codificada(self, ruta_id: int, polilinea: str, tolerancia_m: float = 0) -> str:
+        """Polilínea re-codificada con la geometría simplificada"""
+        if not polilinea or tolerancia_m <= 0:
+            return polilinea
+        return polyline.encode(self.coordenadas(ruta_id, polilinea, tolerancia_m))
+
+    def limpiar(self):
+        with self._lock:
+            self._rutas.clear()
+
+
+CACHE_POLILINEAS = CachePolilineas()
@@ -0,0 +1,177 @@
+"""
+ÍNDICE DE DESTINATARIOS
+Búsqueda de la persona reportada por el repartidor dentro de las rutas:
+- Nombres plegados (sin acentos, minúsculas) y sin títulos (Lic., Mtra., Dr. ...)
+- Niveles de coincidencia: exacto → prefijo → difuso (difflib)
+- Cada coincidencia apunta a (ruta, edificio, persona) por su orden
+- Reporta ambigüedad cuando más de un destinatario coincide
+"""
+
+import bisect
+import difflib
+import json
+import os
+import re
+import unicodedata
+from dataclasses import dataclass, asdict, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+TITULOS = {
+    'lic', 'licenciado', 'licenciada', 'mtro', 'mtra', 'maestro', 'maestra',
+    'ing', 'ingeniero', 'ingeniera', 'dr', 'dra', 'doctor', 'doctora',
+    'c', 'cp', 'arq', 'sr', 'sra', 'srita', 'magdo', 'magda', 'juez', 'jueza'
+}
+
+UMBRAL_DIFUSO = 0.85
+VERSION_INDICE = 1
+
+
+def plegar(texto) -> str:
+    """Minúsculas sin acentos ni signos; espacios colapsados"""
+    texto = unicodedata.normalize('NFKD', str(texto or ''))
+    texto = ''.join(c for c in texto if not unicodedata.combining(c)).lower()
+    return ' '.join(re.sub(r'[^a-z0-9ñ]+', ' ', texto).split())
+
+
+def tokens(nombre) -> Tuple[str, ...]:
+    """Tokens del nombre sin los títulos iniciales"""
+    partes = plegar(nombre).split()
+    while len(partes) > 1 and partes[0] in TITULOS:
+        partes.pop(0)
+    return tuple(partes)
+
+
+def clave(nombre) -> str:
+    return ' '.join(tokens(nombre))
+
+
+@dataclass
+class Destinatario:
+    ruta_id: int
+    orden_edificio: int
+    orden_persona: int
+    nombre: str
+
+    @property
+    def id(self) -> Tuple[int, int, int]:
+        return (self.ruta_id, self.orden_edificio, self.orden_persona)
+
+
+@dataclass
+class Coincidencia:
+    nivel: str  # exacto | prefijo | difuso | ninguna
+    candidatos: List[Destinatario] = field(default_factory=list)
+
+    @property
+    def unica(self) -> Optional[Destinatario]:
+        return self.candidatos[0] if len(self.candidatos) == 1 else None
+
+    @property
+    def ambigua(self) -> bool:
+        return len(self.candidatos) > 1
+
+
+class IndiceDestinatarios:
+    """Índice nombre → destinatarios, construido al generar las rutas"""
+
+    def __init__(self, destinatarios: Iterable[Destinatario] = ()):
+        self.destinatarios: List[Destinatario] = []
+        self._exacto: Dict[str, List[int]] = {}
+        self._orden_libre: Dict[Tuple[str, ...], List[int]] = {}
+        self._por_token: Dict[str, List[int]] = {}
+        self._tokens_ordenados: List[str] = []
+        self._por_ruta: Dict[int, List[int]] = {}
+        for d in destinatarios:
+            self._agregar(d)
+        self._tokens_ordenados = sorted(self._por_token)
+
+    def _agregar(self, d: Destinatario):
+        i = len(self.destinatarios)
+        self.destinatarios.append(d)
+        toks = tokens(d.nombre)
+        if not toks:
+            return
+        self._exacto.setdefault(' '.join(toks), []).append(i)
+        self._orden_libre.setdefault(tuple(sorted(toks)), []).append(i)
+        for t in set(toks):
+            self._por_token.setdefault(t, []).append(i)
+        self._por_ruta.setdefault(d.ruta_id, []).append(i)
+
+    @classmethod
+    def desde_rutas(cls, rutas) -> 'IndiceDestinatarios':
+        """Desde objetos Ruta del generador (edificios → personas)"""
+        return cls(
+            Destinatario(ruta.id, orden_edificio, orden_persona, persona.nombre_completo or persona.nombre)
+            for ruta in rutas
+            for orden_edificio, edificio in enumerate(ruta.edificios, 1)
+            for orden_persona, persona in enumerate(edificio.personas, 1)
+        )
+
+    def _filtrar(self, indices: Iterable[int], ruta_id: Optional[int]) -> List[int]:
+        return sorted(i for i in set(indices)
+                      if ruta_id is None or self.destinatarios[i].ruta_id == ruta_id)
+
+    def _con_prefijo(self, prefijo: str) -> set:
+        """Destinatarios con algún token que empieza con prefijo (búsqueda binaria)"""
+        encontrados = set()
+        inicio = bisect.bisect_left(self._tokens_ordenados, prefijo)
+        for token in self._tokens_ordenados[inicio:]:
+            if not token.startswith(prefijo):
+                break
+            encontrados.update(self._por_token[token])
+        return encontrados
+
+    def buscar(self, nombre: str, ruta_id: Optional[int] = None) -> Coincidencia:
+        """Busca por niveles; se detiene en el primero que encuentre algo"""
+        toks = tokens(nombre)
+        if not toks:
+            return Coincidencia('ninguna')
+
+        # Exacto (también con las palabras en otro orden)
+        indices = self._filtrar(self._exacto.get(' '.join(toks), []), ruta_id)
+        if not indices:
+            indices = self._filtrar(self._orden_libre.get(tuple(sorted(toks)), []), ruta_id)
+        if indices:
+            return Coincidencia('exacto', [self.destinatarios[i] for i in indices])
+
+        # Prefijo: cada token reportado es prefijo de algún token del nombre
+        conjuntos = [self._con_prefijo(t) for t in toks]
+        indices = self._filtrar(set.intersection(*conjuntos), ruta_id) if all(conjuntos) else []
+        if indices:
+            return Coincidencia('prefijo', [self.destinatarios[i] for i in indices])
+
+        # Difuso: sobre los nombres de la ruta (o de todo el plan)
+        universo = self._por_ruta.get(ruta_id, []) if ruta_id is not None else range(len(self.destinatarios))
+        nombres: Dict[str, List[int]] = {}
+        for i in universo:
+            nombres.setdefault(clave(self.destinatarios[i].nombre), []).append(i)
+        cercanos = difflib.get_close_matches(' '.join(toks), list(nombres), n=3, cutoff=UMBRAL_DIFUSO)
+        if cercanos:
+            # Solo el mejor puntaje; empates cuentan como ambigüedad
+            puntaje = lambda c: difflib.SequenceMatcher(None, ' '.join(toks), c).ratio()
+            mejor = puntaje(cercanos[0])
+            indices = sorted(i for c in cercanos if puntaje(c) == mejor for i in nombres[c])
+            return Coincidencia('difuso', [self.destinatarios[i] for i in indices])
+
+        return Coincidencia('ninguna')
+
+    def rutas(self) -> set:
+        return set(self._por_ruta)
+
+    def guardar(self, archivo: str):
+        temporal = f"{archivo}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump({'version': VERSION_INDICE,
+                       'destinatarios': [asdict(d) for d in self.destinatarios]},
+                      f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temporal, archivo)
+
+    @classmethod
+    def cargar(cls, archivo: str) -> Optional['IndiceDestinatarios']:
+        if not os.path.exists(archivo):
+            return None
+        with open(archivo, 'r', encoding='utf-8') as f:
+            datos = json.load(f)
+        if datos.get('version') != VERSION_INDICE:
+            return None
+        return cls(Destinatario(**d) for d in datos.get('destinatarios', []))
@@ -0,0 +1,182 @@
+"""
+INSTRUMENTACIÓN DE CORRIDAS
+Medición de una corrida de generación de rutas:
+- Tiempo por etapa del pipeline
+- Llamadas externas por endpoint (conteo, tiempo, errores)
+- Contadores libres (aciertos de caché, estados de la API, rutas omitidas)
+- Captura opcional con cProfile y/o tracemalloc
+- Reporte JSON de la corrida
+"""
+
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MODOS_PERFIL = ('', 'cpu', 'memoria', 'completo')
+
+
+class Instrumentacion:
+    """Acumula tiempos y contadores de una corrida (seguro entre hilos)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reiniciar()
+
+    def reiniciar(self):
+        with self._lock:
+            self.inicio = time.perf_counter()
+            self.fecha_inicio = datetime.now().isoformat()
+            self.etapas: Dict[str, float] = {}
+            self.llamadas: Dict[str, Dict] = {}
+            self.contadores: Dict[str, int] = {}
+            self.perfil: Dict = {}
+
+    @contextmanager
+    def etapa(self, nombre: str):
+        """Cronometra una etapa; si se repite, los tiempos se suman"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.etapas[nombre] = self.etapas.get(nombre, 0.0) + time.perf_counter() - t0
+
+    @contextmanager
+    def llamada(self, endpoint: str):
+        """Cronometra una llamada externa; una excepción cuenta como error y se propaga"""
+        t0 = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            segundos = time.perf_counter() - t0
+            with self._lock:
+                datos = self.llamadas.setdefault(
+                    endpoint, {'llamadas': 0, 'errores': 0, 'segundos': 0.0, 'max_segundos': 0.0}
+                )
+                datos['llamadas'] += 1
+                datos['errores'] += error
+                datos['segundos'] += segundos
+                datos['max_segundos'] = max(datos['max_segundos'], segundos)
+
+    def contar(self, nombre: str, n: int = 1):
+        with self._lock:
+            self.contadores[nombre] = self.contadores.get(nombre, 0) + n
+
+    @contextmanager
+    def capturar(self, modo: str = '', archivo_perfil: Optional[str] = None, top: int = 15):
+        """Perfila el bloque: 'cpu' (cProfile), 'memoria' (tracemalloc) o 'completo'"""
+        cpu = modo in ('cpu', 'completo')
+        memoria = modo in ('memoria', 'completo')
+        perfilador = cProfile.Profile() if cpu else None
+        memoria_previa = tracemalloc.is_tracing()
+
+        if memoria and not memoria_previa:
+            tracemalloc.start()
+        if perfilador:
+            perfilador.enable()
+        try:
+            yield
+        finally:
+            if perfilador:
+                perfilador.disable()
+                self.perfil['cpu'] = self._resumen_cpu(perfilador, archivo_perfil, top)
+            if memoria:
+                self.perfil['memoria'] = self._resumen_memoria(top)
+                if not memoria_previa:
+                    tracemalloc.stop()
+
+    @staticmethod
+    def _resumen_cpu(perfilador: cProfile.Profile, archivo: Optional[str], top: int) -> Dict:
+        if archivo:
+            perfilador.dump_stats(archivo)
+        stats = pstats.Stats(perfilador)
+        funciones = []
+        for (ruta, linea, funcion), (_, llamadas, propio, acumulado, _) in stats.stats.items():
+            funciones.append({
+                'funcion': f"{os.path.basename(ruta)}:{linea}({funcion})",
+                'llamadas': llamadas,
+                'propio_s': round(propio, 4),
+                'acumulado_s': round(acumulado, 4)
+            })
+        funciones.sort(key=lambda f: f['acumulado_s'], reverse=True)
+        return {'archivo': archivo, 'top_acumulado': funciones[:top]}
+
+    @staticmethod
+    def _resumen_memoria(top: int) -> Dict:
+        actual, pico = tracemalloc.get_traced_memory()
+        lineas = tracemalloc.take_snapshot().statistics('lineno')[:top]
+        return {
+            'actual_mb': round(actual / 2**20, 2),
+            'pico_mb': round(pico / 2**20, 2),
+            'top_asignaciones': [
+                {'ubicacion': str(s.traceback[0]), 'kb': round(s.size / 1024, 1), 'bloques': s.count}
+                for s in lineas
+            ]
+        }
+
+    def reporte(self, extra: Optional[Dict] = None) -> Dict:
+        with self._lock:
+            llamadas = {
+                endpoint: {**d, 'segundos': round(d['segundos'], 3),
+                           'max_segundos': round(d['max_segundos'], 3)}
+                for endpoint, d in sorted(self.llamadas.items())
+            }
+            datos = {
+                'inicio': self.fecha_inicio,
+                'fin': datetime.now().isoformat(),
+                'duracion_s': round(time.perf_counter() - self.inicio, 3),
+                'etapas_s': {k: round(v, 3) for k, v in self.etapas.items()},
+                'llamadas_externas': llamadas,
+                'total_llamadas_api': sum(d['llamadas'] for d in self.llamadas.values()),
+                'contadores': dict(sorted(self.contadores.items())),
+            }
+            if self.perfil:
+                datos['perfil'] = self.perfil
+        if extra:
+            datos.update(extra)
+        return datos
+
+    def guardar(self, archivo: str, extra: Optional[Dict] = None) -> Dict:
+        """Escribe el reporte JSON de forma atómica y lo retorna"""
+        datos = self.reporte(extra)
+        temporal = f"{archivo}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(datos, f, ensure_ascii=False, indent=2)
+        os.replace(temporal, archivo)
+        logger.info(f"Reporte de ejecución: {archivo}")
+        return datos
+
+
+def lineas_resumen(reporte: Dict) -> List[str]:
+    """Resumen legible de un reporte para el log"""
+    lineas = [f"⏱️ Duración total: {reporte['duracion_s']:.1f}s"]
+    if reporte['etapas_s']:
+        lineas.append("⏱️ Etapas: " + ", ".join(f"{k} {v:.1f}s" for k, v in reporte['etapas_s'].items()))
+    for endpoint, d in reporte['llamadas_externas'].items():
+        lineas.append(f"🌐 {endpoint}: {d['llamadas']} llamadas, {d['errores']} errores, "
+                      f"{d['segundos']:.1f}s")
+    contadores = reporte['contadores']
+    aciertos = contadores.get('cache_geocode.aciertos', 0)
+    consultas = aciertos + contadores.get('cache_geocode.fallos', 0)
+    if consultas:
+        lineas.append(f"💾 Caché geocoding: {aciertos}/{consultas} aciertos ({aciertos / consultas:.0%})")
+    if 'perfil' in reporte and 'memoria' in reporte['perfil']:
+        lineas.append(f"🧠 Memoria pico: {reporte['perfil']['memoria']['pico_mb']} MB")
+    return lineas
+
+
+INSTRUMENTACION = Instrumentacion()
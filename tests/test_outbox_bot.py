@@ -0,0 +1,66 @@
+"""
+Reintentos del outbox hacia el bot (OutboxBot.procesar_pendientes)
+
+Uso:
+    python -m pytest tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ_REPO)
+
+import Sistema_Rutas_Completo as S
+
+
+class ConectorFijo:
+    """Responde siempre el mismo status a cada POST"""
+
+    def __init__(self, status):
+        self.status = status
+        self.llamadas = 0
+
+    def post_idempotente(self, endpoint, cuerpo, content_type, clave):
+        self.llamadas += 1
+        return self.status, {}
+
+
+class TestOutboxReintentos(unittest.TestCase):
+
+    def setUp(self):
+        self.temporal = tempfile.mkdtemp(prefix='pjcdmx_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.temporal, ignore_errors=True)
+
+    def _enviar_ack(self, status):
+        conector = ConectorFijo(status)
+        outbox = S.OutboxBot(os.path.join(self.temporal, f"outbox_{status}.db"), conector)
+        clave = outbox.encolar_ack("7")
+        outbox.procesar_pendientes()
+        outbox.procesar_pendientes(solo_vencidos=False)
+        return outbox, clave, conector
+
+    def test_404_no_se_reprograma(self):
+        outbox, clave, conector = self._enviar_ack(404)
+        self.assertEqual(outbox.estado(clave), 'fallido')
+        self.assertEqual(outbox.pendientes(), 0)
+        self.assertEqual(conector.llamadas, 1)
+
+    def test_401_es_definitivo(self):
+        outbox, clave, _ = self._enviar_ack(401)
+        self.assertEqual(outbox.estado(clave), 'fallido')
+
+    def test_reintentables_siguen_pendientes(self):
+        for status in (None, 408, 429, 503):
+            outbox, clave, conector = self._enviar_ack(status)
+            self.assertEqual(outbox.estado(clave), 'pendiente', status)
+            self.assertEqual(conector.llamadas, 2, status)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Checkpoint de la etapa de exportación (PipelineRutas._etapa_exportacion)
+
+Uso:
+    python -m pytest tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ_REPO)
+
+import Sistema_Rutas_Completo as S
+
+CONFIG_PIPELINE = ('CHECKPOINT_DIR', 'MAX_EDIFICIOS_POR_RUTA', 'PROCESOS_EXPORTACION', 'EXCEL_MODO',
+                   'MAPA_MODO', 'FORMATO_PAYLOAD', 'COMPRIMIR_PAYLOAD')
+
+
+def ruta_sintetica(ruta_id: int) -> S.Ruta:
+    persona = S.Persona(f"LIC. PERSONA {ruta_id}", f"PERSONA {ruta_id}", "JUZGADO", f"Calle {ruta_id}",
+                        "Cuauhtémoc")
+    edificio = S.Edificio(f"Calle {ruta_id}", f"calle {ruta_id}", "Cuauhtémoc", "JUZGADO",
+                          (19.43 + ruta_id / 1000, -99.13), [persona])
+    return S.Ruta(id=ruta_id, zona="CENTRO", edificios=[edificio], origen=S.CONFIG.ORIGEN_NOMBRE)
+
+
+class TestCheckpointExportacion(unittest.TestCase):
+
+    def setUp(self):
+        self._directorio = os.getcwd()
+        # _aplicar_config escribe en CONFIG; se restaura al terminar
+        self._config = {c: getattr(S.CONFIG, c) for c in CONFIG_PIPELINE}
+        self.temporal = tempfile.mkdtemp(prefix='pjcdmx_test_')
+        os.chdir(self.temporal)  # Los artefactos se escriben en rutas relativas
+        S.CONFIG.CHECKPOINT_DIR = os.path.join(self.temporal, 'checkpoints')
+
+    def tearDown(self):
+        os.chdir(self._directorio)
+        for campo, valor in self._config.items():
+            setattr(S.CONFIG, campo, valor)
+        shutil.rmtree(self.temporal, ignore_errors=True)
+
+    def _pipeline(self) -> S.PipelineRutas:
+        pipeline = S.PipelineRutas(S.OpcionesPipeline(procesos=1, subir=False, reanudar=True,
+                                                      excel_modo="por_ruta", mapa_modo="por_ruta"))
+        pipeline._aplicar_config()
+        pipeline.rutas = [ruta_sintetica(1), ruta_sintetica(2)]
+        return pipeline
+
+    def test_reanudar_reexporta_ruta_fallida(self):
+        generar_mapa = S.FileGenerator.generar_mapa
+
+        def _falla_ruta_2(file_gen, ruta, *args, **kwargs):
+            if ruta.id == 2:
+                raise IOError("disco lleno")
+            return generar_mapa(file_gen, ruta, *args, **kwargs)
+
+        pipeline = self._pipeline()
+        with mock.patch.object(S.FileGenerator, 'generar_mapa', _falla_ruta_2):
+            pipeline._etapa_exportacion('firma')
+        self.assertEqual([bool(e['error']) for e in pipeline.exportados], [False, True])
+        self.assertIsNone(pipeline.checkpoints.cargar('exportacion', 'firma'))
+
+        reanudada = self._pipeline()
+        reanudada._etapa_exportacion('firma')
+        self.assertEqual([e['error'] for e in reanudada.exportados], ['', ''])
+        self.assertTrue(os.path.exists(reanudada.exportados[1]['mapa']))
+        self.assertTrue(reanudada.exportados[0].get('omitida'))  # Ya estaba generada
+        self.assertIsNotNone(reanudada.checkpoints.cargar('exportacion', 'firma'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+Sincronización incremental de rutas_telegram (RouteManager.sincronizar_archivos)
+
+Uso:
+    python -m pytest tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault('BOT_TOKEN', '123:abc')
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ_REPO)
+
+_DIRECTORIO_PREVIO = os.getcwd()
+_TEMPORAL = tempfile.mkdtemp(prefix='pjcdmx_test_')
+os.chdir(_TEMPORAL)  # rutas_telegram es relativa al directorio de trabajo
+
+import bot
+import formato_rutas
+
+
+def tearDownModule():
+    bot.vigilante_rutas.detener()
+    os.chdir(_DIRECTORIO_PREVIO)
+    shutil.rmtree(_TEMPORAL, ignore_errors=True)
+
+
+def ruta_payload(ruta_id: int, zona: str) -> dict:
+    return {
+        'ruta_id': ruta_id,
+        'zona': zona,
+        'origen': bot.CONFIG.ORIGEN_FIJO,
+        'google_maps_url': 'https://www.google.com/maps/dir/?api=1',
+        'paradas': [{'orden': 1, 'nombre': 'Edificio 1', 'direccion': 'Calle 1', 'total_personas': 1,
+                     'personas': [{'nombre': 'ANA'}]}]
+    }
+
+
+class TestSincronizarArchivos(unittest.TestCase):
+
+    def setUp(self):
+        self.carpeta = tempfile.mkdtemp(dir=_TEMPORAL)
+        self._previos = (bot.CONFIG.CARPETA_RUTAS, bot.CONFIG.DB_PATH)
+        bot.CONFIG.CARPETA_RUTAS = os.path.join(self.carpeta, 'rutas_telegram')
+        bot.CONFIG.DB_PATH = os.path.join(self.carpeta, 'bot.db')
+        os.makedirs(bot.CONFIG.CARPETA_RUTAS)
+        formato_rutas.escribir_archivo(f"{bot.CONFIG.CARPETA_RUTAS}/Ruta_5_CENTRO", ruta_payload(5, 'CENTRO'))
+        self.manager = bot.RouteManager()
+        self.assertEqual(self.manager.obtener_ruta_para_usuario(7, 'Ana').id, 5)
+
+    def tearDown(self):
+        bot.CONFIG.CARPETA_RUTAS, bot.CONFIG.DB_PATH = self._previos
+
+    def _mover(self, nuevo: str, comprimir: bool = False):
+        """Otro worker reescribe la ruta sin cambios en otro archivo y borra el anterior"""
+        base = f"{bot.CONFIG.CARPETA_RUTAS}/{nuevo}"
+        archivo = formato_rutas.escribir_archivo(base, ruta_payload(5, 'CENTRO'), 'json', comprimir)
+        os.unlink(f"{bot.CONFIG.CARPETA_RUTAS}/Ruta_5_CENTRO.json")
+        self.manager.sincronizar_archivos(sorted(['Ruta_5_CENTRO.json', os.path.basename(archivo)]))
+
+    def _verificar_conservada(self):
+        self.assertIsNotNone(self.manager.ruta(5))
+        self.assertEqual(self.manager.ruta_de_usuario(7).id, 5)
+
+    def test_cambio_de_formato_conserva_ruta(self):
+        # El archivo borrado (.json) se procesa antes que el nuevo (.json.gz)
+        self._mover('Ruta_5_CENTRO', comprimir=True)
+        self._verificar_conservada()
+
+    def test_cambio_de_nombre_conserva_ruta(self):
+        self._mover('Ruta_5_CENTRO_B')
+        self._verificar_conservada()
+
+    def test_archivo_borrado_quita_ruta(self):
+        os.unlink(f"{bot.CONFIG.CARPETA_RUTAS}/Ruta_5_CENTRO.json")
+        self.manager.sincronizar_archivos(['Ruta_5_CENTRO.json'])
+        self.assertIsNone(self.manager.ruta(5))
+        self.assertIsNone(self.manager.ruta_de_usuario(7))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+URL DE GOOGLE MAPS - CONSTRUCTOR COMPARTIDO
+Una sola forma de armar la liga de navegación de una ruta:
+- La usa el generador (Sistema_Rutas_Completo.py) al escribir el payload
+- La usa el bot solo para rutas recibidas sin URL; al cargar archivos no recalcula
+- Memoizada por la lista de paradas (origen + direcciones)
+- Formato de Google Maps URLs (api=1): origen, destino y waypoints
+"""
+
+import re
+import urllib.parse
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+MAX_PARADAS = 8  # Google Maps tiene límite de waypoints
+BASE_URL = "https://www.google.com/maps/dir/?api=1"
+CIUDAD = "Ciudad de México"
+SIN_DIRECCION = ('', 'Sin dirección', 'N/A')
+_COORDENADAS = re.compile(r'^-?\d+(\.\d+)?,\s*-?\d+(\.\d+)?$')
+
+
+def limpiar_direccion(direccion) -> str:
+    """Sin HTML ni saltos de línea; agrega la ciudad si no la trae (salvo coordenadas)"""
+    d = re.sub(r'<br\s*/?>', ' ', str(direccion or ''))
+    d = ' '.join(d.split())
+    if (d and not _COORDENADAS.match(d)
+            and not any(term in d.lower() for term in ('ciudad de méxico', 'cdmx', 'mexico'))):
+        d += f", {CIUDAD}"
+    return d
+
+
+def direccion_parada(parada: Dict) -> str:
+    """Mejor dirección disponible de una parada del payload"""
+    direccion = parada.get('direccion', '')
+    if direccion and direccion not in SIN_DIRECCION:
+        return direccion
+
+    coords = parada.get('coords', '')
+    if coords and ',' in coords:
+        return coords
+
+    personas = parada.get('personas', [])
+    if personas:
+        dir_persona = personas[0].get('direccion', '')
+        if dir_persona and dir_persona not in SIN_DIRECCION:
+            return dir_persona
+
+    # Nombre del edificio como último recurso
+    return f"{parada.get('nombre', 'Edificio ' + str(parada.get('orden', '')))}, {CIUDAD}"
+
+
+@lru_cache(maxsize=1024)
+def _construir(origen: str, direcciones: Tuple[str, ...]) -> str:
+    limpias = [limpiar_direccion(d) for d in direcciones]
+    url = (f"{BASE_URL}&origin={urllib.parse.quote(limpiar_direccion(origen))}"
+           f"&destination={urllib.parse.quote(limpias[-1])}")
+    if len(limpias) > 1:
+        url += "&waypoints=" + "|".join(urllib.parse.quote(d) for d in limpias[:-1])
+    return url + "&travelmode=driving"
+
+
+def url_ruta(origen: str, paradas: List[Dict], max_paradas: int = MAX_PARADAS) -> Optional[str]:
+    """URL de navegación origen → paradas en orden; None si no hay paradas"""
+    direcciones = tuple(direccion_parada(p) for p in paradas[:max_paradas])
+    if not direcciones:
+        return None
+    return _construir(origen or CIUDAD, direcciones)